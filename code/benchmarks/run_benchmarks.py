@@ -0,0 +1,395 @@
+"""
+Benchmarks of the rnaseqTools and confusion-matrix hot paths on synthetic data (see synthetic.py).
+
+Every benchmark runs in its own process and records the wall time, the peak resident
+memory on top of the loaded data, the peak of the memory traced by tracemalloc, and the
+memory blocks still allocated after the call.
+Results are written as JSON, so that two commits can be compared:
+
+    python run_benchmarks.py --preset small --output before.json
+    (check out another commit)
+    python run_benchmarks.py --preset small --output after.json
+    python run_benchmarks.py --compare before.json after.json
+
+Benchmarks of functions or arguments that do not exist in the checked-out code are reported
+as skipped; any error while a benchmark runs, or a benchmark process that dies without a
+result, is reported as failed.
+"""
+import os
+import io
+import sys
+import json
+import time
+import pickle
+import inspect
+import importlib
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import tracemalloc
+import multiprocessing
+from queue import Empty
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '../'))
+sys.path.append(os.path.join(HERE, '../confusion_matrices/'))
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np
+import synthetic
+
+
+# Data sets
+
+def load_data(preset, datadir):
+    """
+    Returns the synthetic reference and patch-seq data of a preset, generated once and
+    then cached as a pickle in datadir.
+    """
+    params = synthetic.PRESETS[preset]
+    path = os.path.join(datadir, 'synthetic-{}.pickle'.format(preset))
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    ref = synthetic.reference(params['referenceCells'], params['genes'], params['clusters'], params['density'])
+    m1, ttypes = synthetic.patch_seq(ref, params['patchCells'], density=params['density'])
+    data = {'reference': ref, 'm1': m1, 'ttypes': ttypes}
+    os.makedirs(datadir, exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(data, f, protocol=4)
+    os.replace(path + '.tmp', path)
+    return data
+
+
+# Benchmarks: setup(data, datadir, **params) prepares the inputs (not measured)
+# and returns the function that is measured
+
+class Skipped(Exception):
+    # a benchmarked function or argument that does not exist in the checked-out code
+    pass
+
+
+def _require(module, name, arguments=()):
+    # the function name of module, or Skipped if this version of the code does not have it
+    # or it does not take all the keyword arguments
+    try:
+        mod = importlib.import_module(module)
+    except ModuleNotFoundError as e:
+        if e.name != module:
+            raise
+        raise Skipped('no module ' + module)
+    if not hasattr(mod, name):
+        raise Skipped('{}.{} does not exist'.format(module, name))
+    f = getattr(mod, name)
+    parameters = inspect.signature(f).parameters
+    if not any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+        missing = [a for a in arguments if a not in parameters]
+        if missing:
+            raise Skipped('{}.{} has no argument {}'.format(module, name, ', '.join(missing)))
+    return f
+
+
+def bench_sparseload(data, datadir, **params):
+    sparseload = _require('rnaseqTools', 'sparseload', params)
+    m1 = data['m1']
+    filename = os.path.join(datadir, 'exon-counts-{}.csv.gz'.format(m1.cells.size))
+    if not os.path.exists(filename):
+        synthetic.write_counts_csv(filename + '.tmp.gz', m1.exonCounts, m1.genes, m1.cells)
+        os.replace(filename + '.tmp.gz', filename)
+    return lambda: sparseload(filename, **params)
+
+
+def bench_geneSelection(data, datadir, n=3000):
+    geneSelection = _require('rnaseqTools', 'geneSelection', ['n', 'plot'])
+    counts = data['reference']['counts']
+    return lambda: geneSelection(counts, n=n, plot=False)
+
+
+def _log_inputs(data, referenceCells):
+    ref = data['reference']
+    m1 = data['m1']
+    _, a, b = np.intersect1d(m1.genes, ref['genes'], return_indices=True)
+    X = np.log2(m1.exonCounts[:, a].toarray() + 1)
+    T = ref['counts'][:referenceCells, b]
+    T.data = np.log2(T.data + 1)
+    return X, T
+
+
+def bench_corr2(data, datadir, referenceCells=2000):
+    corr2 = _require('rnaseqTools', 'corr2')
+    X, T = _log_inputs(data, referenceCells)
+    T = T.toarray()
+    return lambda: corr2(X, T)
+
+
+def bench_corr2_sparse(data, datadir, referenceCells=2000):
+    corr2_sparse = _require('rnaseqTools', 'corr2_sparse')
+    X, T = _log_inputs(data, referenceCells)
+    return lambda: corr2_sparse(X, T)
+
+
+_MAPPING_ARGUMENTS = ['newIntronCounts', 'normalizeNew', 'newExonLengths', 'newIntronLengths', 'seed']
+
+def bench_map_to_tsne(data, datadir, **params):
+    map_to_tsne = _require('rnaseqTools', 'map_to_tsne', _MAPPING_ARGUMENTS + list(params))
+    ref = data['reference']
+    m1 = data['m1']
+    return lambda: map_to_tsne(ref['counts'], ref['genes'], m1.exonCounts, m1.genes, ref['tsne'],
+                                           newIntronCounts=m1.intronCounts, normalizeNew=True,
+                                           newExonLengths=m1.exonLengths, newIntronLengths=m1.intronLengths,
+                                           seed=42, **params)
+
+
+def bench_map_to_clusters(data, datadir, **params):
+    map_to_clusters = _require('rnaseqTools', 'map_to_clusters',
+                               _MAPPING_ARGUMENTS + ['totalClusters'] + list(params))
+    ref = data['reference']
+    m1 = data['m1']
+    return lambda: map_to_clusters(ref['counts'], ref['genes'], m1.exonCounts, m1.genes, ref['clusters'],
+                                               newIntronCounts=m1.intronCounts, normalizeNew=True,
+                                               newExonLengths=m1.exonLengths, newIntronLengths=m1.intronLengths,
+                                               totalClusters=ref['clusterNames'].size, seed=42, **params)
+
+
+def bench_get_feature_dict(data, datadir):
+    get_feature_dict = _require('features', 'get_feature_dict')
+    return lambda: get_feature_dict(data['m1'], data['ttypes'])
+
+
+def bench_confusion_matrices(data, datadir, matrix_type='ff', k=10):
+    # the loop of kNN_alldata in revisit-confusion-matrices.ipynb, without the plots
+    get_feature_dict = _require('features', 'get_feature_dict')
+    kNN_confusion_matrix = _require('kNN_evaluation', 'kNN_confusion_matrix_' + matrix_type,
+                                    ['restrictLayers'] if matrix_type != 'ff' else [])
+    from sklearn.neighbors import NearestNeighbors
+    m1, ttypes = data['m1'], data['ttypes']
+    with contextlib.redirect_stdout(io.StringIO()):
+        feature_matrices, cell_filters = get_feature_dict(m1, ttypes)
+    classes = np.array(['Lamp5', 'Vip', 'Sst', 'Pvalb', 'IT', 'ET', 'CT'])
+    inputs = {}
+    for mode, X in feature_matrices.items():
+        selector = cell_filters[mode]
+        _, indices = NearestNeighbors(n_neighbors=k).fit(X[selector]).kneighbors()
+        inputs[mode] = (indices, selector)
+
+    def run():
+        cm = {}
+        for mode, (indices, selector) in inputs.items():
+            restrictLayers = not (mode=='e' or mode=='t' or mode=='te')
+            if matrix_type == 'ff':
+                cm[mode] = kNN_confusion_matrix(indices, ttypes['family'][selector], classes)
+            elif matrix_type == 'tf':
+                cm[mode] = kNN_confusion_matrix(indices, ttypes['family'][selector], classes,
+                                                selector, ttypes, m1.layers, restrictLayers=restrictLayers)
+            else:
+                labels = ttypes['m1consensus_ass'][selector].astype(int)
+                cm[mode] = kNN_confusion_matrix(indices, labels, selector, m1.layers,
+                                                restrictLayers=restrictLayers)
+        return cm
+    return run
+
+
+# name: (setup, list of parameter sets)
+BENCHMARKS = {
+    'sparseload':            (bench_sparseload, [{}]),
+    'geneSelection':         (bench_geneSelection, [{'n': 3000}]),
+    'corr2':                 (bench_corr2, [{'referenceCells': 500}, {'referenceCells': 2000}]),
+    'corr2_sparse':          (bench_corr2_sparse, [{'referenceCells': 500}, {'referenceCells': 2000}]),
+    'map_to_tsne':           (bench_map_to_tsne, [{}, {'bootstrap': True, 'nrep': 10}]),
+    'map_to_clusters':       (bench_map_to_clusters, [{}, {'bootstrap': True, 'nrep': 100}]),
+    'get_feature_dict':      (bench_get_feature_dict, [{}]),
+    'kNN_confusion_matrix':  (bench_confusion_matrices, [{'matrix_type': 'ff'}, {'matrix_type': 'tf'},
+                                                         {'matrix_type': 'tt'}]),
+}
+
+
+# Measurements
+
+def _rss():
+    # current resident set size in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class _PeakRSS:
+    # samples the resident memory in a background thread while the benchmark runs
+    def __init__(self, interval=.005):
+        self.interval = interval
+
+    def __enter__(self):
+        self.start = _rss()
+        self.peak = self.start
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+def _measure(name, params, preset, datadir, repeat, queue):
+    # runs in a fresh process, so that memory measurements do not see earlier benchmarks
+    setup, _ = BENCHMARKS[name]
+    result = {'benchmark': name, 'params': params, 'preset': preset}
+    try:
+        data = load_data(preset, datadir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run = setup(data, datadir, **params)
+
+            times, peaks = [], []
+            for r in range(repeat):
+                with _PeakRSS() as rss:
+                    t = time.perf_counter()
+                    run()
+                    times.append(time.perf_counter() - t)
+                peaks.append(rss.peak - rss.start)
+
+            # one more run with tracemalloc, which slows numpy code down too much for the timings
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            run()
+            after = tracemalloc.take_snapshot()
+            _, tracedPeak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        # snapshots only see live blocks: these are the blocks the call left allocated,
+        # temporaries freed during the call only show up in traced_peak
+        diff = after.compare_to(before, 'lineno')
+        result.update({'status': 'ok',
+                       'time': float(np.min(times)), 'time_median': float(np.median(times)), 'times': times,
+                       'peak_rss': int(np.max(peaks)),
+                       'traced_peak': int(tracedPeak),
+                       'retained_blocks': int(sum(s.count_diff for s in diff if s.count_diff > 0)),
+                       'retained': int(sum(s.size_diff for s in diff))})
+    except Skipped as e:
+        result.update({'status': 'skipped', 'error': repr(e)})
+    except Exception as e:
+        result.update({'status': 'failed', 'error': repr(e)})
+    queue.put(result)
+
+
+def _collect(p, queue, result, poll=1.):
+    # waits for the result of the benchmark process p; a process that dies without one
+    # (killed by the OOM killer, a crash in native code) is recorded as failed
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if p.is_alive():
+                continue
+            try:
+                # it may have put its result just before exiting
+                return queue.get(timeout=poll)
+            except Empty:
+                result.update({'status': 'failed',
+                               'error': 'process exited with code {} without a result'.format(p.exitcode)})
+                return result
+
+
+def key(result):
+    return '{}[{}] {}'.format(result['benchmark'], result['preset'],
+                              json.dumps(result['params'], sort_keys=True))
+
+
+def _metadata():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True,
+                             text=True).stdout.strip()
+    except OSError:
+        rev = None
+    import scipy, sklearn, pandas
+    return {'git_rev': rev, 'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'sklearn': sklearn.__version__, 'pandas': pandas.__version__}
+
+
+def run_benchmarks(preset='small', names=None, repeat=3, datadir=None):
+    """
+    Runs the benchmarks (all of them, or the ones in names) on a preset of
+    synthetic.PRESETS and returns the results as a dictionary.
+    """
+    if datadir is None:
+        datadir = os.path.join(tempfile.gettempdir(), 'clustering-neurons-benchmarks')
+    print('Generating data', end='', flush=True)
+    load_data(preset, datadir)
+    print(' done', flush=True)
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in (names or BENCHMARKS):
+        for params in BENCHMARKS[name][1]:
+            queue = context.Queue()
+            p = context.Process(target=_measure, args=(name, params, preset, datadir, repeat, queue))
+            p.start()
+            result = _collect(p, queue, {'benchmark': name, 'params': params, 'preset': preset})
+            p.join()
+            results.append(result)
+            if result['status'] == 'ok':
+                print('{:60} {:9.3f} s {:9.1f} MB {:9.1f} MB traced'.format(
+                    key(result), result['time'], result['peak_rss']/2**20, result['traced_peak']/2**20), flush=True)
+            else:
+                print('{:60} {}: {}'.format(key(result), result['status'], result['error']), flush=True)
+    return {'metadata': _metadata(), 'preset': preset, 'parameters': synthetic.PRESETS[preset],
+            'results': results}
+
+
+def compare(old, new, threshold=1.1):
+    """
+    Prints the time and memory ratios (new/old) of two result files and
+    returns the keys of the benchmarks that got slower than threshold.
+    """
+    with open(old) as f:
+        old = {key(r): r for r in json.load(f)['results'] if r['status'] == 'ok'}
+    with open(new) as f:
+        new = {key(r): r for r in json.load(f)['results'] if r['status'] == 'ok'}
+    regressions = []
+    print('{:60} {:>9} {:>9} {:>7} {:>7}'.format('', 'old (s)', 'new (s)', 'time', 'memory'))
+    for k in sorted(set(old) & set(new)):
+        timeRatio = new[k]['time'] / old[k]['time']
+        memoryRatio = max(new[k]['peak_rss'], 1) / max(old[k]['peak_rss'], 1)
+        flag = ''
+        if timeRatio > threshold:
+            regressions.append(k)
+            flag = '  <- slower'
+        print('{:60} {:9.3f} {:9.3f} {:6.2f}x {:6.2f}x{}'.format(
+            k, old[k]['time'], new[k]['time'], timeRatio, memoryRatio, flag))
+    for k in sorted(set(old) ^ set(new)):
+        print('{:60} only in {}'.format(k, 'old' if k in old else 'new'))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks on synthetic data.')
+    parser.add_argument('--preset', default='small', choices=sorted(synthetic.PRESETS))
+    parser.add_argument('--only', help='comma-separated benchmark names: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--datadir', help='where the generated data are cached')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=1.1, help='time ratio reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    results = run_benchmarks(args.preset, args.only.split(',') if args.only else None,
+                             args.repeat, args.datadir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,192 @@
+import os
+import gzip
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# same fields as the m1 object exported by patch-seq-data-load.ipynb
+houstonData = namedtuple('houstonData', 'exonCounts intronCounts cells genes layers cre yields traced \
+                                         depth thickness ephys ephysNames exclude \
+                                         mice_ages mice_cres morphometrics morphometricsNames zProfiles \
+                                         exonLengths intronLengths')
+
+# M1 families and how many of the 88 t-types belong to them
+FAMILIES = ['Lamp5', 'Sncg', 'Vip', 'Sst', 'Pvalb', 'IT', 'ET', 'CT', 'NP']
+FAMILY_TYPES = [6, 3, 12, 20, 8, 17, 10, 8, 4]
+INHIBITORY = ['Lamp5', 'Sncg', 'Vip', 'Sst', 'Pvalb']
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/')
+
+# realistic shapes: the M1 patch-seq data set and the reference atlases it is mapped to
+# (the large, 10x-sized reference is sparser and needs tens of GB of memory)
+PRESETS = {
+    'small':     dict(referenceCells=2000,    genes=5000,  patchCells=300,  clusters=88, density=.05),
+    'realistic': dict(referenceCells=15000,   genes=42466, patchCells=1329, clusters=88, density=.05),
+    'large':     dict(referenceCells=1000000, genes=42466, patchCells=1329, clusters=88, density=.02),
+}
+
+
+def type_names(clusters=88):
+    """
+    Returns t-type names ('Vip_3' etc.) and their families, with the M1 family proportions.
+    """
+    sizes = np.array(FAMILY_TYPES) * clusters / np.sum(FAMILY_TYPES)
+    sizes = np.maximum(np.round(sizes).astype(int), 1)
+    sizes[np.argmax(sizes)] += clusters - np.sum(sizes)
+    families = np.repeat(FAMILIES, sizes)
+    names = np.array([f + '_' + str(i+1) for f, n in zip(FAMILIES, sizes) for i in range(n)])
+    return names, families
+
+
+def _profiles(rng, genes, clusters, markers=.02):
+    # gene detection probabilities and mean levels of every cluster: a shared
+    # heavy-tailed background plus a few strongly expressed markers per cluster
+    background = rng.lognormal(0, 1.5, size=genes)
+    P = np.tile(background, (clusters, 1))
+    nmarkers = max(1, int(markers * genes))
+    for k in range(clusters):
+        P[k, rng.choice(genes, nmarkers, replace=False)] *= rng.lognormal(3, .5, size=nmarkers)
+    P /= P.sum(axis=1, keepdims=True)
+    levels = rng.lognormal(1, 1, size=genes)
+    return P, levels
+
+
+def _counts(rng, clusters, P, levels, density):
+    # sparse cells x genes counts: nonzero positions drawn from the cluster profiles,
+    # negative-binomial values around the gene levels
+    n = clusters.size
+    G = P.shape[1]
+    nnz = rng.poisson(density * G, size=n)
+    rows, cols = [], []
+    for k in np.unique(clusters):
+        cells = np.where(clusters == k)[0]
+        total = np.sum(nnz[cells])
+        rows.append(np.repeat(cells, nnz[cells]))
+        cols.append(rng.choice(G, total, p=P[k]))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    values = 1 + rng.negative_binomial(2, 2/(2+levels[cols]))
+    M = sparse.csr_matrix((values.astype(float), (rows, cols)), shape=(n, G))
+    M.sum_duplicates()
+    return M
+
+
+def reference(referenceCells=15000, genes=42466, clusters=88, density=.05, seed=42):
+    """
+    A synthetic reference atlas with cluster structure.
+
+    Returns a dictionary with:
+    - counts: sparse CSR exon counts (cells x genes)
+    - intronCounts: sparse CSR intron counts
+    - genes: gene names
+    - clusters: the cluster of every cell
+    - clusterNames, clusterFamilies: t-type names and families
+    - tsne: 2D positions of the cells, grouped by cluster
+    - profiles, levels: the generating parameters, for patch_seq()
+    """
+    rng = np.random.default_rng(seed)
+    P, levels = _profiles(rng, genes, clusters)
+    labels = rng.choice(clusters, referenceCells, p=rng.dirichlet(np.ones(clusters)*5))
+    counts = _counts(rng, labels, P, levels, density)
+    intronCounts = _counts(rng, labels, P, levels/2, density/2)
+    centers = rng.normal(0, 30, size=(clusters, 2))
+    tsne = centers[labels] + rng.normal(0, 2, size=(referenceCells, 2))
+    clusterNames, clusterFamilies = type_names(clusters)
+    return {'counts': counts, 'intronCounts': intronCounts,
+            'genes': np.array(['Gene' + str(g) for g in range(genes)]),
+            'clusters': labels, 'clusterNames': clusterNames, 'clusterFamilies': clusterFamilies,
+            'tsne': tsne, 'profiles': P, 'levels': levels}
+
+
+def _csv_names(filename, fallback):
+    # real feature names from the data folder, so that the feature code selects the same columns
+    path = os.path.join(DATADIR, filename)
+    if os.path.exists(path):
+        return pd.read_csv(path, nrows=0).columns.values
+    return np.array(['cell id'] + ['Feature ' + str(i) for i in range(fallback)])
+
+
+def patch_seq(ref, patchCells=1329, overlap=.9, density=.05, seed=43):
+    """
+    A synthetic patch-seq data set drawn from the clusters of ref (see reference()).
+
+    Returns (m1, ttypes) like the pickles used by the notebooks:
+    m1 is a houstonData with sparse exon/intron counts, ephys, morphometrics and z-profiles,
+    ttypes is a dictionary with 'type', 'family' and 'm1consensus_ass'.
+    A fraction 1-overlap of the genes is not in the reference, and the gene order is shuffled.
+    """
+    rng = np.random.default_rng(seed)
+    K, G = ref['profiles'].shape
+    labels = rng.choice(K, patchCells)
+    exonCounts = _counts(rng, labels, ref['profiles'], ref['levels'], density)
+    intronCounts = _counts(rng, labels, ref['profiles'], ref['levels'], density)
+
+    # permuted genes, some of them renamed so that they are missing from the reference
+    order = rng.permutation(G)
+    genes = ref['genes'][order].astype(object)
+    missing = rng.random(G) > overlap
+    genes[missing] = ['Novel' + str(g) for g in np.where(missing)[0]]
+    exonCounts = exonCounts[:, order].tocsr()
+    intronCounts = intronCounts[:, order].tocsr()
+    exonLengths = rng.integers(500, 10000, size=G).astype(float)
+    intronLengths = rng.integers(0, 100000, size=G).astype(float)
+
+    # a few low quality cells without a type, and a few excluded ones
+    lowQuality = rng.random(patchCells) < .05
+    ttypes = {'type': np.where(lowQuality, '', ref['clusterNames'][labels]).astype(object),
+              'family': np.where(lowQuality, 'low quality', ref['clusterFamilies'][labels]).astype(object),
+              'm1consensus_ass': np.where(lowQuality, np.nan, labels.astype(float))}
+    exclude = np.where(rng.random(patchCells) < .02, 'excluded', '').astype(object)
+    inh = np.isin(ttypes['family'], INHIBITORY)
+
+    # ephys: positive, type-dependent values with a few missing features
+    ephysNames = _csv_names('m1_patchseq_ephys_features.csv', 29)[1:]
+    shift = rng.normal(0, 1, size=(K, ephysNames.size))
+    ephys = np.exp(shift[labels] + rng.normal(0, .3, size=(patchCells, ephysNames.size)))
+    ephys[rng.random(ephys.shape) < .01] = np.nan
+
+    # morphometrics only for traced cells, and only the inhibitory or the excitatory features
+    morphNames = _csv_names('m1_patchseq_morph_features.csv', 63)[1:-2]
+    traced = rng.random(patchCells) < .5
+    shift = rng.normal(0, 1, size=(K, morphNames.size))
+    morphometrics = shift[labels] + rng.normal(0, .5, size=(patchCells, morphNames.size))
+    inhFeatures = np.arange(morphNames.size) < .8*morphNames.size
+    excFeatures = np.arange(morphNames.size) >= .2*morphNames.size
+    morphometrics[inh[:,None] & ~inhFeatures[None,:]] = np.nan
+    morphometrics[~inh[:,None] & ~excFeatures[None,:]] = np.nan
+    morphometrics[~traced,:] = np.nan
+    zProfiles = rng.dirichlet(np.ones(20), size=patchCells) * 100
+    zProfiles[~traced,:] = np.nan
+
+    thickness = rng.normal(1600, 150, size=patchCells)
+    depth = thickness * rng.random(patchCells)
+    mice = np.array(['mouse' + str(i) for i in rng.integers(0, 200, size=patchCells)])
+    m1 = houstonData(exonCounts=exonCounts, intronCounts=intronCounts,
+                     cells=np.array(['sample_' + str(i) for i in range(patchCells)]), genes=genes,
+                     layers=rng.choice(['1', '2/3', '5', '6'], patchCells).astype(object),
+                     cre=rng.choice(['PV+', 'SST+', 'VIP+', 'WT'], patchCells).astype(object),
+                     yields=rng.random(patchCells), traced=traced, depth=depth,
+                     ephys=ephys, ephysNames=ephysNames,
+                     exclude=exclude, thickness=thickness,
+                     mice_ages={m: int(rng.integers(30, 250)) for m in np.unique(mice)},
+                     mice_cres={m: 'WT' for m in np.unique(mice)},
+                     morphometrics=morphometrics, morphometricsNames=morphNames, zProfiles=zProfiles,
+                     exonLengths=exonLengths, intronLengths=intronLengths)
+    return m1, ttypes
+
+
+def write_counts_csv(filename, counts, genes, cells):
+    """
+    Writes a genes x cells count table like the M1 exon/intron count files
+    (gzipped if the filename ends with .gz), for benchmarking rnaseqTools.sparseload.
+    """
+    counts = sparse.csc_matrix(counts)
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wt') as f:
+        f.write(',' + ','.join(cells) + '\n')
+        T = counts.T.tocsr()
+        for g in range(T.shape[0]):
+            row = np.zeros(T.shape[1], dtype=int)
+            row[T.indices[T.indptr[g]:T.indptr[g+1]]] = T.data[T.indptr[g]:T.indptr[g+1]]
+            f.write(genes[g] + ',' + ','.join(map(str, row)) + '\n')
@@ -1,53 +1,186 @@
+import os
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, svds
 from sklearn.decomposition import PCA
 
-def get_transcriptomic_features(m1, ttypes):
+def truncated_pca(X, ncomponents=50, seed=42, return_components=False):
     """
-    Gets the transcriptomic features processed the same way as in the article's 
-    confusion matrices, and a Boolean matrix that gets cells that are valid for analysis.
+    PCA scores of the first principal components of X, computed by a truncated (Lanczos) SVD
+    of the column-centered matrix. The centering is implicit, so a sparse X stays sparse and
+    only a few vectors per component are dense.
+    The signs follow get_transcriptomic_features: a component is flipped if its loadings sum to < 0.
+    
+    Arguments:
+    - X: cells x features matrix, sparse or dense. The computation runs in the dtype of X (e.g. np.float32)
+    - ncomponents: the number of components to keep
+    - seed: the seed of the starting vector of the iteration
+    - return_components: also return the (sign-fixed) principal axes
+    
+    Returns:
+    - the scores U*s with size (cells, ncomponents), largest singular values first
+    - the principal axes with size (ncomponents, features), if return_components=True
     """
-    # like the other sets used in the confusion matrix visualization in Scala's article,
-    # the transcriptomic features must be in the state just before it was processed by t-SNE
-    # for the transcriptomic features, this means the exon and intron counts are combined,
-    # in log2 scale, and reduced from 42,466 features to 50 by PCA
+    dtype = X.dtype if X.dtype in [np.float32, np.float64] else np.float64
+    mu = np.asarray(X.mean(axis=0), dtype=dtype).ravel()
+    
+    # products with the centered matrix X - 1*mu without forming it
+    def matvec(v):
+        v = np.ravel(v)
+        return np.asarray(X @ v).ravel() - mu @ v
+    def rmatvec(u):
+        u = np.ravel(u)
+        return np.asarray(X.T @ u).ravel() - mu * np.sum(u)
+    
+    op = LinearOperator(X.shape, matvec=matvec, rmatvec=rmatvec, dtype=dtype)
+    v0 = np.random.default_rng(seed).random(min(X.shape)).astype(dtype)
+    U, s, V = svds(op, k=min(ncomponents, min(X.shape)-1), v0=v0)
+    order = np.argsort(s)[::-1]
+    U, s, V = U[:, order], s[order], V[order, :]
+    flip = np.sum(V,axis=1)<0
+    U[:, flip] *= -1
+    if return_components:
+        V[flip, :] *= -1
+        return U * s, V
+    return U * s
 
-    exons = m1.exonCounts.copy()
-    introns = m1.intronCounts.copy()
-    exons = np.array(exons.todense())
-    introns = np.array(introns.todense())
+class FeatureTransformer:
+    """
+    Base class of the fitted feature transformers. fit_transform(m1, ttypes) computes the features
+    of the cells in m1 exactly like the article, and keeps everything needed to put new cells into
+    the same feature space with transform(m1, ttypes), without refitting.
+    m1 can be any object with the fields of the houstonData namedtuple that the modality uses.
+    fit_transform_rows(m1, ttypes) returns only the features of the valid cells and their indices
+    in m1.cells, without the full-size array.
+    """
+    # the value of the full-size arrays in the rows of the cells that are not valid
+    fill = np.nan
 
-    # keep only cells that have transcriptomic types assigned to them
-    keepcells = (ttypes['type']!='') & (m1.exclude=='')
-    exons = exons[keepcells,:]
-    introns = introns[keepcells,:]
+    def fit(self, m1, ttypes):
+        self.fit_transform(m1, ttypes)
+        return self
 
-    # normalize by exon/intron lengths, combine, and put into log scale
-    # for this process I referenced rnaseqTools.map_to_tsne
-    exons = exons / (m1.exonLengths/1000)
-    introns = introns / ((m1.intronLengths+.001)/1000)
-    exon_introns = np.log2(exons + introns +1)
+    def fit_transform(self, m1, ttypes):
+        rows, cells = self.fit_transform_rows(m1, ttypes)
+        features = np.zeros((m1.cells.size, rows.shape[1])) + self.fill
+        features[cells,:] = rows
+        keepcells = np.zeros(m1.cells.size, dtype=bool)
+        keepcells[cells] = True
+        return features, keepcells
 
-    # do PCA. For this I referenced how Yao et al.'s UMI counts were processed in allen-data-preprocess-mod.ipynb
-    exon_introns = exon_introns - exon_introns.mean(axis=0)
-    U,s,V = np.linalg.svd(exon_introns, full_matrices=False)
-    U[:, np.sum(V,axis=1)<0] *= -1
-    exon_introns = np.dot(U, np.diag(s))
-    exon_introns = exon_introns[:, np.argsort(s)[::-1]][:,:50]
+    def save(self, filename):
+        """
+        Writes the fitted transformer into a pickle.
+        """
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=4)
 
-    # creating the feature dictionary and filter dictionary
-    tTsneFeatures = np.zeros((m1.cells.size, exon_introns.shape[1])) * np.nan
-    tTsneFeatures[keepcells,:] = exon_introns
-    
-    return tTsneFeatures, keepcells
+    @staticmethod
+    def load(filename):
+        """
+        Loads a transformer written by save().
+        """
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
 
-def get_ephys_features(m1, ttypes):
+class TranscriptomicFeatures(FeatureTransformer):
     """
-    Gets the electrophysiological features processed the same way as in the article's 
-    confusion matrices, and a Boolean matrix that gets cells that are valid for analysis.
+    The transcriptomic features: log2 of the length-normalized exon and intron counts, projected
+    on the first principal components. The fitted transformer keeps the genes, the gene means
+    and the sign-fixed principal axes.
     
-    The difference between the original and the output of this function is the cell selection criteria.
-    The article selects all cells that have all 17 ephys features, but this one has an additional condition:
-    cells must have all 17 ephys features AND have ttype assigned AND not be one of the cells that are excluded from analysis
+    Arguments:
+    - ncomponents: the number of principal components
+    - svd_solver: 'full' or 'truncated', see get_transcriptomic_features
+    - dtype: float or np.float32, the precision of the truncated SVD
+    - seed: the seed of the truncated SVD
+    """
+    def __init__(self, ncomponents=50, svd_solver='full', dtype=float, seed=42):
+        if svd_solver not in ['full', 'truncated']:
+            raise ValueError("svd_solver must be 'full' or 'truncated'")
+        self.ncomponents = ncomponents
+        self.svd_solver = svd_solver
+        self.dtype = dtype
+        self.seed = seed
+
+    def _log_counts(self, m1, keepcells, dense):
+        if dense:
+            exons = m1.exonCounts.copy()
+            introns = m1.intronCounts.copy()
+            exons = np.array(exons.todense()) if sparse.issparse(exons) else np.array(exons)
+            introns = np.array(introns.todense()) if sparse.issparse(introns) else np.array(introns)
+            exons = exons[keepcells,:]
+            introns = introns[keepcells,:]
+
+            # normalize by exon/intron lengths, combine, and put into log scale
+            # for this process I referenced rnaseqTools.map_to_tsne
+            exons = exons / (m1.exonLengths/1000)
+            introns = introns / ((m1.intronLengths+.001)/1000)
+            return np.log2(exons + introns +1)
+        
+        # the same normalization on the nonzero entries only (log2(0+1) = 0)
+        exons = sparse.csr_matrix(m1.exonCounts)[keepcells,:]
+        introns = sparse.csr_matrix(m1.intronCounts)[keepcells,:]
+        exons = exons @ sparse.diags(1 / (m1.exonLengths/1000))
+        introns = introns @ sparse.diags(1 / ((m1.intronLengths+.001)/1000))
+        exon_introns = (exons + introns).astype(self.dtype).tocsr()
+        exon_introns.data = np.log2(exon_introns.data + 1)
+        return exon_introns
+
+    def fit_transform_rows(self, m1, ttypes):
+        # like the other sets used in the confusion matrix visualization in Scala's article,
+        # the transcriptomic features must be in the state just before it was processed by t-SNE
+        # for the transcriptomic features, this means the exon and intron counts are combined,
+        # in log2 scale, and reduced from 42,466 features to 50 by PCA
+
+        # keep only cells that have transcriptomic types assigned to them
+        keepcells = (ttypes['type']!='') & (m1.exclude=='')
+        self.genes = np.asarray(m1.genes)
+        self.exonLengths = np.asarray(m1.exonLengths)
+        self.intronLengths = np.asarray(m1.intronLengths)
+        exon_introns = self._log_counts(m1, keepcells, dense=self.svd_solver=='full')
+        self.mean = np.asarray(exon_introns.mean(axis=0)).ravel()
+
+        if self.svd_solver == 'truncated':
+            exon_introns, self.components = truncated_pca(exon_introns, self.ncomponents, self.seed, 
+                                                          return_components=True)
+        else:
+            # do PCA. For this I referenced how Yao et al.'s UMI counts were processed in allen-data-preprocess-mod.ipynb
+            exon_introns = exon_introns - exon_introns.mean(axis=0)
+            U,s,V = np.linalg.svd(exon_introns, full_matrices=False)
+            flip = np.sum(V,axis=1)<0
+            U[:, flip] *= -1
+            V[flip, :] *= -1
+            exon_introns = np.dot(U, np.diag(s))
+            order = np.argsort(s)[::-1][:self.ncomponents]
+            exon_introns = exon_introns[:, order]
+            self.components = V[order, :]
+        return exon_introns, np.where(keepcells)[0]
+
+    def transform(self, m1, ttypes=None):
+        """
+        Returns the features of the cells in m1 (with the same genes as the fitted data)
+        and the Boolean array of the cells that have a ttype (if ttypes is given) and are not excluded.
+        """
+        if not np.array_equal(np.asarray(m1.genes), self.genes):
+            raise ValueError('the new cells must have the same genes as the fitted data')
+        keepcells = np.asarray(m1.exclude)=='' 
+        if ttypes is not None:
+            keepcells &= ttypes['type']!=''
+        X = self._log_counts(m1, keepcells, dense=False)
+        features = np.asarray(X @ self.components.T) - self.mean @ self.components.T
+        tTsneFeatures = np.zeros((m1.cells.size, features.shape[1])) * np.nan
+        tTsneFeatures[keepcells,:] = features
+        return tTsneFeatures, keepcells
+
+class EphysFeatures(FeatureTransformer):
+    """
+    The electrophysiological features: some features in log scale, the redundant ones removed,
+    standardized and rotated by PCA (all components), scaled by the standard deviation of the first.
+    The fitted transformer keeps the feature names, means, standard deviations, PCA and scaling.
     """
     features_exclude = ['Afterdepolarization (mV)', 'AP Fano factor', 'ISI Fano factor', 
                         'Latency @ +20pA current (ms)', 'Wildness', 'Spike frequency adaptation',
@@ -57,85 +190,194 @@ def get_ephys_features(m1, ttypes):
     features_log =     ['AP coefficient of variation', 'ISI coefficient of variation', 
                         'ISI adaptation index', 'Latency (ms)'] # features that need to be in natural log scale
 
-    # 1. put features that need to be in log scale in log scale
-    # 2. omit features that need to be omitted
-    # 3. keep only the cells that have all of the remaining features
-    # 4. standardize the values
-    X = m1.ephys.copy()
-    for e in features_log:
-        X[:, m1.ephysNames==e] = np.log(X[:, m1.ephysNames==e])
-    X = X[:, ~np.isin(m1.ephysNames, features_exclude)]
+    def _values(self, m1):
+        # 1. put features that need to be in log scale in log scale
+        # 2. omit features that need to be omitted
+        X = m1.ephys.copy()
+        for e in self.features_log:
+            X[:, m1.ephysNames==e] = np.log(X[:, m1.ephysNames==e])
+        return X[:, ~np.isin(m1.ephysNames, self.features_exclude)]
+
+    def fit_transform_rows(self, m1, ttypes):
+        # 3. keep only the cells that have all of the remaining features
+        # 4. standardize the values
+        self.ephysNames = np.asarray(m1.ephysNames)
+        X = self._values(m1)
 
-    # adding additional conditions to original: cell must have a ttype and must not be excluded from analysis
-    keepcells = ~np.isnan(np.sum(X, axis=1)) & (ttypes['type']!='') & (m1.exclude=='') 
-    X = X[keepcells, :]
+        # adding additional conditions to original: cell must have a ttype and must not be excluded from analysis
+        keepcells = ~np.isnan(np.sum(X, axis=1)) & (ttypes['type']!='') & (m1.exclude=='') 
+        X = X[keepcells, :]
 
-    X = X - X.mean(axis=0)
-    X = X / X.std(axis=0)
+        self.mean = X.mean(axis=0)
+        X = X - self.mean
+        self.std = X.std(axis=0)
+        X = X / self.std
 
-    ephysTsneData = np.zeros((m1.cells.size, X.shape[1])) * np.nan
-    ephysTsneData[keepcells,:] = PCA().fit_transform(X) # doing PCA but keeping all dimensions and projecting into new space
-    ephysTsneData[keepcells,:] /= np.std(ephysTsneData[keepcells,0]) # the article somehoe only scales with first component's std
+        self.pca = PCA()
+        ephysTsneData = self.pca.fit_transform(X) # doing PCA but keeping all dimensions and projecting into new space
+        self.scale = np.std(ephysTsneData[:,0])
+        ephysTsneData /= self.scale # the article somehoe only scales with first component's std
 
-    return ephysTsneData, keepcells
+        return ephysTsneData, np.where(keepcells)[0]
+
+    def transform(self, m1, ttypes=None):
+        """
+        Returns the features of the cells in m1 and the Boolean array of the cells that have
+        all features, a ttype (if ttypes is given) and are not excluded.
+        """
+        if not np.array_equal(np.asarray(m1.ephysNames), self.ephysNames):
+            raise ValueError('the new cells must have the same ephys features as the fitted data')
+        X = self._values(m1)
+        keepcells = ~np.isnan(np.sum(X, axis=1)) & (np.asarray(m1.exclude)=='')
+        if ttypes is not None:
+            keepcells &= ttypes['type']!=''
+        ephysTsneData = np.zeros((m1.cells.size, X.shape[1])) * np.nan
+        if np.any(keepcells):
+            ephysTsneData[keepcells,:] = self.pca.transform((X[keepcells,:] - self.mean) / self.std) / self.scale
+        return ephysTsneData, keepcells
+
+class MorphFeatures(FeatureTransformer):
+    """
+    The morphometric features: separately for inhibitory and excitatory neurons, the standardized
+    morphometrics reduced to 20 principal components and the z-profiles to principal components 2-5,
+    scaled by the standard deviation of their first component.
+    The fitted transformer keeps the feature masks, means, standard deviations, PCAs and scalings.
+    """
+    inhFamilies = ['Pvalb', 'Sst', 'Vip', 'Lamp5', 'Sncg']
+    excFamilies = ['CT', 'IT', 'NP', 'ET']
+    fill = 0
+
+    def _cells(self, m1, ttypes):
+        # getting Boolean array to select cells that can be used for morphometric analysis
+        keepcells = (np.sum(~np.isnan(m1.morphometrics), axis=1) > 0) # must have all morphometric features
+        keepcells[np.isin(m1.cells, ['20180820_sample_1', '20180921_sample_3'])] = False # must not be one of the cells unsuitable for analysis
+
+        inhCells = np.isin(ttypes['family'], self.inhFamilies)
+        excCells = np.isin(ttypes['family'], self.excFamilies)
+        keepcells &= (inhCells | excCells) # need to be either excitatory or inhibitory neurons
+
+        keepcells &= (ttypes['type']!='') & (m1.exclude == '') # must have ttype assigned and must not be one of the cells that don't have valid features
+        return keepcells, inhCells, excCells
+
+    def _assemble(self, m1, keepcells, inhCells, excCells, inhPC, excPC, inhZPC, excZPC, rows=False):
+        # the full-size array, or with rows=True only the rows of the valid cells
+        cells = keepcells if rows else np.ones(m1.cells.size, dtype=bool)
+        morphTsneData = np.zeros((np.sum(cells), self.ncomponents*2 + self.zcomponents*2)) + 0
+        inh = (inhCells & keepcells)[cells]
+        exc = (excCells & keepcells)[cells]
+        n, z = self.ncomponents, self.zcomponents
+        morphTsneData[inh,  0:n] = inhPC 
+        morphTsneData[exc, n:n*2] = excPC
+        morphTsneData[inh, n*2:n*2+z] = inhZPC
+        morphTsneData[exc, n*2+z:n*2+z*2] = excZPC
+        return morphTsneData
+
+    def fit_transform_rows(self, m1, ttypes):
+        keepcells, inhCells, excCells = self._cells(m1, ttypes)
+        
+        # Boolean array to get features for inhibitory/excitatory neurons
+        self.inhFeatures = np.sum(~np.isnan(m1.morphometrics[inhCells & keepcells,:]),axis=0)>0
+        self.excFeatures = np.sum(~np.isnan(m1.morphometrics[excCells & keepcells,:]),axis=0)>0
+
+        inhChunk = m1.morphometrics[inhCells & keepcells,:][:, self.inhFeatures] # numpy array with all inhibitory cells and features
+        excChunk = m1.morphometrics[excCells & keepcells,:][:, self.excFeatures] # numpy array with all excitatory cells and features
+
+        # standardize all features
+        self.inhMean = inhChunk.mean(axis=0)
+        inhChunk = inhChunk - self.inhMean
+        self.inhStd = inhChunk.std(axis=0)
+        inhChunk = inhChunk / self.inhStd
+        self.excMean = excChunk.mean(axis=0)
+        excChunk = excChunk - self.excMean
+        self.excStd = excChunk.std(axis=0)
+        excChunk = excChunk / self.excStd
+
+        # do PCA on the inhibitory/excitatory features, keep 20 dimensions
+        # and standardize by the first principal component's standard deviation
+        self.inhPCA = PCA(n_components=20)
+        inhPC = self.inhPCA.fit_transform(inhChunk)
+        self.inhScale = np.std(inhPC[:,0])
+        inhPC /= self.inhScale
+        self.excPCA = PCA(n_components=20)
+        excPC = self.excPCA.fit_transform(excChunk)
+        self.excScale = np.std(excPC[:,0])
+        excPC /= self.excScale
+        excPC += .25 #to prevent overlap between populations
+
+        # do the same for the z-profiles
+        inhZprof = m1.zProfiles[inhCells & keepcells,:]
+        excZprof = m1.zProfiles[excCells & keepcells,:]
+
+        self.inhZPCA = PCA(n_components=5)
+        inhZPC = self.inhZPCA.fit_transform(inhZprof)[:,1:]
+        self.inhZScale = np.std(inhZPC[:,0])
+        inhZPC /= self.inhZScale
+        self.excZPCA = PCA(n_components=5)
+        excZPC = self.excZPCA.fit_transform(excZprof)[:,1:]
+        self.excZScale = np.std(excZPC[:,0])
+        excZPC /= self.excZScale
+        excZPC += .25
+
+        self.ncomponents, self.zcomponents = inhPC.shape[1], inhZPC.shape[1]
+        return (self._assemble(m1, keepcells, inhCells, excCells, inhPC, excPC, inhZPC, excZPC, rows=True),
+                np.where(keepcells)[0])
+
+    def transform(self, m1, ttypes):
+        """
+        Returns the features of the cells in m1 and the Boolean array of the cells that are valid
+        for the morphometric analysis. The ttypes are needed to tell inhibitory from excitatory cells.
+        """
+        keepcells, inhCells, excCells = self._cells(m1, ttypes)
+        inh = inhCells & keepcells
+        exc = excCells & keepcells
+        def project(pca, X):
+            # PCA.transform does not accept an empty batch
+            return pca.transform(X) if X.shape[0] > 0 else np.zeros((0, pca.n_components_))
+        inhPC = project(self.inhPCA, (m1.morphometrics[inh,:][:, self.inhFeatures] - self.inhMean) / self.inhStd) / self.inhScale
+        excPC = project(self.excPCA, (m1.morphometrics[exc,:][:, self.excFeatures] - self.excMean) / self.excStd) / self.excScale + .25
+        inhZPC = project(self.inhZPCA, m1.zProfiles[inh,:])[:,1:] / self.inhZScale
+        excZPC = project(self.excZPCA, m1.zProfiles[exc,:])[:,1:] / self.excZScale + .25
+        return self._assemble(m1, keepcells, inhCells, excCells, inhPC, excPC, inhZPC, excZPC), keepcells
+
+def get_transcriptomic_features(m1, ttypes, svd_solver='full', dtype=float, seed=42):
+    """
+    Gets the transcriptomic features processed the same way as in the article's 
+    confusion matrices, and a Boolean matrix that gets cells that are valid for analysis.
+    Use TranscriptomicFeatures to keep the fitted transformation for new cells.
+    
+    Arguments:
+    - m1, ttypes: the patch-seq data and the transcriptomic type assignments
+    - svd_solver: 'full' - the complete SVD of the dense log counts, as in the article
+                  'truncated' - only the 50 components, by truncated_pca on the sparse counts.
+                  Equal to the full SVD up to numerical precision, in a fraction of the time and memory
+    - dtype: float or np.float32, the precision of the truncated SVD
+    - seed: the seed of the truncated SVD
+    """
+    return TranscriptomicFeatures(50, svd_solver, dtype, seed).fit_transform(m1, ttypes)
+
+def get_ephys_features(m1, ttypes):
+    """
+    Gets the electrophysiological features processed the same way as in the article's 
+    confusion matrices, and a Boolean matrix that gets cells that are valid for analysis.
+    Use EphysFeatures to keep the fitted transformation for new cells.
+    
+    The difference between the original and the output of this function is the cell selection criteria.
+    The article selects all cells that have all 17 ephys features, but this one has an additional condition:
+    cells must have all 17 ephys features AND have ttype assigned AND not be one of the cells that are excluded from analysis
+    """
+    return EphysFeatures().fit_transform(m1, ttypes)
 
 def get_morph_features(m1, ttypes):
     """
     Gets the morphometric features processed the same way as in the article's 
     confusion matrices, and a Boolean matrix that gets cells that are valid for analysis.
+    Use MorphFeatures to keep the fitted transformation for new cells.
     
     The difference between the original and the output of this function is the cell selection criteria 
     - though it did not make a difference.
     The article does not exclude the cells that did not have transcriptomic types assigned, but this one does.
     """
-    # getting Boolean array to select cells that can be used for morphometric analysis
-    keepcells = (np.sum(~np.isnan(m1.morphometrics), axis=1) > 0) # must have all morphometric features
-    keepcells[np.isin(m1.cells, ['20180820_sample_1', '20180921_sample_3'])] = False # must not be one of the cells unsuitable for analysis
-
-    inhCells = np.isin(ttypes['family'], ['Pvalb', 'Sst', 'Vip', 'Lamp5', 'Sncg'])
-    excCells = np.isin(ttypes['family'], ['CT', 'IT', 'NP', 'ET'])
-    keepcells &= (inhCells | excCells) # need to be either excitatory or inhibitory neurons
-
-    keepcells &= (ttypes['type']!='') & (m1.exclude == '') # must have ttype assigned and must not be one of the cells that don't have valid features
-
-    # Boolean array to get features for inhibitory/excitatory neurons
-    inhFeatures = np.sum(~np.isnan(m1.morphometrics[inhCells & keepcells,:]),axis=0)>0
-    excFeatures = np.sum(~np.isnan(m1.morphometrics[excCells & keepcells,:]),axis=0)>0
-
-    inhChunk = m1.morphometrics[inhCells & keepcells,:][:, inhFeatures] # numpy array with all inhibitory cells and features
-    excChunk = m1.morphometrics[excCells & keepcells,:][:, excFeatures] # numpy array with all excitatory cells and features
-
-    # standardize all features
-    inhChunk = inhChunk - inhChunk.mean(axis=0)
-    inhChunk = inhChunk / inhChunk.std(axis=0)
-    excChunk = excChunk - excChunk.mean(axis=0)
-    excChunk = excChunk / excChunk.std(axis=0)
-
-    # do PCA on the inhibitory/excitatory features, keep 20 dimensions
-    # and standardize by the first principal component's standard deviation
-    inhPC = PCA(n_components=20).fit_transform(inhChunk)
-    inhPC /= np.std(inhPC[:,0])
-    excPC = PCA(n_components=20).fit_transform(excChunk)
-    excPC /= np.std(excPC[:,0])
-    excPC += .25 #to prevent overlap between populations
-
-    # do the same for the z-profiles
-    inhZprof = m1.zProfiles[inhCells & keepcells,:]
-    excZprof = m1.zProfiles[excCells & keepcells,:]
-
-    inhZPC = PCA(n_components=5).fit_transform(inhZprof)[:,1:]
-    inhZPC /= np.std(inhZPC[:,0])
-    excZPC = PCA(n_components=5).fit_transform(excZprof)[:,1:]
-    excZPC /= np.std(excZPC[:,0])
-    excZPC += .25
-
-    morphTsneData = np.zeros((m1.cells.size, inhPC.shape[1]*2 + inhZPC.shape[1]*2)) + 0
-    morphTsneData[inhCells & keepcells,  0:inhPC.shape[1]] = inhPC 
-    morphTsneData[excCells & keepcells, inhPC.shape[1]:inhPC.shape[1]*2] = excPC
-    morphTsneData[inhCells & keepcells, inhPC.shape[1]*2:inhPC.shape[1]*2+inhZPC.shape[1]] = inhZPC
-    morphTsneData[excCells & keepcells, inhPC.shape[1]*2+inhZPC.shape[1]:inhPC.shape[1]*2+inhZPC.shape[1]*2] = excZPC
-    
-    return morphTsneData, keepcells
+    return MorphFeatures().fit_transform(m1, ttypes)
  
 def combine2features(featureset1, featureset2, keepcells1, keepcells2):
     """
@@ -153,36 +395,285 @@ def combine3features(featureset1, featureset2, featureset3, keepcells1, keepcell
     keepcells = keepcells1 & keepcells2 & keepcells3 & ~np.isnan(np.sum(combinedFeatures,axis=1))
     return combinedFeatures, keepcells
 
-def get_feature_dict(m1, ttypes):
+class ColumnStack:
+    """
+    A lazy column-wise concatenation of feature matrices that have the same rows (cells).
+    Indexing rows, e.g. X[keepcells], concatenates only the selected rows, and np.asarray(X)
+    gives the full concatenated matrix, so it can be used like the arrays of combine2features.
+    """
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.shape = (self.parts[0].shape[0], sum(p.shape[1] for p in self.parts))
+        self.ndim = 2
+        self.dtype = np.result_type(*self.parts)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            rows, cols = index
+            return self[rows][..., cols]
+        rows = [p[index] for p in self.parts]
+        return np.concatenate(rows, axis=rows[0].ndim-1)
+
+    def __array__(self, dtype=None, copy=None):
+        X = np.concatenate(self.parts, axis=1)
+        return X if dtype is None else X.astype(dtype)
+
+    def __reduce__(self):
+        # pickled as the concatenated array (e.g. processed_features.pickle of
+        # revisit-confusion-matrices.ipynb), so loading it does not need this module
+        return (np.concatenate, (self.parts, 1))
+
+    def __repr__(self):
+        return 'ColumnStack({} x {}, {} parts)'.format(self.shape[0], self.shape[1], len(self.parts))
+
+# the feature sets: base modalities computed from m1 and ttypes, and their combinations
+BASE_FEATURES = {'t': get_transcriptomic_features, 
+                 'e': get_ephys_features, 
+                 'm': get_morph_features}
+# the transformers of the base modalities, for the valid rows only (see get_feature_store)
+BASE_TRANSFORMERS = {'t': TranscriptomicFeatures,
+                     'e': EphysFeatures,
+                     'm': MorphFeatures}
+COMBINED_FEATURES = {'te': ['t', 'e'], 
+                     'tm': ['t', 'm'], 
+                     'em': ['e', 'm'], 
+                     'tem': ['t', 'e', 'm']}
+
+# the fields of m1 and ttypes that each base modality reads; a cached feature set is only
+# recomputed if one of them (or its options) changes
+FEATURE_INPUTS = {'t': (['cells', 'exclude', 'exonCounts', 'intronCounts', 'exonLengths', 'intronLengths'], ['type']),
+                  'e': (['cells', 'exclude', 'ephys', 'ephysNames'], ['type']),
+                  'm': (['cells', 'exclude', 'morphometrics', 'zProfiles'], ['type', 'family'])}
+
+def feature_hash(*items):
+    """
+    Returns a hex digest of arrays (dense or sparse), lists and other values with a stable repr,
+    used as the cache key of the feature sets.
+    """
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, dict):
+            h.update(repr(sorted(item.items())).encode())
+        elif sparse.issparse(item):
+            item = item.tocsr()
+            h.update(repr(item.shape).encode())
+            for a in [item.data, item.indices, item.indptr]:
+                h.update(np.ascontiguousarray(a).tobytes())
+        elif isinstance(item, (np.ndarray, list, tuple)) or hasattr(item, '__array__'):
+            # also pandas columns like m1.morphometricsNames
+            item = np.asarray(item)
+            if item.dtype == object:
+                h.update('\n'.join(map(str, item.ravel())).encode())
+            else:
+                h.update(item.dtype.str.encode() + repr(item.shape).encode())
+                h.update(np.ascontiguousarray(item).tobytes())
+        else:
+            h.update(repr(item).encode())
+    return h.hexdigest()
+
+def _base_features(name, m1, ttypes, options):
+    # module level, so that it can run in a worker process
+    return BASE_FEATURES[name](m1, ttypes, **options)
+
+def _base_rows(name, m1, ttypes, options):
+    # the features of the valid cells and their indices, without the full-size array
+    return BASE_TRANSFORMERS[name](**options).fit_transform_rows(m1, ttypes)
+
+def _cache_load(cachedir, name, key):
+    if cachedir is None:
+        return None
+    path = os.path.join(cachedir, '{}-{}.npz'.format(name, key[:16]))
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+def _cache_save(cachedir, name, key, arrays):
+    if cachedir is None:
+        return
+    os.makedirs(cachedir, exist_ok=True)
+    path = os.path.join(cachedir, '{}-{}.npz'.format(name, key[:16]))
+    tmp = path + '.tmp{}.npz'.format(os.getpid())
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+def _base_feature_sets(m1, ttypes, svd_solver, dtype, options, cachedir, n_jobs, rows=False):
+    # the base sets (from the cache or computed in n_jobs processes) and the cache keys of all sets;
+    # with rows=True the valid rows and the cell indices of every set instead of full-size arrays
+    compute = _base_rows if rows else _base_features
+    fields = ('rows', 'cells') if rows else ('features', 'keepcells')
+    suffix = '-rows' if rows else ''
+    options = {name: dict((options or {}).get(name, {})) for name in BASE_FEATURES}
+    options['t'].setdefault('svd_solver', svd_solver)
+    options['t'].setdefault('dtype', dtype)
+    
+    keys = {}
+    for name in BASE_FEATURES:
+        inputs, labels = FEATURE_INPUTS[name]
+        keys[name] = feature_hash(name, *[getattr(m1, f) for f in inputs], *[ttypes[l] for l in labels],
+                                  {k: str(v) for k, v in options[name].items()})
+    for name, parents in COMBINED_FEATURES.items():
+        keys[name] = feature_hash(name, *[keys[p] for p in parents])
+    
     feature_matrices = {}
     cell_filters = {}
+    missing = []
+    for name in BASE_FEATURES:
+        cached = _cache_load(cachedir, name + suffix, keys[name])
+        if cached is None:
+            missing.append(name)
+        else:
+            feature_matrices[name], cell_filters[name] = cached[fields[0]], cached[fields[1]]
     
-    feature_matrix, cell_filter = get_transcriptomic_features(m1, ttypes)
-    feature_matrices["t"] = feature_matrix
-    cell_filters["t"] = cell_filter
-    
-    feature_matrix, cell_filter = get_ephys_features(m1, ttypes)
-    feature_matrices["e"] = feature_matrix
-    cell_filters["e"] = cell_filter
+    if n_jobs > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(missing))) as executor:
+            futures = {name: executor.submit(compute, name, m1, ttypes, options[name]) for name in missing}
+            results = {name: future.result() for name, future in futures.items()}
+    else:
+        results = {name: compute(name, m1, ttypes, options[name]) for name in missing}
+    for name in missing:
+        feature_matrices[name], cell_filters[name] = results[name]
+        _cache_save(cachedir, name + suffix, keys[name], dict(zip(fields, results[name])))
+    return feature_matrices, cell_filters, keys
+
+def get_feature_dict(m1, ttypes, svd_solver='full', dtype=float, options=None, cachedir=None, n_jobs=1):
+    """
+    Computes all feature sets and the Boolean arrays of the cells that are valid for them.
     
-    feature_matrix, cell_filter = get_morph_features(m1, ttypes)
-    feature_matrices["m"] = feature_matrix
-    cell_filters["m"] = cell_filter
+    The base sets t, e and m are computed independently (in n_jobs processes), and the combined
+    sets te, tm, em and tem are ColumnStack views of them instead of copies.
+    With a cachedir, every feature set is stored on disk under a hash of the data it depends on
+    (FEATURE_INPUTS) and its options, so e.g. new morphometric data only recompute m, tm, em and tem.
     
-    feature_matrix, cell_filter = combine2features(feature_matrices["t"], feature_matrices["e"],cell_filters["t"], cell_filters["e"])
-    feature_matrices["te"] = feature_matrix
-    cell_filters["te"] = cell_filter
+    Arguments:
+    - m1, ttypes: the patch-seq data and the transcriptomic type assignments
+    - svd_solver, dtype: the options of get_transcriptomic_features
+    - options: a dictionary of keyword arguments for each base set, e.g. {'t': {'svd_solver': 'truncated'}}
+    - cachedir: the directory for cached feature sets (None - no caching)
+    - n_jobs: the number of processes for the base sets
     
-    feature_matrix, cell_filter = combine2features(feature_matrices["t"], feature_matrices["m"],cell_filters["t"], cell_filters["m"])
-    feature_matrices["tm"] = feature_matrix
-    cell_filters["tm"] = cell_filter
+    Returns:
+    - feature_matrices: a dictionary with the feature matrices, keys t, e, m, te, tm, em, tem
+    - cell_filters: a dictionary with the Boolean arrays of the valid cells
+    """
+    feature_matrices, cell_filters, keys = _base_feature_sets(m1, ttypes, svd_solver, dtype, options, cachedir, n_jobs)
     
-    feature_matrix, cell_filter = combine2features(feature_matrices["e"], feature_matrices["m"],cell_filters["e"], cell_filters["m"])
-    feature_matrices["em"] = feature_matrix
-    cell_filters["em"] = cell_filter
+    # same cells as combine2features / combine3features: valid in every set and without nans
+    for name, parents in COMBINED_FEATURES.items():
+        feature_matrices[name] = ColumnStack([feature_matrices[p] for p in parents])
+        cached = _cache_load(cachedir, name, keys[name])
+        if cached is None:
+            keepcells = np.ones(m1.cells.size, dtype=bool)
+            for p in parents:
+                keepcells &= cell_filters[p] & ~np.isnan(np.sum(feature_matrices[p], axis=1))
+            _cache_save(cachedir, name, keys[name], {'keepcells': keepcells})
+        else:
+            keepcells = cached['keepcells']
+        cell_filters[name] = keepcells
     
-    feature_matrix, cell_filter = combine3features(feature_matrices["t"], feature_matrices["e"], feature_matrices["m"], cell_filters["t"], cell_filters["e"], cell_filters["m"])
-    feature_matrices["tem"] = feature_matrix
-    cell_filters["tem"] = cell_filter
+    feature_matrices = {name: feature_matrices[name] for name in list(BASE_FEATURES) + list(COMBINED_FEATURES)}
+    cell_filters = {name: cell_filters[name] for name in feature_matrices}
+    return feature_matrices, cell_filters
+
+
+class FeatureStore:
+    """
+    Compact storage of feature sets: for every set only the rows of its valid cells, as a
+    contiguous (float32) matrix, and the indices of these cells in m1.cells. Combined sets are
+    built from the intersection of the cell indices of their parts, without any full-size arrays.
+    features(name) returns the stored matrix itself, e.g. for NearestNeighbors.
     
-    return feature_matrices, cell_filters
\ No newline at end of file
+    Arguments:
+    - ncells: the number of cells in m1
+    - dtype: the dtype of the stored features
+    """
+    def __init__(self, ncells, dtype=np.float32):
+        self.ncells = ncells
+        self.dtype = dtype
+        self._features = {}
+        self._cells = {}
+
+    def add(self, name, features, keepcells):
+        """
+        Adds a feature set from a full-size matrix and its Boolean array of valid cells,
+        like the outputs of the get_*_features functions. Only the valid rows are kept.
+        """
+        cells = np.where(keepcells)[0]
+        return self.add_rows(name, np.asarray(features)[cells], cells)
+
+    def add_rows(self, name, rows, cells):
+        """
+        Adds a feature set from the rows of the valid cells and their (increasing) indices.
+        """
+        self._features[name] = np.ascontiguousarray(rows, dtype=self.dtype)
+        self._cells[name] = np.asarray(cells, dtype=np.int64)
+        return self
+
+    def combine(self, name, parts):
+        """
+        Adds the column-wise combination of the sets in parts, for the cells that are valid
+        in all of them (like combine2features and combine3features).
+        """
+        cells = self._cells[parts[0]]
+        for p in parts[1:]:
+            cells = np.intersect1d(cells, self._cells[p], assume_unique=True)
+        blocks = [self._features[p][np.searchsorted(self._cells[p], cells)] for p in parts]
+        rows = np.hstack(blocks)
+        valid = ~np.isnan(np.sum(rows, axis=1))
+        return self.add_rows(name, rows[valid], cells[valid])
+
+    def names(self):
+        return list(self._features)
+
+    def __contains__(self, name):
+        return name in self._features
+
+    def features(self, name):
+        """
+        The features of the valid cells of a set (no copy).
+        """
+        return self._features[name]
+
+    def cells(self, name):
+        """
+        The indices of the valid cells of a set in m1.cells.
+        """
+        return self._cells[name]
+
+    def mask(self, name):
+        """
+        The Boolean array of the valid cells of a set, like the cell filters of get_feature_dict.
+        """
+        keepcells = np.zeros(self.ncells, dtype=bool)
+        keepcells[self._cells[name]] = True
+        return keepcells
+
+    def dense(self, name):
+        """
+        The full-size matrix of a set with nan rows for the cells that are not valid.
+        """
+        X = np.zeros((self.ncells, self._features[name].shape[1]), dtype=self.dtype) * np.nan
+        X[self._cells[name]] = self._features[name]
+        return X
+
+    def nbytes(self):
+        return sum(X.nbytes + self._cells[name].nbytes for name, X in self._features.items())
+
+def get_feature_store(m1, ttypes, svd_solver='full', dtype=float, options=None, cachedir=None, n_jobs=1,
+                      storetype=np.float32):
+    """
+    Computes all feature sets like get_feature_dict, but returns them as a compact FeatureStore:
+    only the valid rows of every set, in storetype, with the combined sets te, tm, em and tem
+    built from intersections of the cell indices. The base sets come from fit_transform_rows of
+    their transformers (and are cached as such), so no full-size array is allocated.
+    """
+    feature_rows, cells, _ = _base_feature_sets(m1, ttypes, svd_solver, dtype, options, cachedir, n_jobs, rows=True)
+    store = FeatureStore(m1.cells.size, storetype)
+    for name in BASE_FEATURES:
+        store.add_rows(name, feature_rows.pop(name), cells[name])
+    for name, parents in COMBINED_FEATURES.items():
+        store.combine(name, parents)
+    return store
@@ -1,4 +1,8 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+import pandas as pd
 import pylab as plt
 import seaborn as sns; sns.set()
 import matplotlib
@@ -23,6 +27,141 @@ def sns_styleset():
 
 sns_styleset()
 
+class TypeGroups:
+    """
+    Cells grouped by transcriptomic type and layer, built once and shared by all per-type
+    computations of the confusion matrices (and per-type cell counts). The grouped cells are sorted
+    by type, then by layer, then by their position, and CSR-style offsets point to the
+    cells of every type and of every type and layer, so that getting the cells of one
+    group costs as much as the group is large and no mask over all cells is built.
+    
+    Per-type counts of the included cells and of the traced ones:
+        groups = TypeGroups(ttypes['m1consensus_ass'], m1.layers, mask=(m1.exclude==''))
+        totalcounts = groups.counts()
+        reconcounts = groups.counts(m1.traced)
+    
+    Arguments:
+    - types: the transcriptomic type of every cell, e.g. ttypes['m1consensus_ass'];
+             cells with nan, negative or too large types are not in any group
+    - layers: the layer of every cell, e.g. m1.layers (optional)
+    - ntypes: how many transcriptomic types there are in total
+    - mask: a Boolean array of the cells to group (optional)
+    
+    Attributes:
+    - types: the type of every cell, -1 for cells that are not in any group
+    - order: the indices of the grouped cells, sorted by type and layer
+    - indptr: the cells of type t are order[indptr[t]:indptr[t+1]]
+    - sizes: the number of cells of every type
+    - layerNames: the layers in sorted order, layerCodes: the index into layerNames of every cell
+    - layerCounts: the number of cells of every type in every layer (ntypes x layers)
+    - mostCommonLayer: the index of the most common layer of every type (the first one in sorted order on ties)
+    """
+    def __init__(self, types, layers=None, ntypes=88, mask=None):
+        types = np.asarray(types)
+        if types.dtype.kind == 'f':
+            valid = np.isfinite(types)
+            types = np.where(valid, types, -1).astype(int)
+        else:
+            types = types.astype(int)
+        valid = (types >= 0) & (types < ntypes)
+        if mask is not None:
+            valid &= np.asarray(mask, dtype=bool)
+        self.types = np.where(valid, types, -1)
+        self.ntypes = ntypes
+        
+        if layers is not None:
+            self.layerNames, self.layerCodes = np.unique(np.asarray(layers), return_inverse=True)
+            self.layerCodes = self.layerCodes.ravel()
+        else:
+            self.layerNames, self.layerCodes = np.array(['']), np.zeros(types.size, dtype=int)
+        nlayers = self.layerNames.size
+        
+        cells = np.where(valid)[0]
+        self.order = cells[np.lexsort((self.layerCodes[cells], self.types[cells]))]
+        self.layerCounts = np.bincount(self.types[cells]*nlayers + self.layerCodes[cells],
+                                       minlength=ntypes*nlayers).reshape(ntypes, nlayers)
+        self.sizes = np.sum(self.layerCounts, axis=1)
+        self.indptr = np.concatenate(([0], np.cumsum(self.sizes)))
+        self._layerptr = np.concatenate(([0], np.cumsum(self.layerCounts.ravel())))
+        self.mostCommonLayer = np.argmax(self.layerCounts, axis=1) if layers is not None else None
+
+    def cells(self, t, layer=None):
+        """
+        Returns the indices of the cells of type t, or only of those in layer (an index into layerNames).
+        """
+        if layer is None:
+            return self.order[self.indptr[t]:self.indptr[t+1]]
+        g = t * self.layerNames.size + layer
+        return self.order[self._layerptr[g]:self._layerptr[g+1]]
+
+    def counts(self, select=None):
+        """
+        Returns the number of grouped cells of every type, or of those where the Boolean array select is True.
+        """
+        grouped = self.types >= 0
+        if select is not None:
+            grouped &= np.asarray(select, dtype=bool)
+        return np.bincount(self.types[grouped], minlength=self.ntypes)
+
+    def restrict(self, cutoff=10, restrictLayers=False):
+        """
+        The groups that the per-type statistics are computed on.
+        With restrictLayers, types with at least cutoff cells keep only the cells from their
+        most common layer, and the cutoff is checked again.
+        
+        Returns:
+        - groups: the type every cell counts for (-1 - none)
+        - aboveCutoff: Boolean array, the types that have at least cutoff cells
+        """
+        sizes = self.sizes.copy()
+        layer = [None] * self.ntypes
+        if restrictLayers:
+            if self.mostCommonLayer is None:
+                raise ValueError('restrictLayers needs the layers of the cells')
+            for t in np.where(sizes >= cutoff)[0]:
+                layer[t] = self.mostCommonLayer[t]
+                sizes[t] = self.layerCounts[t, layer[t]]
+        aboveCutoff = sizes >= cutoff
+        groups = np.zeros(self.types.size, dtype=int) - 1
+        for t in np.where(aboveCutoff)[0]:
+            groups[self.cells(t, layer[t])] = t
+        return groups, aboveCutoff
+
+def _vote_codes(labels):
+    # integer codes of the labels in sorted order, which is the order np.unique uses
+    values, codes = np.unique(labels, return_inverse=True)
+    return values, codes.ravel()
+
+def _majority_vote(pred, codes, ncodes):
+    # the most frequent code among the nearest neighbors of every cell, counted for all cells at once.
+    # np.argmax takes the first maximum, i.e. the smallest code, like u[np.argmax(count)] after np.unique.
+    # Negative codes are not counted, and cells without any counted neighbor get -1
+    n = pred.shape[0]
+    neighborCodes = codes[pred].ravel()
+    rows = np.repeat(np.arange(n), pred.shape[1])
+    ok = neighborCodes >= 0
+    counts = np.bincount(rows[ok]*ncodes + neighborCodes[ok], minlength=n*ncodes).reshape(n, ncodes)
+    winner = np.argmax(counts, axis=1)
+    winner[counts[np.arange(n), winner] == 0] = -1
+    return winner
+
+def _family_votes(pred, labels, classes):
+    # index into classes of the label and of the majority vote of every cell (-1 if not one of the classes)
+    values, codes = _vote_codes(labels)
+    classIndex = np.zeros(values.size, dtype=int) - 1
+    for j, cl in enumerate(classes):
+        classIndex[values == cl] = j
+    winner = _majority_vote(pred, codes, values.size)
+    return classIndex[codes], np.where(winner >= 0, classIndex[winner], -1)
+
+def _vote_proportions(groups, votes, nrows, ncols):
+    # rows: groups of cells, columns: their votes, divided by the number of cells with a valid vote
+    ok = (groups >= 0) & (votes >= 0)
+    C = np.bincount(groups[ok]*ncols + votes[ok], minlength=nrows*ncols).reshape(nrows, ncols).astype(float)
+    num = np.bincount(groups[ok], minlength=nrows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return C / num[:,None]
+
 def kNN_confusion_matrix_ff(pred, labels, classes):
     """
     A function to get the family-family confusion matrix for kNN.
@@ -35,27 +174,15 @@ def kNN_confusion_matrix_ff(pred, labels, classes):
     Output:
     The confusion matrix for family assignment with size (number of families, number of families)
     """
-    C = np.zeros((classes.size, classes.size))
-    for i, cl in enumerate(classes): #for every class
-        num = 0 # counts how many cells there are within one family
-        for ind in np.where(labels==cl)[0]: # for every cell that has that class as ground truth
-            # pred[ind,:] gets the indices of the k nearest neighbors for that cell
-            # labels[pred[ind,:]] gets the family assignments of the k nearest neighbors for that cell
-            # u: the unique labels in the k nearest neighbor family list
-            # count: the counts for the unique labels
-            u, count = np.unique(labels[pred[ind,:]], return_counts=True)
-            if u[np.argmax(count)] in classes: # if the family most often assigned to the k nearest neighbors is a valid family
-                num += 1# add cell count
-
-                # add count to the corresponding cell in confusion matrix
-                # rows: ground truth, cols: assignment by majority vote of k nearest neighbors
-                C[i, classes==u[np.argmax(count)]] += 1
-
-        C[i,:] /= num #divide by cell count within family so that the raw counts become proprotions
-        
-    return C
+    # every cell is assigned the family most often found among its k nearest neighbors,
+    # and only counts if this family is one of the classes
+    # rows: ground truth, cols: assignment by majority vote of k nearest neighbors,
+    # divided by the cell count within the family so that the raw counts become proportions
+    truth, votes = _family_votes(pred, labels, classes)
+    return _vote_proportions(truth, votes, classes.size, classes.size)
     
-def kNN_confusion_matrix_tf(pred, labels, classes, cell_selector, labelset, layerset, cutoff=10, restrictLayers=False, clusterN=88):
+def kNN_confusion_matrix_tf(pred, labels, classes, cell_selector, labelset, layerset, cutoff=10, restrictLayers=False, clusterN=88,
+                            groups=None):
     """
     A function to get the transcriptomic type-family confusion matrix for kNN.
     
@@ -69,37 +196,21 @@ def kNN_confusion_matrix_tf(pred, labels, classes, cell_selector, labelset, laye
     - cutoff: how many cells there should be in a transcriptomic type to calculate the confusion matrix
     - restrictLayers: True - uses the cells from most common layer per ttype, False - uses every layer
     - clusterN: how many transcriptomic types there are in total
+    - groups: an optional TypeGroups of the selected cells, to reuse it across calls
     
     Output:
     The confusion matrix for family assignment, aggregated by transcriptomic types.
     The size will be (number of total transcriptomic types, number of families).
     Rows where the cutoff is not satisfied will have value np.nan.
     """
-    C = np.zeros((clusterN, classes.size)) * np.nan
-    for t in range(clusterN):
-        # this is a filter that gets the indices of the cell type t
-        ind = (labelset['m1consensus_ass'][cell_selector].astype(int) == t) 
-
-        # if restrictLayers is True, only keep the cells that came from the most common layer for cell type t
-        if np.sum(ind) >= cutoff and restrictLayers:
-            l, lc = np.unique(layerset[cell_selector][ind], return_counts=True)
-            mostCommonLayer = l[np.argmax(lc)]
-            ind &= (layerset[cell_selector] == mostCommonLayer)
-
-        # only calculate the confusion matrix for cells that have at least 10 cells classified to that label
-        if np.sum(ind) >= cutoff:
-            C[t,:] = 0
-            num = 0
-            for i in np.where(ind)[0]:
-                u, count = np.unique(labels[pred[i,:]], return_counts=True)
-                if u[np.argmax(count)] in classes:
-                    num += 1
-                    C[t, classes==u[np.argmax(count)]] += 1
-            C[t,:] /= num
-
-    return C
+    if groups is None:
+        groups = TypeGroups(labelset['m1consensus_ass'][cell_selector].astype(int),
+                            layerset[cell_selector], clusterN)
+    return kNN_confusion_matrices(pred, labels, None, classes, None, cutoff, restrictLayers, clusterN,
+                                  which='tf', groups=groups)
     
-def kNN_confusion_matrix_tt(pred, labels, cell_selector, layerset, cutoff=10, restrictLayers=False, clusterN=88):
+def kNN_confusion_matrix_tt(pred, labels, cell_selector, layerset, cutoff=10, restrictLayers=False, clusterN=88,
+                            groups=None):
     """
     A function to get the transcriptomic type-transcriptomic type confusion matrix for kNN.
     
@@ -111,37 +222,180 @@ def kNN_confusion_matrix_tt(pred, labels, cell_selector, layerset, cutoff=10, re
     - cutoff: how many cells there should be in a transcriptomic type to calculate the confusion matrix
     - restrictLayers: True - uses the cells from most common layer per ttype, False - uses every layer
     - clusterN: how many transcriptomic types there are in total
+    - groups: an optional TypeGroups of the selected cells, to reuse it across calls
     
     Output:
     The confusion matrix for transcriptomic type assignment.
     The size will be (number of total transcriptomic types, number of total transcriptomic types).
     Rows where the cutoff is not satisfied will have value np.nan.
     """
-    C = np.zeros((clusterN, clusterN)) * np.nan
-    for t in range(clusterN):
-        # this is a filter that gets the indices of the cell type t
-        ind = (labels == t) 
-
-        # if restrictLayers is True, only keep the cells that came from the most common layer for cell type t
-        if np.sum(ind) >= cutoff and restrictLayers:
-            l, lc = np.unique(layerset[cell_selector][ind], return_counts=True)
-            mostCommonLayer = l[np.argmax(lc)]
-            ind &= (layerset[cell_selector] == mostCommonLayer)
-
-        # only calculate the confusion matrix for cells that have at least 10 cells classified to that label
-        if np.sum(ind) >= cutoff:
-            C[t,:] = 0
-            num = 0
-            for i in np.where(ind)[0]:
-                neighbor_labels = [label for label in labels[pred[i,:]] if label in np.arange(clusterN)]
-                #u, count = np.unique(labels[pred[i,:]], return_counts=True)
-                u, count = np.unique(neighbor_labels, return_counts=True)
-                #if u[np.argmax(count)] in np.arange(clusterN):
-                num += 1
-                C[t, u[np.argmax(count)]] += 1
-            C[t,:] /= num
-
-    return C
+    if groups is None:
+        groups = TypeGroups(labels, layerset[cell_selector], clusterN)
+    return kNN_confusion_matrices(pred, None, None, None, None, cutoff, restrictLayers, clusterN,
+                                  which='tt', groups=groups)
+
+def kNN_confusion_matrices(pred, labels, type_labels, classes, layers, cutoff=10, restrictLayers=False, clusterN=88, 
+                           which=('ff', 'tf', 'tt'), groups=None):
+    """
+    The family-family, transcriptomic type-family and transcriptomic type-transcriptomic type confusion
+    matrices of one set of nearest neighbors in one pass. The neighbor labels are converted to integer
+    codes once and the majority votes of all cells are counted together; ties are broken like np.argmax
+    after np.unique (the first label in sorted order).
+    
+    Attributes:
+    - pred: the predictions given by the nearest neighbors
+    - labels: the family labels of the cells
+    - type_labels: the integer transcriptomic type labels of the cells, e.g. labelset['m1consensus_ass'][cell_selector].astype(int)
+    - classes: the list of cell families
+    - layers: the layer assignment of the cells, e.g. layerset[cell_selector]
+    - cutoff, restrictLayers, clusterN: as in kNN_confusion_matrix_tf and kNN_confusion_matrix_tt
+    - which: the matrices to compute, 'ff', 'tf' and/or 'tt'
+    - groups: a TypeGroups of the cells built from type_labels and layers
+              (type_labels and layers are then not needed), so that one index can be shared
+              by several sets of nearest neighbors of the same cells
+    
+    Output:
+    A dictionary with the requested matrices, or the matrix itself if which is a single name.
+    Cells whose neighbors have no valid transcriptomic type are left out of the tt matrix.
+    """
+    names = [which] if isinstance(which, str) else list(which)
+    pred = np.asarray(pred)
+    results = {}
+    if 'ff' in names or 'tf' in names:
+        truth, familyVotes = _family_votes(pred, labels, classes)
+    if 'tf' in names or 'tt' in names:
+        if groups is None:
+            groups = TypeGroups(np.asarray(type_labels).astype(int), layers, clusterN)
+        typeCodes = groups.types
+        groups, aboveCutoff = groups.restrict(cutoff, restrictLayers)
+    
+    if 'ff' in names:
+        results['ff'] = _vote_proportions(truth, familyVotes, classes.size, classes.size)
+    if 'tf' in names:
+        C = _vote_proportions(groups, familyVotes, clusterN, classes.size)
+        C[~aboveCutoff,:] = np.nan
+        results['tf'] = C
+    if 'tt' in names:
+        C = _vote_proportions(groups, _majority_vote(pred, typeCodes, clusterN), clusterN, clusterN)
+        C[~aboveCutoff,:] = np.nan
+        results['tt'] = C
+    return results[which] if isinstance(which, str) else results
+
+# the subplot grid of every kind of confusion matrix figure
+CM_LAYOUTS = {'ff': (3, 3), 'tf': (7, 1), 'tt': (3, 3)}
+
+_textPaths = {}
+
+def _text_path(text, fontsize):
+    # the glyph outline of text in points, centered on (0, 0); there are only a hundred
+    # different percentages, so every outline is built once
+    key = (text, fontsize)
+    if key not in _textPaths:
+        path = matplotlib.textpath.TextPath((0, 0), text, size=fontsize)
+        extents = path.get_extents()
+        _textPaths[key] = path.transformed(matplotlib.transforms.Affine2D().translate(
+            -(extents.x0 + extents.x1)/2, -(extents.y0 + extents.y1)/2))
+    return _textPaths[key]
+
+def annotate_cells(ax, C, threshold=.05, dark=.6, fontsize=5):
+    """
+    Writes the percentages of the cells of C with C >= threshold into an image of C on ax,
+    white above dark and black otherwise. All annotations are one PathCollection of glyph
+    outlines placed at the cell centers, instead of one text artist per cell.
+    Returns the collection (None if no cell is annotated).
+    """
+    C = np.asarray(C)
+    with np.errstate(invalid='ignore'):
+        rows, cols = np.nonzero(C >= threshold)
+    if rows.size == 0:
+        return None
+    values = C[rows, cols]
+    texts = np.char.mod('%2.0f', 100*values)
+    colors = np.where(values > dark, 'w', 'k')
+    # the outlines are in points, so they keep their size at any dpi and zoom
+    collection = matplotlib.collections.PathCollection(
+        [_text_path(t, fontsize) for t in texts], offsets=np.column_stack((cols, rows)),
+        offset_transform=ax.transData, facecolors=colors, edgecolors='none',
+        transform=matplotlib.transforms.Affine2D().scale(1/72) + ax.figure.dpi_scale_trans)
+    ax.add_collection(collection, autolim=False)
+    return collection
+
+def draw_cm_ff(ax, C, classes, title=None):
+    """
+    Draws one family-family confusion matrix with its percentages on ax.
+    """
+    ax.imshow(C, vmin=0, vmax=1, cmap=matplotlib.colormaps['Greys'])
+    ax.set_xticks([])
+    ax.set_yticks(np.arange(classes.size), classes)
+    ax.tick_params(axis='y', length=0)
+    ax.set_ylim([-.5, classes.size-.5])
+    ax.invert_yaxis()
+    annotate_cells(ax, C)
+    if title is not None:
+        ax.set_title(title, y=1.07)
+
+def draw_cm_tf(ax, C, classes, clusterNames, title=None):
+    """
+    Draws one transcriptomic type-family confusion matrix on ax, only the types with values.
+    """
+    aboveCutoff = ~np.isnan(C[:,0]) # plot only where there are values in the confusion matrix
+    n = np.sum(aboveCutoff)
+    ax.imshow(C[aboveCutoff,:].T, vmin=0, vmax=1, cmap=matplotlib.colormaps['Greys'], aspect='auto')
+    ax.set_xticks(np.arange(n)+.15, clusterNames[aboveCutoff], fontsize=5, rotation=90) # +.15 to adjust label positions
+    ax.tick_params(axis='both', length=0)
+    ax.set_yticks(np.arange(classes.size), classes)
+    ax.set_ylim([-.5, classes.size-.5])
+    ax.set_xlim([-.5, n-.5])
+    ax.invert_yaxis()
+    if title is not None:
+        ax.set_title(title, y=1.07)
+
+def draw_cm_tt(ax, C, clusterNames, title=None):
+    """
+    Draws one transcriptomic type-transcriptomic type confusion matrix on ax, only the types with values.
+    """
+    aboveCutoff = ~np.isnan(C[:,0]) # plot only where there are values in the confusion matrix
+    n = np.sum(aboveCutoff)
+    ax.imshow(C[aboveCutoff][:,aboveCutoff], vmin=0, vmax=1, cmap=matplotlib.colormaps['Greys'], aspect='auto')
+    ax.set_xticks(np.arange(n)+.15, clusterNames[aboveCutoff], fontsize=5, rotation=90) # +.15 to adjust label positions
+    ax.tick_params(axis='both', length=0)
+    ax.set_yticks(np.arange(n)+.15, clusterNames[aboveCutoff], fontsize=5)
+    ax.set_ylim([-.5, n-.5])
+    ax.set_xlim([-.5, n-.5])
+    ax.invert_yaxis()
+    if title is not None:
+        ax.set_title(title, y=1.07)
+
+def cm_figure(cm_dict, kind, titles, classes=None, clusterNames=None, figsize=None, fig=None):
+    """
+    Draws the confusion matrices of every feature set into one figure, without pyplot, so that it
+    works with any backend and in worker processes.
+    
+    Arguments:
+    - cm_dict: the confusion matrix dictionary
+    - kind: 'ff', 'tf' or 'tt'
+    - titles: the title dictionary to be used for each subplot. Make sure you use the same keys as cm_dict
+    - classes: the list of transcriptomic family names (for 'ff' and 'tf')
+    - clusterNames: the master list of transcriptomic type names (for 'tf' and 'tt')
+    - figsize: the figure size of a new figure
+    - fig: the figure to draw into instead of a new matplotlib.figure.Figure
+    
+    Returns:
+    - fig: the figure
+    """
+    if fig is None:
+        fig = matplotlib.figure.Figure(figsize=figsize)
+    nrows, ncols = CM_LAYOUTS[kind]
+    for cnt, (mode, C) in enumerate(cm_dict.items()):
+        ax = fig.add_subplot(nrows, ncols, cnt+1)
+        if kind == 'ff':
+            draw_cm_ff(ax, C, classes, titles[mode])
+        elif kind == 'tf':
+            draw_cm_tf(ax, C, classes, clusterNames, titles[mode])
+        else:
+            draw_cm_tt(ax, C, clusterNames, titles[mode])
+    fig.tight_layout()
+    return fig
 
 def kNN_plot_cm_ff(cm_dict, classes, titles, figsize):
     """
@@ -153,31 +407,7 @@ def kNN_plot_cm_ff(cm_dict, classes, titles, figsize):
     - titles: the title dictionary to be used for each subplot. Make sure you use the same keys as cm_dict
     - figsize: the figure size to be passed on to pyplot
     """
-    plt.figure(figsize=figsize)
-    cnt = 1
-    for mode, C in cm_dict.items():
-        ax = plt.subplot(3,3,cnt )
-        
-        plt.sca(ax)
-        plt.imshow(C, vmin=0, vmax=1, cmap=plt.get_cmap('Greys'))
-        plt.xticks([])
-        plt.yticks(np.arange(classes.size), classes)
-        plt.gca().tick_params(axis='y', length=0)
-        plt.ylim([-.5, classes.size-.5])
-        plt.gca().invert_yaxis()
-
-        for i in range(classes.size):
-            for j in range(classes.size):
-                if C[i,j] >= .05:
-                    if C[i,j] > .6:
-                        col = 'w'
-                    else:
-                        col = 'k'
-                    plt.text(j,i, '{:2.0f}'.format(100*C[i,j]), fontsize=5, ha='center', va='center', color=col)
-                    
-        plt.title(titles[mode], y=1.07)
-        cnt +=1
-    plt.tight_layout()
+    return cm_figure(cm_dict, 'ff', titles, classes=classes, fig=plt.figure(figsize=figsize))
     
 def kNN_plot_cm_tf(cm_dict, classes, titles, clusterNames, figsize):
     """
@@ -190,26 +420,8 @@ def kNN_plot_cm_tf(cm_dict, classes, titles, clusterNames, figsize):
     - clusterNames: the master list of transcriptomic family names
     - figsize: the figure size to be passed on to pyplot
     """
-    plt.figure(figsize=figsize)
-    cnt = 1
-    for mode, C in cm_dict.items():
-        ax = plt.subplot(7,1,cnt)
-        aboveCutoff = ~np.isnan(C[:,0]) # plot only where there are values in the confusion matrix
-
-        # settings for the axes
-        plt.sca(ax)
-        plt.imshow(C[aboveCutoff,:].T, vmin=0, vmax=1, cmap=plt.get_cmap('Greys'), aspect='auto')
-        plt.xticks(np.arange(np.sum(aboveCutoff))+.15, clusterNames[aboveCutoff], fontsize=5, rotation=90) # +.15 to adjust label positions
-        plt.gca().tick_params(axis='both', length=0)
-        plt.yticks(np.arange(classes.size), classes)
-        plt.ylim([-.5, classes.size-.5])
-        plt.xlim([-.5,np.sum(aboveCutoff)-.5])
-        plt.gca().invert_yaxis()
-        
-        plt.title(titles[mode], y=1.07)
-        cnt+=1
-
-    plt.tight_layout()
+    return cm_figure(cm_dict, 'tf', titles, classes=classes, clusterNames=clusterNames,
+                     fig=plt.figure(figsize=figsize))
 
 def kNN_plot_cm_tt(cm_dict, titles, clusterNames, figsize):
     """
@@ -221,25 +433,39 @@ def kNN_plot_cm_tt(cm_dict, titles, clusterNames, figsize):
     - clusterNames: the master list of transcriptomic family names
     - figsize: the figure size to be passed on to pyplot
     """
-    plt.figure(figsize=figsize)
-    cnt = 1
-    for mode, C in cm_dict.items():
-        ax = plt.subplot(3,3,cnt)
-        aboveCutoff = ~np.isnan(C[:,0]) # plot only where there are values in the confusion matrix
-
-        plt.sca(ax)
-        plt.imshow(C[aboveCutoff][:,aboveCutoff], vmin=0, vmax=1, cmap=plt.get_cmap('Greys'), aspect='auto')
-        plt.xticks(np.arange(np.sum(aboveCutoff))+.15, clusterNames[aboveCutoff], fontsize=5, rotation=90) # +.15 to adjust label positions
-        plt.gca().tick_params(axis='both', length=0)
-        plt.yticks(np.arange(np.sum(aboveCutoff))+.15, clusterNames[aboveCutoff], fontsize=5)
-        plt.ylim([-.5, clusterNames[aboveCutoff].size-.5])
-        plt.xlim([-.5,np.sum(aboveCutoff)-.5])
-        plt.gca().invert_yaxis()
-                    
-        plt.title(titles[mode], y=1.07)
-        cnt +=1
-    plt.tight_layout()
+    return cm_figure(cm_dict, 'tt', titles, clusterNames=clusterNames, fig=plt.figure(figsize=figsize))
+
+def _export_figure(job, savefig_kwargs):
+    # renders one job of export_confusion_matrices into its file (through a temporary file)
+    job = dict(job)
+    filename = job.pop('filename')
+    fig = cm_figure(**job)
+    fmt = savefig_kwargs.get('format', os.path.splitext(filename)[1][1:])
+    tmp = filename + '.tmp{}'.format(os.getpid())
+    fig.savefig(tmp, **dict(savefig_kwargs, format=fmt))
+    os.replace(tmp, filename)
+    return filename
+
+def export_confusion_matrices(jobs, n_jobs=4, **savefig_kwargs):
+    """
+    Renders confusion matrix figures into files (PNG, PDF or any other format matplotlib writes)
+    in n_jobs processes, without pyplot, e.g. every k, with and without restrictLayers, 'ff' and 'tt'.
     
+    Arguments:
+    - jobs: a list of dictionaries with the filename and the arguments of cm_figure, e.g.
+            {'filename': 'tt_k5.pdf', 'cm_dict': cm_dict, 'kind': 'tt', 'titles': titles,
+             'clusterNames': clusterNames, 'figsize': (8,8.5)}
+    - n_jobs: the number of processes
+    - savefig_kwargs: passed on to savefig, e.g. dpi=300; the format is taken from the file names
+    
+    Returns:
+    - filenames: the written files in the order of jobs
+    """
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs))) as executor:
+            return list(executor.map(_export_figure, jobs, [savefig_kwargs]*len(jobs)))
+    return [_export_figure(job, savefig_kwargs) for job in jobs]
+
 def evaluate_acc_fms(kNN_dict, label_dict, titles, class_list):
     """
     A function to calculate the adjusted mutual information and Fowlkes-Mallows score of
@@ -252,9 +478,10 @@ def evaluate_acc_fms(kNN_dict, label_dict, titles, class_list):
     - class_list: for family assignments, the list of family names. Number of ttypes for ttype assignment
     
     Returns:
-    - pred: a dictionary of the predictions based on the k nearest neighbors
-    - ACC: the accuracy score
-    - FMS: the Fowlkes-Mallows score
+    - pred_dict: a dictionary of the predictions based on the k nearest neighbors
+    - ACC_dict: a dictionary of the accuracy scores
+    - FMS_dict: a dictionary of the Fowlkes-Mallows scores
+    Raises a ValueError if a cell has no nearest neighbor with a label in class_list.
     """
     pred_dict = {}
     ACC_dict = {}
@@ -265,16 +492,16 @@ def evaluate_acc_fms(kNN_dict, label_dict, titles, class_list):
 
     for mode in label_dict.keys():
         print(f"--------------------------{titles[mode]}--------------------------")
-        pred = []
         labels = label_dict[mode]
         neighbors=kNN_dict[mode]
 
-        for cell in neighbors:
-            # in case the nearest neighbors contain nan or a family other than the ones in the list, remove them
-            neighbor_labels = [label for label in labels[cell] if label in class_list]
-            t, vote = np.unique(neighbor_labels, return_counts=True) # get the "votes" for the nearest neighbor assignment
-            pred.append(t[np.argmax(vote)]) # assign the result of the majority vote
-        pred = np.array(pred)
+        # the majority vote of the nearest neighbors of all cells at once;
+        # in case the nearest neighbors contain nan or a family other than the ones in the list, they do not vote
+        values, codes = _vote_codes(labels)
+        winner = _majority_vote(np.asarray(neighbors), np.where(np.isin(values, class_list)[codes], codes, -1), values.size)
+        if np.any(winner < 0):
+            raise ValueError('cell {} has no nearest neighbor with a label in class_list'.format(np.where(winner < 0)[0][0]))
+        pred = np.array(values[winner].tolist())
 
         ACC = accuracy_score(pred, labels)
         FMS = fowlkes_mallows_score(pred, labels)
@@ -285,6 +512,303 @@ def evaluate_acc_fms(kNN_dict, label_dict, titles, class_list):
         ACC_dict[mode] = ACC
         FMS_dict[mode] = FMS
     
-    return pred, ACC, FMS
+    return pred_dict, ACC_dict, FMS_dict
+
+    
+
+def _table_scores(pairs, ncodes):
+    # accuracy and Fowlkes-Mallows score for every row of pairs (true code * (ncodes+1) + predicted code + 1,
+    # where predicted code -1 means no vote), from contingency tables counted together with one bincount.
+    # The Fowlkes-Mallows score is computed like sklearn.metrics.fowlkes_mallows_score
+    R, m = pairs.shape
+    P = ncodes + 1
+    offsets = np.arange(R)[:,None] * (ncodes*P)
+    C = np.bincount((offsets + pairs).ravel(), minlength=R*ncodes*P).reshape(R, ncodes, P).astype(float)
+    acc = np.sum(C[:, np.arange(ncodes), np.arange(ncodes)+1], axis=1) / m
+    tk = np.sum(C**2, axis=(1,2)) - m
+    pk = np.sum(C.sum(axis=1)**2, axis=1) - m
+    qk = np.sum(C.sum(axis=2)**2, axis=1) - m
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fms = np.where(tk != 0, np.sqrt(tk / pk) * np.sqrt(tk / qk), 0.)
+    return acc, fms
+
+def _resample_scores(kind, pairsA, pairsB, ncodes, nrep, seed):
+    # one chunk of bootstrap or permutation replicates, with its own random stream.
+    # Module level, so that it can run in a worker process
+    rng = np.random.default_rng(seed)
+    m = pairsA.size
+    if kind == 'bootstrap':
+        # resampling the cells with replacement (the same cells for both feature sets of a gap)
+        ind = rng.integers(0, m, size=(nrep, m))
+        A = pairsA[ind]
+        B = pairsB[ind] if pairsB is not None else None
+    else:
+        # under the null hypothesis both feature sets predict equally well, so the
+        # predictions of the two sets can be swapped for any cell
+        swap = rng.random((nrep, m)) < .5
+        A = np.where(swap, pairsB, pairsA)
+        B = np.where(swap, pairsA, pairsB)
+    acc, fms = _table_scores(A, ncodes)
+    if B is None:
+        return acc, fms
+    accB, fmsB = _table_scores(B, ncodes)
+    return acc - accB, fms - fmsB
+
+def evaluate_acc_fms_ci(kNN_dict, label_dict, class_list, cell_dict=None, nboot=1000, nperm=1000, 
+                        alpha=.05, seed=42, n_jobs=1, chunksize=100):
+    """
+    Accuracy and Fowlkes-Mallows score of the kNN majority votes (like evaluate_acc_fms) for all feature sets,
+    with bootstrap confidence intervals, and the differences between all pairs of feature sets with
+    paired bootstrap confidence intervals and permutation p-values. Votes and scores of all replicates
+    are vectorized, and the replicates run in chunks of chunksize in n_jobs processes. Every chunk has
+    its own seed spawned from seed, so the results do not depend on n_jobs.
+    
+    Arguments:
+    - kNN_dict: a dictionary that contains the k nearest neighbors of each cell
+    - label_dict: a dictionary that has the ground truth labels
+    - class_list: for family assignments, the list of family names. Number of ttypes for ttype assignment
+    - cell_dict: a dictionary with the indices of the cells of each feature set (e.g. FeatureStore.cells),
+                 used to pair the cells for the differences between feature sets. None - no differences
+    - nboot: the number of bootstrap replicates
+    - nperm: the number of permutations for the p-values of the differences
+    - alpha: the confidence intervals are the alpha/2 and 1-alpha/2 quantiles
+    - seed: the seed of the random streams
+    - n_jobs: the number of processes
+    - chunksize: the number of replicates per task
+    
+    Returns:
+    - scores: a pandas DataFrame with one row per feature set: ACC, ACC low, ACC high, FMS, FMS low, FMS high
+    - gaps: a pandas DataFrame with one row per pair of feature sets (A, B) with the differences A - B
+            (ACC gap, ACC low, ACC high, ACC p, and the same for FMS), or None without cell_dict
+    Raises a ValueError, like evaluate_acc_fms, if a cell has no nearest neighbor with a label in class_list.
+    """
+    if type(class_list) == int:
+        class_list = np.arange(class_list)
+    modes = list(label_dict.keys())
+    
+    # one code space for the labels of all feature sets, so that predictions can be swapped between them
+    values = np.unique(np.concatenate([np.asarray(label_dict[mode]) for mode in modes]))
+    ncodes = values.size
+    pairs = {}
+    for mode in modes:
+        codes = np.searchsorted(values, label_dict[mode])
+        winner = _majority_vote(np.asarray(kNN_dict[mode]), np.where(np.isin(values, class_list)[codes], codes, -1), ncodes)
+        if np.any(winner < 0):
+            raise ValueError('cell {} of {} has no nearest neighbor with a label in class_list'.format(
+                np.where(winner < 0)[0][0], mode))
+        pairs[mode] = codes * (ncodes+1) + winner + 1
+    
+    tasks = []
+    for mode in modes:
+        tasks += [('scores', mode, 'bootstrap', pairs[mode], None)]
+    gapPairs = []
+    if cell_dict is not None:
+        for i, a in enumerate(modes):
+            for b in modes[i+1:]:
+                common, ia, ib = np.intersect1d(cell_dict[a], cell_dict[b], return_indices=True)
+                gapPairs.append((a, b, pairs[a][ia], pairs[b][ib]))
+                tasks += [('gaps', (a, b), 'bootstrap', pairs[a][ia], pairs[b][ib]),
+                          ('gaps', (a, b), 'permutation', pairs[a][ia], pairs[b][ib])]
+    
+    # chunks of replicates with independent seeds, in a fixed order
+    chunks = []
+    for table, key, kind, A, B in tasks:
+        n = nboot if kind == 'bootstrap' else nperm
+        for start in range(0, n, chunksize):
+            chunks.append((table, key, kind, A, B, min(chunksize, n-start)))
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [(kind, A, B, ncodes, nrep, s) for (table, key, kind, A, B, nrep), s in zip(chunks, seeds)]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_resample_scores, *zip(*args)))
+    else:
+        results = [_resample_scores(*a) for a in args]
+    replicates = {}
+    for (table, key, kind, _, _, _), (acc, fms) in zip(chunks, results):
+        r = replicates.setdefault((table, key, kind), ([], []))
+        r[0].append(acc)
+        r[1].append(fms)
+    replicates = {k: (np.concatenate(a), np.concatenate(f)) for k, (a, f) in replicates.items()}
+    q = [alpha/2, 1-alpha/2]
+    
+    rows = []
+    for mode in modes:
+        acc, fms = _table_scores(pairs[mode][None,:], ncodes)
+        bootACC, bootFMS = replicates[('scores', mode, 'bootstrap')]
+        rows.append([acc[0], *np.quantile(bootACC, q), fms[0], *np.quantile(bootFMS, q)])
+    scores = pd.DataFrame(rows, index=modes, columns=['ACC', 'ACC low', 'ACC high', 'FMS', 'FMS low', 'FMS high'])
+    
+    if cell_dict is None:
+        return scores, None
+    rows = []
+    for a, b, A, B in gapPairs:
+        accA, fmsA = _table_scores(A[None,:], ncodes)
+        accB, fmsB = _table_scores(B[None,:], ncodes)
+        gap = [accA[0] - accB[0], fmsA[0] - fmsB[0]]
+        boot = replicates[('gaps', (a, b), 'bootstrap')]
+        perm = replicates[('gaps', (a, b), 'permutation')]
+        row = []
+        for j in range(2):
+            p = (1 + np.sum(np.abs(perm[j]) >= np.abs(gap[j]) - 1e-12)) / (1 + perm[j].size)
+            row += [gap[j], *np.quantile(boot[j], q), p]
+        rows.append(row)
+    gaps = pd.DataFrame(rows, index=pd.MultiIndex.from_tuples([(a, b) for a, b, _, _ in gapPairs], names=['A', 'B']),
+                        columns=['ACC gap', 'ACC low', 'ACC high', 'ACC p', 'FMS gap', 'FMS low', 'FMS high', 'FMS p'])
+    return scores, gaps
+
+def _knn_block(X, sqnorms, rows, k):
+    # exact neighbors of X[rows] among all other rows of X, by squared Euclidean distances.
+    # Neighbors are sorted by distance and then by index, so every k is a prefix of a larger k.
+    # The product is computed in the dtype of X and the distances in float64 (sqnorms are float64);
+    # for float32 features the 2k best candidates are re-ranked by their float64 distances
+    D = sqnorms[rows,None] + sqnorms[None,:] - 2 * (X[rows] @ X.T)
+    np.maximum(D, 0, out=D)
+    D[np.arange(rows.size), rows] = np.inf # a cell is not its own neighbor, like NearestNeighbors.kneighbors()
+    if X.dtype == np.float64:
+        ind = np.argpartition(D, k-1, axis=1)[:, :k]
+        dist = np.take_along_axis(D, ind, axis=1)
+    else:
+        candidates = np.argpartition(D, min(2*k, X.shape[0]-1)-1, axis=1)[:, :min(2*k, X.shape[0]-1)]
+        diff = X[candidates].astype(np.float64) - X[rows,None,:].astype(np.float64)
+        exact = np.einsum('ijk,ijk->ij', diff, diff)
+        best = np.argpartition(exact, k-1, axis=1)[:, :k]
+        ind = np.take_along_axis(candidates, best, axis=1)
+        dist = np.take_along_axis(exact, best, axis=1)
+    order = np.lexsort((ind, dist), axis=1)
+    return np.take_along_axis(ind, order, axis=1), np.sqrt(np.take_along_axis(dist, order, axis=1))
+
+class SharedNeighbors:
+    """
+    Exact k nearest neighbors of the cells of every feature set of a features.FeatureStore, computed
+    once at the largest k in blocks of cells on a thread pool. Any smaller k is served as a prefix of
+    the stored neighbors, so curves over k need a single neighbor search per feature set.
+    The neighbors exclude the cell itself, like NearestNeighbors(n_neighbors=k).fit(X).kneighbors().
+    
+    Arguments:
+    - store: a features.FeatureStore (or a dictionary of feature matrices of the valid cells)
+    - maxk: the largest k that will be used
+    - blocksize: the number of cells per block of the distance computation
+    - n_jobs: the number of threads (None - the number of CPUs)
+    - cachedir: a directory where the neighbors are stored under a hash of the features (None - memory only)
+    """
+    def __init__(self, store, maxk=50, blocksize=1024, n_jobs=None, cachedir=None):
+        self.store = store
+        self.maxk = maxk
+        self.blocksize = blocksize
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.cachedir = cachedir
+        self._neighbors = {}
+
+    def _features(self, name):
+        if hasattr(self.store, 'features'):
+            return self.store.features(name)
+        return self.store[name]
+
+    def _names(self):
+        return self.store.names() if hasattr(self.store, 'names') else list(self.store)
+
+    def _cache_path(self, name, X):
+        h = hashlib.sha1(repr((X.shape, X.dtype.str, self.maxk)).encode())
+        h.update(np.ascontiguousarray(X).tobytes())
+        return os.path.join(self.cachedir, 'neighbors-{}-{}.npz'.format(name, h.hexdigest()[:16]))
 
-    
\ No newline at end of file
+    def compute(self, names=None):
+        """
+        Computes the neighbors of the given feature sets (all of them by default) that are
+        not computed or cached yet, with the blocks of all sets on one thread pool.
+        """
+        todo = {}
+        for name in (names or self._names()):
+            if name in self._neighbors:
+                continue
+            # the stored features are used as they are (e.g. float32 from a FeatureStore), without a copy
+            X = np.asarray(self._features(name))
+            if not np.issubdtype(X.dtype, np.floating):
+                X = X.astype(float)
+            if self.cachedir is not None and os.path.exists(self._cache_path(name, X)):
+                with np.load(self._cache_path(name, X)) as f:
+                    self._neighbors[name] = (f['ind'], f['dist'])
+                continue
+            k = min(self.maxk, X.shape[0]-1)
+            ind = np.zeros((X.shape[0], k), dtype=int)
+            dist = np.zeros((X.shape[0], k))
+            todo[name] = (X, np.einsum('ij,ij->i', X, X, dtype=np.float64), ind, dist, k)
+
+        def run(name, rows):
+            X, sqnorms, ind, dist, k = todo[name]
+            ind[rows], dist[rows] = _knn_block(X, sqnorms, rows, k)
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            futures = [executor.submit(run, name, np.arange(start, min(start+self.blocksize, X.shape[0])))
+                       for name, (X, _, _, _, _) in todo.items()
+                       for start in range(0, X.shape[0], self.blocksize)]
+            for future in futures:
+                future.result()
+
+        for name, (X, _, ind, dist, _) in todo.items():
+            self._neighbors[name] = (ind, dist)
+            if self.cachedir is not None:
+                os.makedirs(self.cachedir, exist_ok=True)
+                path = self._cache_path(name, X)
+                np.savez(path + '.tmp{}.npz'.format(os.getpid()), ind=ind, dist=dist)
+                os.replace(path + '.tmp{}.npz'.format(os.getpid()), path)
+        return self
+
+    def kneighbors(self, name, k):
+        """
+        Returns the Euclidean distances and the indices of the k nearest neighbors of every cell of
+        a feature set (views into the stored arrays), like NearestNeighbors.kneighbors().
+        """
+        if k > self.maxk:
+            raise ValueError('k={} is larger than maxk={}'.format(k, self.maxk))
+        self.compute([name])
+        ind, dist = self._neighbors[name]
+        if k > ind.shape[1]:
+            raise ValueError('k={} is larger than the number of other cells in {} ({})'.format(k, name, ind.shape[1]))
+        return dist[:, :k], ind[:, :k]
+
+def kNN_sweep(neighbors, label_dict, class_list, ks=range(1, 51)):
+    """
+    Accuracy and Fowlkes-Mallows score of the majority vote of the k nearest neighbors, like
+    evaluate_acc_fms, for every k in ks and every feature set, from the neighbors computed once.
+    The votes are counted incrementally over the prefix of the neighbor lists. Like evaluate_acc_fms,
+    it raises ValueError if a cell has no nearest neighbor with a label in class_list.
+    
+    Arguments:
+    - neighbors: a SharedNeighbors with maxk >= max(ks) on sets with more than max(ks) cells
+    - label_dict: a dictionary with the ground truth labels of the cells of each feature set
+    - class_list: for family assignments, the list of family names. Number of ttypes for ttype assignment
+    - ks: the values of k
+    
+    Returns:
+    - ACC: a dictionary with an array of accuracies (one per k) for every feature set
+    - FMS: the same for the Fowlkes-Mallows scores
+    """
+    if type(class_list) == int:
+        class_list = np.arange(class_list)
+    ks = np.unique(list(ks))
+    ACC, FMS = {}, {}
+    for mode, labels in label_dict.items():
+        values, codes = _vote_codes(labels)
+        votable = np.isin(values, class_list)
+        _, ind = neighbors.kneighbors(mode, ks[-1])
+        n = ind.shape[0]
+        counts = np.zeros((n, values.size), dtype=int)
+        ACC[mode] = np.zeros(ks.size)
+        FMS[mode] = np.zeros(ks.size)
+        j = 0
+        for k in range(1, ks[-1]+1):
+            # add the k-th neighbor's vote if its label is one of the classes
+            c = codes[ind[:, k-1]]
+            ok = votable[c]
+            counts[np.arange(n)[ok], c[ok]] += 1
+            if k == ks[j]:
+                # the first maximum is the first label in sorted order, like np.unique and np.argmax
+                pred = np.argmax(counts, axis=1)
+                if np.any(counts[np.arange(n), pred] == 0):
+                    raise ValueError('cell {} has no nearest neighbor with a label in class_list (k={})'.format(
+                        np.where(counts[np.arange(n), pred] == 0)[0][0], k))
+                ACC[mode][j] = np.mean(pred == codes)
+                FMS[mode][j] = fowlkes_mallows_score(pred, codes)
+                j += 1
+    return ACC, FMS
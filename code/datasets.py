@@ -0,0 +1,232 @@
+import os
+import re
+import sys
+import json
+import shutil
+import pickle
+from collections import namedtuple
+from collections.abc import Mapping
+import numpy as np
+from scipy import sparse
+
+# fields of the m1 object exported by patch-seq-data-load.ipynb, for reading m1.pickle
+# outside of the notebooks that define houstonData
+HOUSTON_FIELDS = ('exonCounts intronCounts cells genes layers cre yields traced '
+                  'depth thickness ephys ephysNames exclude '
+                  'mice_ages mice_cres morphometrics morphometricsNames zProfiles '
+                  'exonLengths intronLengths')
+
+SCHEMA = 'schema.json'
+
+
+def _file_name(key, i, used):
+    # a readable file name for the key if it is one, otherwise a numbered one
+    name = key if isinstance(key, str) and re.fullmatch(r'[A-Za-z0-9_\-.]{1,100}', key) else '_{}'.format(i)
+    if name.lower() in used or name in [SCHEMA, '.', '..']:
+        name = '_{}'.format(i)
+    used.add(name.lower())
+    return name
+
+
+def _write_value(value, path, name):
+    # writes one value into the directory path and returns its schema entry
+    if isinstance(value, dict) or _is_namedtuple(value):
+        _write_dataset(value, os.path.join(path, name))
+        return {'type': 'dataset', 'dir': name}
+    if sparse.issparse(value):
+        fmt = value.format if value.format in ['csr', 'csc'] else 'csr'
+        value = value.asformat(fmt)
+        os.makedirs(os.path.join(path, name))
+        for field in ['data', 'indices', 'indptr']:
+            np.save(os.path.join(path, name, field + '.npy'), getattr(value, field))
+        return {'type': 'sparse', 'dir': name, 'format': fmt, 'shape': list(value.shape)}
+    if isinstance(value, np.ndarray) and not isinstance(value, np.matrix) and value.dtype != object:
+        np.save(os.path.join(path, name + '.npy'), value)
+        return {'type': 'array', 'file': name + '.npy'}
+    if isinstance(value, np.matrix) and value.dtype != object:
+        np.save(os.path.join(path, name + '.npy'), np.asarray(value))
+        return {'type': 'array', 'file': name + '.npy', 'matrix': True}
+    if isinstance(value, np.ndarray) and all(isinstance(v, str) for v in value.ravel()):
+        # string arrays (gene and cell names etc.) as fixed-width unicode, back to object on loading
+        np.save(os.path.join(path, name + '.npy'), value.astype(str))
+        return {'type': 'strings', 'file': name + '.npy'}
+    if isinstance(value, np.generic) and value.dtype != object:
+        return {'type': 'value', 'value': value.item(), 'dtype': value.dtype.str}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'type': 'value', 'value': value}
+    # anything else (pandas objects, lists, mixed object arrays) is pickled on its own
+    with open(os.path.join(path, name + '.pickle'), 'wb') as f:
+        pickle.dump(value, f, protocol=4)
+    return {'type': 'pickle', 'file': name + '.pickle'}
+
+
+def _is_namedtuple(value):
+    return isinstance(value, tuple) and hasattr(value, '_fields')
+
+
+def _write_dataset(obj, path):
+    os.makedirs(path)
+    if _is_namedtuple(obj):
+        schema = {'kind': 'namedtuple', 'typename': type(obj).__name__, 'fields': list(obj._fields)}
+        items = list(zip(obj._fields, obj))
+    else:
+        schema = {'kind': 'dict'}
+        items = list(obj.items())
+    used = set()
+    entries = []
+    for i, (key, value) in enumerate(items):
+        entry = _write_value(value, path, _file_name(key, i, used))
+        # non-string keys (e.g. integer clusters) are kept with their JSON type,
+        # numpy scalars (e.g. np.int64 from np.unique) as the Python scalar they hold
+        if isinstance(key, np.generic):
+            key = key.item()
+        entry['key'] = key if isinstance(key, (str, int, float, bool)) else str(key)
+        entries.append(entry)
+    schema['entries'] = entries
+    with open(os.path.join(path, SCHEMA), 'w') as f:
+        json.dump(schema, f, indent=1)
+
+
+def save_dataset(obj, path):
+    """
+    Writes a dictionary or a namedtuple (e.g. m1data, m1 or ttypes) into the directory path:
+    every field becomes its own file, so that it can be loaded (and memory-mapped) on its own.
+    - numeric arrays: <field>.npy
+    - sparse matrices: a directory with data.npy, indices.npy and indptr.npy
+    - string arrays: <field>.npy with fixed-width strings
+    - nested dictionaries and namedtuples: a subdirectory with its own schema
+    - scalars: in the schema
+    - everything else: <field>.pickle
+    Every directory has a schema.json with the kind of object, the fields in their order and how
+    they are stored. The dataset is written into a temporary directory first and replaces path at the end.
+    """
+    tmp = path.rstrip('/') + '.tmp{}'.format(os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    _write_dataset(obj, tmp)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+class Dataset(Mapping):
+    """
+    A dataset written by save_dataset, opened lazily: only the schema is read when it is opened,
+    and a field is loaded (memory-mapped if mmap=True) the first time it is accessed, e.g.
+    m1data['viplamp']['counts'] reads the component arrays of that one sparse matrix.
+    Fields can be accessed by key and, if the key is a valid name, as attributes (m1.exonCounts).
+
+    Arguments:
+    - path: the dataset directory
+    - mmap: memory-map the arrays instead of reading them (memory-mapped arrays are read-only)
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap = mmap
+        with open(os.path.join(path, SCHEMA)) as f:
+            self.schema = json.load(f)
+        self._entries = {entry['key']: entry for entry in self.schema['entries']}
+        self._loaded = {}
+
+    def _load(self, entry):
+        mode = 'r' if self.mmap else None
+        kind = entry['type']
+        if kind == 'dataset':
+            return Dataset(os.path.join(self.path, entry['dir']), self.mmap)
+        if kind == 'sparse':
+            d = os.path.join(self.path, entry['dir'])
+            matrix = sparse.csc_matrix if entry['format'] == 'csc' else sparse.csr_matrix
+            return matrix(tuple(np.load(os.path.join(d, field + '.npy'), mmap_mode=mode)
+                                for field in ['data', 'indices', 'indptr']),
+                          shape=tuple(entry['shape']), copy=False)
+        if kind == 'array':
+            a = np.load(os.path.join(self.path, entry['file']), mmap_mode=mode)
+            return np.asmatrix(a) if entry.get('matrix') else a
+        if kind == 'strings':
+            return np.load(os.path.join(self.path, entry['file'])).astype(object)
+        if kind == 'value':
+            return np.dtype(entry['dtype']).type(entry['value']) if 'dtype' in entry else entry['value']
+        with open(os.path.join(self.path, entry['file']), 'rb') as f:
+            return pickle.load(f)
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            self._loaded[key] = self._load(self._entries[key])
+        return self._loaded[key]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.__dict__.get('_entries', {}):
+            raise AttributeError(name)
+        return self[name]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return 'Dataset({!r}, fields: {})'.format(self.path, ', '.join(map(str, self._entries)))
+
+    @property
+    def _fields(self):
+        return tuple(self._entries)
+
+    def load(self):
+        """
+        Loads everything into memory as the original objects: dictionaries, or namedtuples of the
+        same name and fields (a new class, since the original one may only exist in a notebook).
+        """
+        values = {key: value.load() if isinstance(value, Dataset) else
+                       np.array(value) if isinstance(value, np.memmap) else value
+                  for key, value in self.items()}
+        for key, value in values.items():
+            if sparse.issparse(value):
+                values[key] = value.copy()
+            elif isinstance(value, np.matrix):
+                values[key] = np.asmatrix(np.array(value))
+        if self.schema['kind'] == 'namedtuple':
+            return namedtuple(self.schema['typename'], self.schema['fields'])(**values)
+        return values
+
+
+def open_dataset(path, mmap=True):
+    """
+    Opens a dataset written by save_dataset or convert_pickle without loading any field (see Dataset).
+    """
+    return Dataset(path, mmap)
+
+
+class _Unpickler(pickle.Unpickler):
+    # m1.pickle refers to the houstonData class of the notebook that wrote it
+    def find_class(self, module, name):
+        try:
+            return super().find_class(module, name)
+        except AttributeError:
+            if name == 'houstonData':
+                return namedtuple('houstonData', HOUSTON_FIELDS)
+            raise
+
+
+def convert_pickle(filename, path=None):
+    """
+    One-shot conversion of an analysis pickle (10X_cells_v2_AIBS.pickle, m1.pickle, ttypes.pickle,
+    three_traces.pickle, viplamp_exint.pickle etc.) into a dataset directory, by default next to it
+    without the .pickle extension. Objects other than dictionaries and namedtuples (e.g. the matrix
+    in viplamp_exint.pickle) are stored as the field 'data' of a dictionary.
+    Returns the path of the dataset.
+    """
+    if path is None:
+        path = filename[:-len('.pickle')] if filename.endswith('.pickle') else filename + '.dataset'
+    with open(filename, 'rb') as f:
+        obj = _Unpickler(f).load()
+    if not (isinstance(obj, dict) or _is_namedtuple(obj)):
+        obj = {'data': obj}
+    save_dataset(obj, path)
+    return path
+
+
+if __name__ == '__main__':
+    # python datasets.py ../data/processed/rnaseq/m1.pickle ../data/processed/rnaseq/ttypes.pickle ...
+    for filename in sys.argv[1:]:
+        print(filename, '->', convert_pickle(filename), flush=True)
@@ -0,0 +1,320 @@
+import json
+import time
+import asyncio
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import sparse
+
+import rnaseqTools
+
+
+class MappingService:
+    """
+    A long-lived mapping service for newly sequenced patch-seq cells. The references are
+    preprocessed once (rnaseqTools.ReferenceAtlas) and kept in memory together with the cluster
+    means, the bootstrap-weighted means and the gene subset of the t-SNE reference, and requests
+    with a few cells each are coalesced into larger batches that are only log-transformed and
+    correlated with the precomputed references.
+
+    Start it with serve() (or run() from a script) and send cells with map_cells().
+
+    HTTP endpoints:
+    - POST /map: JSON with "exonCounts" and optionally "intronCounts", "genes" and "cells".
+                 Counts are lists of rows, either dense lists in the order of "genes"
+                 (or of the service genes) or {"index": [...], "value": [...]} for sparse rows.
+                 Returns one result per cell: cluster, type name, bootstrap confidence and t-SNE position.
+    - GET /metrics: request latency percentiles (p50/p99), throughput and batch sizes.
+
+    Arguments:
+    - clusterReference: a ReferenceAtlas of the reference used for the type assignment
+    - clusters: the cluster of every cell in clusterReference
+    - clusterNames: the names of the clusters
+    - genes: the genes of the incoming count vectors
+    - exonLengths, intronLengths: lengths of the genes, needed if normalizeNew=True
+                                  (intronLengths only for requests with intron counts)
+    - normalizeNew: normalize the new counts by gene lengths like in map_to_clusters
+    - tsneReference: a ReferenceAtlas for the t-SNE positions (optional)
+    - tsnePositions: the t-SNE coordinates of the cells in tsneReference
+    - index: an optional neighborSearch.NeighborIndex built on tsneReference
+    - knn: the number of neighbors for the t-SNE positions
+    - nrep: the number of bootstrap repetitions for the confidences (0 - no bootstrap)
+    - seed: the seed of the bootstrap weights, drawn once from the service's own generator,
+            so that a cell gets the same confidence in any batch
+    - maxBatch: the maximum number of cells mapped together
+    - maxWait: how long (in seconds) a request can wait for others to fill a batch
+    - maxmemory: the bootstrap-weighted copies of the cluster means are kept if they fit
+                 into maxmemory bytes, otherwise they are rebuilt for every batch
+    """
+    def __init__(self, clusterReference, clusters, clusterNames, genes,
+                 exonLengths=None, intronLengths=None, normalizeNew=False,
+                 tsneReference=None, tsnePositions=None, index=None, knn=10,
+                 nrep=100, seed=42, maxBatch=256, maxWait=.05, maxmemory=2**30):
+        if normalizeNew and exonLengths is None:
+            raise ValueError('normalizeNew=True needs exonLengths')
+        self.clusterReference = clusterReference
+        self.clusters = np.asarray(clusters).astype(int)
+        self.clusterNames = np.asarray(clusterNames)
+        self.genes = np.asarray(genes)
+        self.geneIndex = {g: i for i, g in reversed(list(enumerate(self.genes)))}
+        self.exonLengths = exonLengths
+        self.intronLengths = intronLengths
+        self.normalizeNew = normalizeNew
+        self.tsneReference = tsneReference
+        self.tsnePositions = tsnePositions
+        self.index = index
+        self.knn = knn
+        self.nrep = nrep
+        self.seed = seed
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+
+        # the reference is kept warm: the common genes, the cluster means, their row stats
+        # and the bootstrap weights are computed once and shared by all batches
+        self.dtype = clusterReference.dtype
+        self._refGenes, self._newGenes = clusterReference.common_genes(self.genes)
+        T, _ = clusterReference.subset(self._refGenes)
+        self._means = rnaseqTools.cluster_means(T, self.clusters, self.clusterNames.size, self.dtype)
+        self._meanStats = rnaseqTools.rowstats(self._means)
+        self._rng = np.random.default_rng(seed)
+        self._weights = None
+        self._weighted = None
+        if nrep > 0:
+            self._weights = rnaseqTools.bootstrap_weights(self._refGenes.size, nrep, self._rng, self.dtype)
+            copies = nrep * self._means.size * self._means.dtype.itemsize <= maxmemory
+            self._weighted = rnaseqTools.weighted_rows(self._means, self._weights, copies)
+        self.maxmemory = maxmemory
+
+        # the same for the t-SNE reference: its common genes, their expression levels and row stats
+        if tsneReference is not None:
+            self._tsneRefGenes, self._tsneNewGenes = tsneReference.common_genes(self.genes)
+            self._tsneT, self._tsneStats = tsneReference.subset(self._tsneRefGenes)
+            if index is not None:
+                if self._tsneRefGenes.size != index.reference.shape[1]:
+                    raise ValueError('index needs a tsneReference whose genes are all in genes')
+                self._tsneIndexOrder = np.argsort(self._tsneRefGenes)
+
+        # the mapping runs in one worker thread so that the event loop keeps accepting requests
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._latencies = deque(maxlen=10000)
+        self._batchSizes = deque(maxlen=10000)
+        self._mapped = deque(maxlen=10000)
+        self._started = time.time()
+
+    def _expression(self, X, Xi, genes, dtype):
+        # log expression levels of the new cells for the service genes genes
+        if self.normalizeNew and Xi is not None and self.intronLengths is None:
+            raise ValueError('intron counts with normalizeNew=True need intronLengths')
+        return rnaseqTools.log_expression(
+            X[:,genes], Xi[:,genes] if Xi is not None else None, self.normalizeNew,
+            self.exonLengths[genes] if self.exonLengths is not None else None,
+            self.intronLengths[genes] if self.intronLengths is not None else None, dtype)
+
+    def map_batch(self, X, Xi=None):
+        """
+        Maps a batch of cells (exon counts X, intron counts Xi in the order of the service genes).
+        Returns cluster assignments, bootstrap confidences and t-SNE positions (or None).
+        """
+        Xg = self._expression(X, Xi, self._newGenes, self.dtype)
+        assignment, frequencies, _ = rnaseqTools.assign_to_means(
+            Xg, self._means, self._meanStats, self._weights, self.dtype, self.maxmemory,
+            verbose=False, weighted=self._weighted)
+        confidence = np.zeros(X.shape[0]) * np.nan
+        if frequencies is not None:
+            assigned = ~np.isnan(assignment)
+            confidence[assigned] = frequencies[assigned, assignment[assigned].astype(int)]
+
+        # t-SNE positions like map_to_tsne, against the precomputed gene subset of the reference
+        positions = None
+        if self.tsneReference is not None:
+            dtype = self.tsneReference.dtype
+            if np.array_equal(self._tsneNewGenes, self._newGenes) and dtype == self.dtype:
+                Xt = Xg
+            else:
+                Xt = self._expression(X, Xi, self._tsneNewGenes, dtype)
+            if self.index is not None:
+                ind, corrs = self.index.query(Xt[:, self._tsneIndexOrder], self.knn)
+                positions = rnaseqTools.aggregate_positions(ind, corrs, self.tsnePositions)
+            else:
+                C = rnaseqTools.corr2_sparse(Xt, self._tsneT, dtype, self._tsneStats)
+                positions = rnaseqTools.knn_positions(C, self.knn, self.tsnePositions)
+        return assignment, confidence, positions
+
+    def _rows(self, rows, genes):
+        # request rows (dense lists or {"index", "value"} dicts) as CSR in the order of the service genes
+        if genes is None:
+            columns = np.arange(self.genes.size)
+        else:
+            columns = np.array([self.geneIndex.get(g, -1) for g in genes])
+        keep = columns >= 0
+        data, indices, indptr = [], [], [0]
+        for row in rows:
+            if isinstance(row, dict):
+                ind = np.asarray(row['index'], dtype=int)
+                val = np.asarray(row['value'], dtype=float)
+            else:
+                val = np.asarray(row, dtype=float)
+                ind = np.nonzero(val)[0]
+                val = val[ind]
+            ok = keep[ind]
+            data.append(val[ok])
+            indices.append(columns[ind[ok]])
+            indptr.append(indptr[-1] + np.sum(ok))
+        return sparse.csr_matrix((np.concatenate(data) if data else np.zeros(0),
+                                  np.concatenate(indices) if indices else np.zeros(0, dtype=int),
+                                  indptr), shape=(len(rows), self.genes.size))
+
+    async def submit(self, X, Xi=None):
+        """
+        Queues the cells for the next batch and waits for their results.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((X, Xi, future, time.perf_counter()))
+        return await future
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            n = items[0][0].shape[0]
+            deadline = loop.time() + self.maxWait
+            while n < self.maxBatch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                n += item[0].shape[0]
+
+            X = sparse.vstack([item[0] for item in items], format='csr')
+            Xi = None
+            if any(item[1] is not None for item in items):
+                Xi = sparse.vstack([item[1] if item[1] is not None else sparse.csr_matrix(item[0].shape)
+                                    for item in items], format='csr')
+            try:
+                assignment, confidence, positions = await loop.run_in_executor(
+                    self._executor, self.map_batch, X, Xi)
+            except Exception as e:
+                for item in items:
+                    # requests whose clients are gone (cancelled futures) get nothing
+                    if not item[2].done():
+                        item[2].set_exception(e)
+                continue
+
+            start = 0
+            now = time.perf_counter()
+            for Xr, _, future, arrival in items:
+                rows = slice(start, start + Xr.shape[0])
+                start += Xr.shape[0]
+                if future.done():
+                    continue
+                future.set_result((assignment[rows], confidence[rows],
+                                   positions[rows] if positions is not None else None))
+                self._latencies.append(now - arrival)
+            self._batchSizes.append(n)
+            self._mapped.append((time.time(), n))
+
+    def metrics(self):
+        """
+        Returns latency percentiles (seconds), throughput (cells per second over the last minute)
+        and the mean batch size.
+        """
+        latencies = np.array(self._latencies)
+        now = time.time()
+        recent = [n for t, n in self._mapped if now - t <= 60]
+        window = min(60, now - self._started)
+        return {'requests': len(latencies),
+                'latency_p50': float(np.percentile(latencies, 50)) if latencies.size else None,
+                'latency_p99': float(np.percentile(latencies, 99)) if latencies.size else None,
+                'cells_per_second': float(np.sum(recent) / window) if window > 0 else None,
+                'mean_batch_size': float(np.mean(self._batchSizes)) if self._batchSizes else None}
+
+    def _results(self, cells, assignment, confidence, positions):
+        results = []
+        for i in range(assignment.size):
+            assigned = not np.isnan(assignment[i])
+            results.append({'cell': cells[i] if cells is not None else i,
+                            'cluster': int(assignment[i]) if assigned else None,
+                            'type': str(self.clusterNames[int(assignment[i])]) if assigned else None,
+                            'confidence': float(confidence[i]) if not np.isnan(confidence[i]) else None,
+                            'position': positions[i].tolist() if positions is not None else None})
+        return results
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            lines = request.decode('latin-1').split('\r\n')
+            method, path = lines[0].split()[:2]
+            headers = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+            headers = {k.strip().lower(): v.strip() for k, v in headers.items()}
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if method == 'GET' and path == '/metrics':
+                status, response = 200, self.metrics()
+            elif method == 'POST' and path == '/map':
+                request = json.loads(body)
+                X = self._rows(request['exonCounts'], request.get('genes'))
+                Xi = None
+                if request.get('intronCounts') is not None:
+                    Xi = self._rows(request['intronCounts'], request.get('genes'))
+                results = await self.submit(X, Xi)
+                status, response = 200, self._results(request.get('cells'), *results)
+            else:
+                status, response = 404, {'error': 'unknown endpoint ' + method + ' ' + path}
+        except Exception as e:
+            status, response = 500, {'error': repr(e)}
+
+        body = json.dumps(response).encode()
+        reason = {200: 'OK', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, reason, len(body)).encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        """
+        Serves HTTP requests until cancelled.
+        """
+        self._queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self._batcher())
+        server = await asyncio.start_server(self._handle, host, port)
+        print('Mapping service listening on http://{}:{}'.format(host, port), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    def run(self, host='127.0.0.1', port=8765):
+        """
+        Blocking version of serve(), e.g. for a script.
+        """
+        asyncio.run(self.serve(host, port))
+
+
+def map_cells(url, exonCounts, intronCounts=None, genes=None, cells=None, timeout=600):
+    """
+    Sends cells to a running MappingService at url (e.g. 'http://127.0.0.1:8765') and
+    returns the list of results. Counts are cells x genes matrices (sparse or dense).
+    """
+    def rows(M):
+        if M is None:
+            return None
+        M = sparse.csr_matrix(M)
+        return [{'index': M.indices[M.indptr[i]:M.indptr[i+1]].tolist(),
+                 'value': M.data[M.indptr[i]:M.indptr[i+1]].tolist()} for i in range(M.shape[0])]
+
+    request = {'exonCounts': rows(exonCounts), 'intronCounts': rows(intronCounts),
+               'genes': list(map(str, genes)) if genes is not None else None,
+               'cells': list(map(str, cells)) if cells is not None else None}
+    r = urllib.request.Request(url.rstrip('/') + '/map', data=json.dumps(request).encode(),
+                               headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(r, timeout=timeout) as response:
+        return json.loads(response.read())
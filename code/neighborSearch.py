@@ -0,0 +1,243 @@
+import os
+import time
+import pickle
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, svds
+from sklearn.neighbors import BallTree
+
+import rnaseqTools
+
+
+def _scores(A, B, metric, dtype=float, statsB=None):
+    # similarity matrix where larger is better: correlations, or negative squared distances
+    if metric == 'correlation':
+        S = rnaseqTools.corr2_sparse(A, B, dtype, statsB)
+        S[np.isnan(S)] = -np.inf
+        return S
+    elif metric == 'euclidean':
+        A = A.toarray() if sparse.issparse(A) else np.asarray(A, dtype=dtype)
+        B = B.toarray() if sparse.issparse(B) else np.asarray(B, dtype=dtype)
+        return -rnaseqTools.pdist2(A, B)
+    else:
+        raise ValueError("metric must be 'correlation' or 'euclidean'")
+
+
+def _top_k(S, knn):
+    # indices of the knn largest entries of every row of S, largest first
+    knn = min(knn, S.shape[1])
+    ind = np.argpartition(-S, knn-1, axis=1)[:, :knn]
+    order = np.argsort(-np.take_along_axis(S, ind, axis=1), axis=1, kind='stable')
+    ind = np.take_along_axis(ind, order, axis=1)
+    return ind, np.take_along_axis(S, ind, axis=1)
+
+
+def _final_scores(S, metric):
+    S = S.copy()
+    if metric == 'correlation':
+        S[np.isinf(S)] = np.nan
+        return S
+    return -S
+
+
+def knn_exact(A, B, knn, metric='correlation', batchsize=1000, dtype=float, statsB=None):
+    """
+    Exact k nearest neighbors of the rows of A among the rows of B, searched in
+    blocks of rows of A so that only a batchsize x (rows of B) matrix is in memory.
+
+    Arguments:
+    - A, B: cells x genes (or cells x features) matrices, sparse or dense
+    - knn: the number of neighbors
+    - metric: 'correlation' (rnaseqTools.corr2_sparse, most correlated first) or
+              'euclidean' (squared distances as in rnaseqTools.pdist2, closest first)
+    - batchsize: the number of rows of A per block
+    - dtype: float or np.float32
+    - statsB: optional row sums and sums of squares of B (see rnaseqTools.rowstats)
+
+    Returns:
+    - ind: indices into the rows of B with shape (rows of A, knn), best neighbor first
+    - score: the corresponding correlations or squared distances
+    """
+    n = A.shape[0]
+    knn = min(knn, B.shape[0])
+    ind = np.zeros((n, knn), dtype=int)
+    score = np.zeros((n, knn))
+    for start in range(0, n, batchsize):
+        batch = np.arange(start, min(start+batchsize, n))
+        S = _scores(A[batch,:], B, metric, dtype, statsB)
+        ind[batch,:], S = _top_k(S, knn)
+        score[batch,:] = _final_scores(S, metric)
+    return ind, score
+
+
+class NeighborIndex:
+    """
+    Approximate nearest-neighbor index over the reference cells, for mapping new cells
+    without correlating them to every reference cell.
+
+    For the correlation metric, the reference profiles are centered and scaled to unit
+    norm per cell, so that squared Euclidean distances between them equal 2*(1 - correlation).
+    These profiles are reduced to ncomponents principal components (without densifying
+    sparse input) and put into a ball tree, which prunes better than a KD-tree in that
+    many dimensions. A query takes candidates*knn neighbors from
+    the tree and re-ranks them by the exact correlation on all genes.
+    With the euclidean metric the same is done on the rows as they are, e.g. for
+    positioning cells on a downsampled t-SNE in PCA space.
+
+    Arguments:
+    - reference: cells x genes log expression levels (sparse or dense), or a rnaseqTools.ReferenceAtlas.
+                 Queries must have the same genes in the same order.
+    - metric: 'correlation' or 'euclidean'
+    - ncomponents: the number of principal components for the tree; the tree search gets
+                   close to a linear scan with many more (check recall() when changing it)
+    - candidates: how many times knn candidates are re-ranked per query
+    - leaf_size: the leaf size of the ball tree
+    - seed: the seed for the SVD initialization
+    """
+    def __init__(self, reference, metric='correlation', ncomponents=20, candidates=10,
+                 leaf_size=40, seed=42, _build=True):
+        if isinstance(reference, rnaseqTools.ReferenceAtlas):
+            reference = reference.expression
+        if sparse.issparse(reference):
+            # queries gather candidate rows
+            reference = reference.tocsr()
+        else:
+            reference = np.asarray(reference)
+        if metric not in ['correlation', 'euclidean']:
+            raise ValueError("metric must be 'correlation' or 'euclidean'")
+        self.reference = reference
+        self.metric = metric
+        self.candidates = candidates
+        self.stats = rnaseqTools.rowstats(reference)
+        if _build:
+            self._fit_projection(min(ncomponents, min(reference.shape)-1), seed)
+            self.tree = BallTree(self.project(reference), leaf_size=leaf_size)
+
+    def _row_scaling(self, A, stats=None):
+        # row means and norms of the centered rows (ones and zeros for the euclidean metric)
+        if self.metric == 'euclidean':
+            return np.zeros(A.shape[0]), np.ones(A.shape[0])
+        s, q = rnaseqTools.rowstats(A) if stats is None else stats
+        p = A.shape[1]
+        m = s / p
+        norm = np.sqrt(np.maximum(q - p * m**2, 0))
+        norm[norm == 0] = 1
+        return m, norm
+
+    def _fit_projection(self, ncomponents, seed):
+        # truncated SVD of the column-centered profiles as an implicit operator, so that
+        # neither the row nor the column centering is ever materialized
+        T = self.reference
+        R, G = T.shape
+        m, norm = self._row_scaling(T, self.stats)
+        self.mean = (np.asarray(T.T @ (1/norm)).ravel() - np.sum(m/norm)) / R
+
+        def matvec(v):
+            v = np.ravel(v)
+            return (np.asarray(T @ v).ravel() - m * np.sum(v)) / norm - self.mean @ v
+
+        def rmatvec(u):
+            u = np.ravel(u) / norm
+            return np.asarray(T.T @ u).ravel() - np.sum(m * u) - self.mean * np.sum(u * norm)
+
+        op = LinearOperator((R, G), matvec=matvec, rmatvec=rmatvec, dtype=float)
+        v0 = np.random.default_rng(seed).random(min(R, G))
+        _, s, Vt = svds(op, k=ncomponents, v0=v0)
+        self.components = Vt[np.argsort(s)[::-1], :].T
+
+    def project(self, A):
+        """
+        Returns the coordinates of the rows of A in the principal component space of the index.
+        """
+        m, norm = self._row_scaling(A)
+        AV = np.asarray(A @ self.components)
+        P = (AV - m[:,None] * np.sum(self.components, axis=0)[None,:]) / norm[:,None]
+        return P - self.mean @ self.components
+
+    def _pair_scores(self, A, cand):
+        # exact scores of every row of A against its own candidate rows of the reference
+        n, c = cand.shape
+        p = A.shape[1]
+        sA, qA = rnaseqTools.rowstats(A)
+        sB, qB = self.stats[0][cand], self.stats[1][cand]
+        dots = np.zeros(n * c)
+        # blocks of queries, so that the gathered rows stay small
+        step = max(1, int(2e7 / (c * A.shape[1])))
+        for start in range(0, n, step):
+            rows = np.arange(start, min(start+step, n))
+            pairs = np.arange(start*c, rows[-1]*c + c)
+            Bc = self.reference[cand[rows].ravel(),:]
+            Ar = A[np.repeat(rows, c),:]
+            if sparse.issparse(Bc):
+                dots[pairs] = np.asarray(Bc.multiply(Ar).sum(axis=1)).ravel()
+            elif sparse.issparse(Ar):
+                dots[pairs] = np.asarray(Ar.multiply(Bc).sum(axis=1)).ravel()
+            else:
+                dots[pairs] = np.einsum('ij,ij->i', Bc, np.asarray(Ar))
+        dots = dots.reshape(n, c)
+        if self.metric == 'euclidean':
+            return -(qA[:,None] + qB - 2*dots)
+        with np.errstate(all='ignore'):
+            ssA = np.maximum(qA - sA**2/p, 0)
+            ssB = np.maximum(qB - sB**2/p, 0)
+            S = (dots - sA[:,None] * sB / p) / np.sqrt(ssA[:,None] * ssB)
+        S[~np.isfinite(S)] = -np.inf
+        return S
+
+    def query(self, A, knn, candidates=None):
+        """
+        Approximate k nearest neighbors of the rows of A among the reference cells.
+        Returns ind and score like knn_exact.
+        """
+        if candidates is None:
+            candidates = self.candidates
+        c = min(knn * candidates, self.reference.shape[0])
+        cand = self.tree.query(self.project(A), k=c, return_distance=False)
+        S = self._pair_scores(A, cand)
+        best, S = _top_k(S, knn)
+        return np.take_along_axis(cand, best, axis=1), _final_scores(S, self.metric)
+
+    def recall(self, A, knn, candidates=None, batchsize=1000):
+        """
+        Fraction of the exact k nearest neighbors (by brute force) that the index finds
+        for the rows of A. Prints the recall and how much faster the index query is than
+        the brute-force search, and returns the recall.
+        """
+        t = time.perf_counter()
+        exact, _ = knn_exact(A, self.reference, knn, self.metric, batchsize, statsB=self.stats)
+        exactTime = time.perf_counter() - t
+        t = time.perf_counter()
+        approx, _ = self.query(A, knn, candidates)
+        queryTime = time.perf_counter() - t
+        hits = [np.intersect1d(exact[i], approx[i]).size for i in range(A.shape[0])]
+        recall = np.sum(hits) / exact.size
+        print('Recall@{} against brute force: {:.3f}, query speedup {:.1f}x ({:.3f} s vs {:.3f} s)'.format(
+            knn, recall, exactTime / queryTime, queryTime, exactTime))
+        return recall
+
+    def save(self, path):
+        """
+        Writes the index (not the reference itself) into the directory path,
+        e.g. next to the reference data or its ReferenceAtlas cache.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'components.npy'), self.components)
+        np.save(os.path.join(path, 'mean.npy'), self.mean)
+        with open(os.path.join(path, 'tree.pickle'), 'wb') as f:
+            pickle.dump({'tree': self.tree, 'metric': self.metric, 'candidates': self.candidates,
+                         'shape': self.reference.shape}, f, protocol=4)
+
+    @classmethod
+    def load(cls, path, reference):
+        """
+        Loads an index written by save() for the same reference.
+        """
+        with open(os.path.join(path, 'tree.pickle'), 'rb') as f:
+            saved = pickle.load(f)
+        index = cls(reference, saved['metric'], candidates=saved['candidates'], _build=False)
+        if index.reference.shape != tuple(saved['shape']):
+            raise ValueError('the index at ' + path + ' was built for a reference of shape {}'.format(saved['shape']))
+        index.tree = saved['tree']
+        index.components = np.load(os.path.join(path, 'components.npy'), mmap_mode='r')
+        index.mean = np.load(os.path.join(path, 'mean.npy'))
+        return index
@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+import rnaseqTools
+import datasets
+
+# the m1 object of patch-seq-data-load.ipynb
+houstonData = namedtuple('houstonData', datasets.HOUSTON_FIELDS)
+
+# the input files of the M1 data set in the data folder
+M1_FILES = {'meta': 'm1_patchseq_meta_data.csv',
+            'exons': 'm1_patchseq_exon_counts.csv.gz',
+            'introns': 'm1_patchseq_intron_counts.csv.gz',
+            'geneLengths': 'gene_lengths.txt',
+            'ephys': 'm1_patchseq_ephys_features.csv',
+            'morph': 'm1_patchseq_morph_features.csv',
+            'zProfiles': 'm1_patchseq_morph_zprofiles.csv'}
+
+# bump when the parsing changes, so that old caches are not used
+LOADER_VERSION = 1
+
+
+def _column(table, name):
+    # a column as a numpy object array, whatever string dtype pandas uses
+    return np.asarray(table[name].to_numpy(dtype=object), dtype=object)
+
+def read_meta(filename):
+    """
+    Reads the patch-seq meta data table and returns a dictionary with the houstonData fields
+    cells, layers, cre, yields, depth, thickness, traced, exclude, mice_ages and mice_cres.
+    """
+    meta = pd.read_csv(filename, sep='\t')
+    cells = _column(meta, 'Cell')
+    layers = _column(meta, 'Targeted layer').astype(str)
+    cre = _column(meta, 'Cre')
+    yields = _column(meta, 'Yield (pg/µl)')
+    yields = np.where(yields == '?', np.nan, yields).astype(float)
+    depth = _column(meta, 'Soma depth (µm)')
+    depth = np.where(depth == 'Slice Lost', np.nan, depth).astype(float)
+    thickness = _column(meta, 'Cortical thickness (µm)').astype(float)
+    thickness[thickness == 0] = np.nan
+    traced = _column(meta, 'Traced') == 'y'
+    exclude = _column(meta, 'Exclusion reasons').astype(str)
+    exclude[exclude == 'nan'] = ''
+
+    mice_names = _column(meta, 'Mouse')
+    mice_ages = meta['Mouse age'].to_numpy()
+    mice_cres = np.array([c if c[-1] != '+' and c[-1] != '-' else c[:-1] for c in cre])
+    return {'cells': cells, 'layers': layers, 'cre': cre, 'yields': yields, 'depth': depth,
+            'thickness': thickness, 'traced': traced, 'exclude': exclude,
+            'mice_ages': dict(zip(mice_names, mice_ages)), 'mice_cres': dict(zip(mice_names, mice_cres))}
+
+def read_counts(filename, n_jobs=1):
+    """
+    Reads a genes x cells count table straight into a sparse cells x genes CSR matrix
+    (see rnaseqTools.sparseload). Returns (counts, genes, cells).
+    """
+    counts, genes, cells = rnaseqTools.sparseload(filename, dtype=np.int64, n_jobs=n_jobs)
+    return counts.tocsr(), np.asarray(genes, dtype=object), np.asarray(cells, dtype=object)
+
+def read_gene_lengths(filename):
+    """
+    Returns the genes, exon lengths and intron lengths from gene_lengths.txt.
+    """
+    data = pd.read_csv(filename)
+    return _column(data, 'GeneID'), data['exon_bp'].to_numpy(), data['intron_bp'].to_numpy()
+
+def read_features(filename, lastcolumns=0):
+    """
+    Reads a cells x features table with a 'cell id' column (ephys, morphometrics, z-profiles)
+    and returns (feature names, cells, values), leaving out the last lastcolumns columns.
+    """
+    data = pd.read_csv(filename)
+    stop = data.shape[1] - lastcolumns
+    return data.columns[1:stop], _column(data, 'cell id'), data.iloc[:, 1:stop].to_numpy(dtype=float)
+
+def _align(cells, featureCells, values):
+    # rows of values in the order of cells, nan for cells without features
+    index = {c: i for i, c in enumerate(featureCells)}
+    rows = np.array([index.get(c, -1) for c in cells], dtype=int)
+    aligned = np.zeros((cells.size, values.shape[1])) * np.nan
+    aligned[rows >= 0] = values[rows[rows >= 0]]
+    return aligned, rows
+
+def fingerprint(filenames, **options):
+    """
+    Returns a hex digest of the paths, modification times and sizes of the files (and of the options),
+    so that a cache is rebuilt whenever one of the files changes, without reading them.
+    """
+    stats = []
+    for f in filenames:
+        s = os.stat(f)
+        stats.append([os.path.abspath(f), s.st_mtime_ns, s.st_size])
+    h = hashlib.sha1(json.dumps([LOADER_VERSION, stats, sorted(options.items())], default=str).encode())
+    return h.hexdigest()
+
+def load_m1(datadir='../data/', cachedir=None, n_jobs=4, mmap=False, files=None):
+    """
+    Loads the M1 patch-seq data set like patch-seq-data-load.ipynb and returns the m1 houstonData.
+
+    The independent files are read concurrently (the gzipped count tables are decompressed in
+    parallel threads and parsed in n_jobs processes, straight into sparse matrices). If cachedir is
+    given, the m1 object is stored there as a dataset (see datasets.py) keyed by the modification
+    times and sizes of the input files, and an unchanged data set is loaded from there without parsing.
+
+    Arguments:
+    - datadir: the folder with the files in M1_FILES
+    - cachedir: the cache folder (optional)
+    - n_jobs: the number of processes that parse the count tables
+    - mmap: memory-map the cached arrays instead of reading them (they are then read-only)
+    - files: file names to use instead of some of M1_FILES, e.g. {'meta': 'other_meta_data.csv'}
+
+    Returns:
+    - m1: houstonData with sparse CSR exon and intron counts (cells x genes)
+    """
+    files = dict(M1_FILES, **(files or {}))
+    paths = {name: os.path.join(datadir, f) for name, f in files.items()}
+
+    key = None
+    if cachedir is not None:
+        key = fingerprint([paths[name] for name in sorted(paths)])
+        path = os.path.join(cachedir, 'm1-' + key[:16])
+        if os.path.isdir(path):
+            cached = datasets.open_dataset(path, mmap=mmap)
+            return houstonData(**{field: cached[field].load() if isinstance(cached[field], datasets.Dataset)
+                                  else cached[field] for field in houstonData._fields})
+
+    # the two count tables take most of the time, so they start first
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        exons = executor.submit(read_counts, paths['exons'], n_jobs)
+        introns = executor.submit(read_counts, paths['introns'], n_jobs)
+        meta = executor.submit(read_meta, paths['meta'])
+        geneLengths = executor.submit(read_gene_lengths, paths['geneLengths'])
+        ephys = executor.submit(read_features, paths['ephys'])
+        morph = executor.submit(read_features, paths['morph'], 2)
+        zProfiles = executor.submit(read_features, paths['zProfiles'])
+
+        meta = meta.result()
+        cells = meta['cells']
+        exonCounts, genes, exonCells = exons.result()
+        intronCounts, intronGenes, intronCells = introns.result()
+        assert np.all(exonCells == cells) and np.all(intronCells == cells)
+        assert np.all(intronGenes == genes)
+        geneIDs, exonLengths, intronLengths = geneLengths.result()
+        assert np.all(geneIDs == genes)
+
+        ephysNames, ephysCells, ephysData = ephys.result()
+        ephysData, rows = _align(cells, ephysCells, ephysData)
+        assert np.all(np.isin(ephysCells, cells))
+        morphNames, morphCells, morphData = morph.result()
+        morphData, rows = _align(cells, morphCells, morphData)
+        assert np.sum(rows >= 0) == morphCells.size
+        _, zCells, zData = zProfiles.result()
+        zData, _ = _align(cells, zCells, zData)
+
+    m1 = houstonData(exonCounts=exonCounts, intronCounts=intronCounts, genes=genes,
+                     ephys=ephysData, ephysNames=np.array(ephysNames).astype(str),
+                     morphometrics=morphData, morphometricsNames=morphNames, zProfiles=zData,
+                     exonLengths=exonLengths, intronLengths=intronLengths, **meta)
+    if key is not None:
+        os.makedirs(cachedir, exist_ok=True)
+        datasets.save_dataset(m1, path)
+    return m1
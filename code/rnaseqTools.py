@@ -3,28 +3,252 @@ import pylab as plt
 import seaborn as sns
 import pandas as pd
 from scipy import sparse
+import os
+import io
+import gzip
+import shutil
+import hashlib
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
-def sparseload(filename, sep=',', dtype=float, chunksize=1000, index_col=0, droplastcolumns=0):
-    with open(filename) as file:
+def _numeric_block(lines, sep, dtype):
+    # fast path for plain numeric tables with the gene names in the first column: all values
+    # of the block are parsed by one np.fromstring call; None if the block is not that simple
+    parts = [line.rstrip('\r\n').split(sep, 1) for line in lines]
+    if any(len(p) != 2 or '"' in p[0] for p in parts):
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            values = np.fromstring(sep.join(p[1] for p in parts), dtype=dtype, sep=sep)
+        except ValueError:
+            # empty fields, nan or floats in an integer table: left to pandas
+            return None
+    ncols = parts[0][1].count(sep) + 1
+    if values.size != len(parts) * ncols or any(p[1].count(sep) + 1 != ncols for p in parts):
+        return None
+    return [p[0] for p in parts], sparse.csr_matrix(values.reshape(len(parts), ncols))
+
+
+def _sparse_block(lines, header, sep, index_col, dtype):
+    # parses one block of CSV lines (genes x cells) straight into a CSR piece
+    if index_col == 0 and len(sep) == 1:
+        block = _numeric_block(lines, sep, dtype)
+        if block is not None:
+            return block
+    chunk = pd.read_csv(io.StringIO(header + ''.join(lines)), sep=sep, index_col=index_col)
+    return list(chunk.index), sparse.csr_matrix(chunk.to_numpy(dtype=dtype))
+
+
+def _file_hash(filename, blocksize=1<<20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _sparse_cache_path(filename, cachedir, sep, dtype, index_col):
+    # the cache key depends on the file content and on everything that affects parsing
+    h = hashlib.sha1()
+    h.update(_file_hash(filename).encode())
+    h.update(repr((sep, np.dtype(dtype).str, index_col)).encode())
+    return os.path.join(cachedir, os.path.basename(filename) + '-' + h.hexdigest()[:16])
+
+
+def _save_arrays(path, arrays):
+    # writes every array as <name>.npy into the directory path, which appears atomically
+    tmp = path + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for name, a in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), a)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # somebody else has written the same cache in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _load_arrays(path, mmap_mode='r'):
+    return {f[:-4]: np.load(os.path.join(path, f), mmap_mode=mmap_mode)
+            for f in os.listdir(path) if f.endswith('.npy')}
+
+
+def _sparse_arrays(M, prefix=''):
+    # the component arrays of a CSR/CSC matrix, so that it can be memory-mapped later
+    return {prefix+'data': M.data, prefix+'indices': M.indices, prefix+'indptr': M.indptr,
+            prefix+'shape': np.array(M.shape)}
+
+
+def _sparse_from_arrays(arrays, format, prefix=''):
+    matrix = sparse.csc_matrix if format == 'csc' else sparse.csr_matrix
+    return matrix((arrays[prefix+'data'], arrays[prefix+'indices'], arrays[prefix+'indptr']),
+                  shape=tuple(arrays[prefix+'shape']), copy=False)
+
+
+def _table_columns(filename, sep, index_col):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as file:
+        header = file.readline()
+    return np.array(pd.read_csv(io.StringIO(header), sep=sep, index_col=index_col).columns)
+
+
+def _sparse_blocks(filename, sep, dtype, chunksize, index_col, n_jobs):
+    # yields (genes, CSR block) for consecutive blocks of `chunksize` rows of a genes x cells table
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as file:
+        header = file.readline()
+        blocks = iter(lambda: list(itertools.islice(file, chunksize)), [])
+        if n_jobs == 1:
+            for lines in blocks:
+                yield _sparse_block(lines, header, sep, index_col, dtype)
+        else:
+            # keep only a few blocks in flight so that the raw text is never all in memory
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                pending = deque()
+                for lines in itertools.chain(blocks, [None]):
+                    if lines is not None:
+                        pending.append(pool.submit(_sparse_block, lines, header, sep, index_col, dtype))
+                    while pending and (lines is None or len(pending) >= 2*n_jobs):
+                        yield pending.popleft().result()
+
+
+def sparseload(filename, sep=',', dtype=float, chunksize=1000, index_col=0, droplastcolumns=0,
+               cachedir=None, n_jobs=1):
+    """
+    Loads a genes x cells count table (optionally gzipped) and returns a tuple
+    (counts, genes, cells) with counts as a sparse cells x genes matrix.
+
+    The table is parsed in blocks of `chunksize` genes; with n_jobs > 1 the blocks
+    are parsed in a process pool. If `cachedir` is given, the parsed matrix is stored
+    there as binary arrays keyed by the hash of the file content, and later calls
+    memory-map the cache instead of parsing the table again.
+    """
+    path = None
+    if cachedir is not None:
+        path = _sparse_cache_path(filename, cachedir, sep, dtype, index_col)
+
+    if path is not None and os.path.isdir(path):
+        arrays = _load_arrays(path)
+        counts = _sparse_from_arrays(arrays, 'csc')
+        genes = np.array(arrays['genes'])
+        cells = np.array(arrays['cells']).astype(object)
+        print('Loaded from cache ' + path)
+    else:
+        cells = _table_columns(filename, sep, index_col)
         genes = []
         sparseblocks = []
-        for i,chunk in enumerate(pd.read_csv(filename, chunksize=chunksize, sep=sep, index_col=index_col)):
+        for g, sparseblock in _sparse_blocks(filename, sep, dtype, chunksize, index_col, n_jobs):
             print('.', end='', flush=True)
-            if i==0:
-                cells = np.array(chunk.columns)
-            genes.extend(list(chunk.index))
-            sparseblock = sparse.csr_matrix(chunk.values.astype(dtype))
-            sparseblocks.append([sparseblock])
-        counts = sparse.bmat(sparseblocks)
+            genes.extend(g)
+            sparseblocks.append(sparseblock)
         print(' done')
 
+        # stacking CSR pieces of the genes x cells table gives the CSC arrays of its transpose
+        counts = sparse.vstack(sparseblocks, format='csr').T
+        genes = np.array(genes)
+        del sparseblocks
+
+        if path is not None:
+            os.makedirs(cachedir, exist_ok=True)
+            # counts is cells x genes CSC
+            _save_arrays(path, dict(_sparse_arrays(counts), genes=genes.astype(str),
+                                    cells=np.array(cells).astype(str)))
+
     if droplastcolumns > 0:
         end = cells.size - droplastcolumns
         cells = cells[:end]
-        counts = counts[:,:end]
-        
-    return (counts.T, np.array(genes), cells)
+        counts = counts[:end,:]
+
+    return (counts, genes, cells)
+
+
+def _detection_sums(block, threshold):
+    # per-gene number of cells above threshold and sum of their log2 expression
+    if sparse.issparse(block) and block.format == 'csc':
+        # the entries of a gene are contiguous, so its sums are differences of cumulative sums
+        keep = block.data > threshold
+        logs = np.log2(np.where(keep, block.data, 1))
+        cumDetected = np.concatenate(([0], np.cumsum(keep)))
+        cumLog = np.concatenate(([0], np.cumsum(logs)))
+        nDetected = cumDetected[block.indptr[1:]] - cumDetected[block.indptr[:-1]]
+        sumLog = cumLog[block.indptr[1:]] - cumLog[block.indptr[:-1]]
+    elif sparse.issparse(block):
+        block = block.tocsr()
+        keep = block.data > threshold
+        columns = block.indices[keep]
+        nDetected = np.bincount(columns, minlength=block.shape[1])
+        sumLog = np.bincount(columns, weights=np.log2(block.data[keep]), minlength=block.shape[1])
+    else:
+        block = np.asarray(block)
+        mask = block > threshold
+        nDetected = np.sum(mask, axis=0)
+        sumLog = np.sum(np.log2(np.where(mask, block, 1)), axis=0)
+    return nDetected, sumLog
+
+
+class GeneStatistics:
+    """
+    Per-gene statistics used by geneSelection, accumulated in one pass over blocks of
+    cells so that the count matrix never has to be in memory at once.
+    Call update() with consecutive cells x genes blocks (sparse or dense, all genes),
+    or use gene_statistics_file() for a count table on disk, and pass the result
+    to geneSelection instead of the count matrix.
+    """
+    def __init__(self, threshold=0):
+        self.threshold = threshold
+        self.nCells = 0
+        self.nDetected = None
+        self.sumLog = None
+
+    def update(self, block):
+        nDetected, sumLog = _detection_sums(block, self.threshold)
+        if self.nDetected is None:
+            self.nDetected, self.sumLog = nDetected, sumLog
+        else:
+            self.nDetected = self.nDetected + nDetected
+            self.sumLog = self.sumLog + sumLog
+        self.nCells += block.shape[0]
+        return self
+
+    def rates(self):
+        """
+        Returns the frequency of zero (near-zero) expression and the mean log2 nonzero expression.
+        """
+        zeroRate = 1 - self.nDetected / self.nCells
+        meanExpr = np.zeros_like(zeroRate) * np.nan
+        detected = self.nDetected > 0
+        meanExpr[detected] = self.sumLog[detected] / self.nDetected[detected]
+        return zeroRate, meanExpr
+
+
+def gene_statistics_file(filename, threshold=0, sep=',', chunksize=1000, index_col=0,
+                         droplastcolumns=0, n_jobs=1):
+    """
+    GeneStatistics of a genes x cells count table, read in blocks of genes like in
+    sparseload but without keeping the counts. Returns (stats, genes).
+    """
+    cells = _table_columns(filename, sep, index_col)
+    end = cells.size - droplastcolumns
+    genes = []
+    nDetected = []
+    sumLog = []
+    for g, block in _sparse_blocks(filename, sep, float, chunksize, index_col, n_jobs):
+        print('.', end='', flush=True)
+        # every block has all cells of its genes, so its statistics are final
+        d, s = _detection_sums(block[:,:end].T, threshold)
+        genes.extend(g)
+        nDetected.append(d)
+        sumLog.append(s)
+    print(' done')
+
+    stats = GeneStatistics(threshold)
+    stats.nCells = end
+    stats.nDetected = np.concatenate(nDetected)
+    stats.sumLog = np.concatenate(sumLog)
+    return stats, np.array(genes)
 
 
 def geneSelection(data, threshold=0, atleast=10, 
@@ -32,36 +256,30 @@ def geneSelection(data, threshold=0, atleast=10,
                   plot=True, markers=None, genes=None, figsize=(6,3.5),
                   markeroffsets=None, labelsize=10, alpha=1):
     
-    if sparse.issparse(data):
-        zeroRate = 1 - np.squeeze(np.array((data>threshold).mean(axis=0)))
-        A = data.multiply(data>threshold)
-        A.data = np.log2(A.data)
-        meanExpr = np.zeros_like(zeroRate) * np.nan
-        detected = zeroRate < 1
-        meanExpr[detected] = np.squeeze(np.array(A[:,detected].mean(axis=0))) / (1-zeroRate[detected])
+    # data can also be a GeneStatistics accumulator computed with the same threshold
+    if isinstance(data, GeneStatistics):
+        stats = data
     else:
-        zeroRate = 1 - np.mean(data>threshold, axis=0)
-        meanExpr = np.zeros_like(zeroRate) * np.nan
-        detected = zeroRate < 1
-        mask = data[:,detected]>threshold
-        logs = np.zeros_like(data[:,detected]) * np.nan
-        logs[mask] = np.log2(data[:,detected][mask])
-        meanExpr[detected] = np.nanmean(logs, axis=0)
+        stats = GeneStatistics(threshold).update(data)
+    zeroRate, meanExpr = stats.rates()
 
-    lowDetection = np.array(np.sum(data>threshold, axis=0)).squeeze() < atleast
+    lowDetection = stats.nDetected < atleast
     zeroRate[lowDetection] = np.nan
     meanExpr[lowDetection] = np.nan
             
+    # the offset search only needs the genes that have statistics
+    nonan = np.where(~np.isnan(zeroRate))[0]
+    zeroRateKept = zeroRate[nonan]
+    meanExprKept = meanExpr[nonan]
     if n is not None:
         up = 10
         low = 0
         for t in range(100):
-            nonan = ~np.isnan(zeroRate)
-            selected = np.zeros_like(zeroRate).astype(bool)
-            selected[nonan] = zeroRate[nonan] > np.exp(-decay*(meanExpr[nonan] - xoffset)) + yoffset
-            if np.sum(selected) == n:
+            tested = xoffset
+            nselected = np.sum(zeroRateKept > np.exp(-decay*(meanExprKept - tested)) + yoffset)
+            if nselected == n:
                 break
-            elif np.sum(selected) < n:
+            elif nselected < n:
                 up = xoffset
                 xoffset = (xoffset + low)/2
             else:
@@ -69,9 +287,9 @@ def geneSelection(data, threshold=0, atleast=10,
                 xoffset = (xoffset + up)/2
         print('Chosen offset: {:.2f}'.format(xoffset))
     else:
-        nonan = ~np.isnan(zeroRate)
-        selected = np.zeros_like(zeroRate).astype(bool)
-        selected[nonan] = zeroRate[nonan] > np.exp(-decay*(meanExpr[nonan] - xoffset)) + yoffset
+        tested = xoffset
+    selected = np.zeros_like(zeroRate).astype(bool)
+    selected[nonan] = zeroRateKept > np.exp(-decay*(meanExprKept - tested)) + yoffset
                 
     if plot:
         if figsize is not None:
@@ -136,46 +354,332 @@ def corr2(A,B):
         C = np.dot(A, B.T) / np.sqrt(np.dot(ssA,ssB.T))
     return C
 
+# Row sums and row sums of squares, accumulated in float64
+def rowstats(A):
+    if sparse.issparse(A):
+        s = np.asarray(A.sum(axis=1, dtype=np.float64)).ravel()
+        q = np.asarray(A.multiply(A).sum(axis=1, dtype=np.float64)).ravel()
+    else:
+        s = np.sum(A, axis=1, dtype=np.float64)
+        q = np.einsum('ij,ij->i', A, A, dtype=np.float64)
+    return s, q
+
+# Computing the matrix of correlations without centering the inputs, using
+# cov(a,b) = sum(a*b) - p*mean(a)*mean(b). A and B can be sparse and stay sparse,
+# so only the output matrix is dense; dtype=np.float32 halves its memory.
+# Gives the same result as corr2 up to rounding. statsB can be passed to reuse
+# the row sums and row sums of squares of B (see ReferenceAtlas).
+def corr2_sparse(A, B, dtype=float, statsB=None):
+    if sparse.issparse(A):
+        A = A.astype(dtype, copy=False)
+    else:
+        A = np.asarray(A, dtype=dtype)
+    if sparse.issparse(B):
+        B = B.astype(dtype, copy=False)
+    else:
+        B = np.asarray(B, dtype=dtype)
+
+    p = A.shape[1]
+    sA, qA = rowstats(A)
+    sB, qB = rowstats(B) if statsB is None else statsB
+    mA, mB = sA / p, sB / p
+    ssA, ssB = qA - p * mA**2, qB - p * mB**2
+    # constant rows have zero variance, do not let rounding make it positive
+    ssA[ssA <= 1e-12 * qA] = 0
+    ssB[ssB <= 1e-12 * qB] = 0
+
+    if sparse.issparse(A) and sparse.issparse(B):
+        C = (A @ B.T).toarray()
+    elif sparse.issparse(B):
+        C = np.asarray(B @ A.T).T
+    else:
+        C = np.asarray(A @ B.T)
+    C = np.ascontiguousarray(C, dtype=dtype)
+
+    # this ignores the NaN warnings. The result can have nans!
+    with np.errstate(all='ignore'):
+        C -= (p * mA).astype(dtype)[:,None] * mB.astype(dtype)[None,:]
+        C /= np.sqrt(ssA).astype(dtype)[:,None]
+        C /= np.sqrt(ssB).astype(dtype)[None,:]
+    # like in corr2, correlations with a constant row are undefined
+    C[ssA == 0, :] = np.nan
+    C[:, ssB == 0] = np.nan
+    return C
+
+def _scale_columns(M, lengths, dtype):
+    if sparse.issparse(M):
+        M = sparse.csr_matrix(M, dtype=dtype)
+        if lengths is not None:
+            M = M @ sparse.diags((1 / lengths).astype(dtype))
+    else:
+        M = np.asarray(M, dtype=dtype)
+        if lengths is not None:
+            M = M / lengths.astype(dtype)
+    return M
+
+# Expression levels log2(exon + intron + 1), with counts optionally normalized by
+# exon/intron lengths in kilobases. Sparse counts stay sparse because log2(0+1) = 0.
+def log_expression(counts, intronCounts=None, normalize=False,
+                   exonLengths=None, intronLengths=None, dtype=float):
+    X = _scale_columns(counts, exonLengths/1000 if normalize else None, dtype)
+    if intronCounts is not None:
+        Xi = _scale_columns(intronCounts, (intronLengths+.001)/1000 if normalize else None, dtype)
+        if sparse.issparse(X) != sparse.issparse(Xi):
+            X = X.toarray() if sparse.issparse(X) else X
+            Xi = Xi.toarray() if sparse.issparse(Xi) else Xi
+        X = X + Xi
+    if sparse.issparse(X):
+        X = X.log1p()
+        X.data /= np.log(2)
+    else:
+        X = np.log2(X + 1)
+    return X
+
+# Computing the matrix of correlations when every column is counted w times
+# (e.g. w are the multiplicities of a bootstrap resample of the columns).
+# A is dense, B can be sparse. B2 can be passed to reuse the elementwise squares of B between calls.
+def corr2_weighted(A, B, w, B2=None):
+    if B2 is None:
+        B2 = B.power(2) if sparse.issparse(B) else B**2
+    n = np.sum(w)
+    mA = A @ w / n
+    mB = B @ w / n
+    ssA = (A**2) @ w - n * mA**2
+    ssB = B2 @ w - n * mB**2
+    # the rows of A x rows of B terms are combined in place, with one temporary of that size
+    C = np.ascontiguousarray(np.asarray(B @ (A * w).T).T)
+    D = np.outer(mA, mB)
+    D *= n
+    C -= D
+    np.multiply.outer(ssA, ssB, out=D)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        np.sqrt(D, out=D)
+        C /= D
+    return C
+
+# The parts of corr2_weighted_batch that depend only on B and W: the weighted means and sums
+# of squares of the rows of B for every row of W, and (with copies=True) the weighted copies
+# of B, r x rows of B x G. Pass them as weighted= to reuse them for many A; slicing every
+# array along its first axis gives the same for a subset of the rows of W.
+def weighted_rows(B, W, copies=True):
+    n = W.sum(axis=1)
+    mB = (B @ W.T).T / n[:,None]
+    ssB = (B**2 @ W.T).T - n[:,None] * mB**2
+    BW = W[:,None,:] * B[None,:,:] if copies else None
+    return BW, mB, ssB
+
+# Correlations for several column weightings at once: C[r] equals corr2_weighted(A, B, W[r])
+# for every row r of W. A can be sparse, B is dense; the weighted copies of B for all
+# rows of W are stacked so that A is multiplied only once. weighted can be passed to reuse
+# the output of weighted_rows(B, W) (its copies can be None).
+def corr2_weighted_batch(A, B, W, weighted=None):
+    r, G = W.shape
+    n = W.sum(axis=1)
+    BW, mB, ssB = weighted_rows(B, W) if weighted is None else weighted
+    if BW is None:
+        BW = W[:,None,:] * B[None,:,:]
+    A2 = A.power(2) if sparse.issparse(A) else A**2
+    mA = np.asarray(A @ W.T).T / n[:,None]
+    ssA = np.asarray(A2 @ W.T).T - n[:,None] * mA**2
+    P = np.asarray(A @ BW.reshape(r*B.shape[0], G).T).reshape(A.shape[0], r, B.shape[0]).transpose(1, 0, 2)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        C = (P - n[:,None,None] * mA[:,:,None] * mB[:,None,:]) / np.sqrt(ssA[:,:,None] * ssB[:,None,:])
+    return C
+
+# Positions in the reference atlas, aggregated over the knn most correlated reference cells.
+# aggregate can be 'median' (default), 'mean', or 'weighted' (mean weighted by the correlations).
+# All rows are handled at once with one gather and one reduction.
+def knn_positions(C, knn, referenceAtlas, aggregate='median'):
+    ind = np.argpartition(C, -knn)[:, -knn:]
+    return aggregate_positions(ind, np.take_along_axis(C, ind, axis=1), referenceAtlas, aggregate)
+
+# Same for known neighbor indices ind and their correlations corrs (both n x knn)
+def aggregate_positions(ind, corrs, referenceAtlas, aggregate='median'):
+    neighbors = referenceAtlas[ind]
+    if aggregate == 'median':
+        return np.median(neighbors, axis=1)
+    elif aggregate == 'mean':
+        return np.mean(neighbors, axis=1)
+    elif aggregate == 'weighted':
+        weights = np.maximum(corrs, 0)
+        weights[np.isnan(weights)] = 0
+        # fall back to equal weights where no neighbor is positively correlated
+        weights[np.sum(weights, axis=1) == 0, :] = 1
+        weights /= np.sum(weights, axis=1, keepdims=True)
+        return np.einsum('ik,ikd->id', weights, neighbors)
+    else:
+        raise ValueError("aggregate must be 'median', 'mean' or 'weighted'")
+
+def _bootstrap_tile(X, T, T2, referenceAtlas, knn, batch, seed, aggregate):
+    # resampling genes with replacement is the same as counting every gene as many
+    # times as it was drawn, so the resampled reference never has to be copied
+    G = T.shape[1]
+    rng = np.random.default_rng(seed)
+    w = np.bincount(rng.integers(0, G, G), minlength=G).astype(T.dtype)
+    Xb = X[batch,:]
+    if sparse.issparse(Xb):
+        Xb = Xb.toarray()
+    C_boot = corr2_weighted(Xb, T, w, B2=T2)
+    return knn_positions(C_boot, knn, referenceAtlas, aggregate)
+
+# Indices of the common genes of two gene lists (sorted by gene name).
+# Genes are looked up in a dictionary; for duplicated genes the first occurrence is used.
+def common_genes(genes1, genes2):
+    index1 = _gene_index(genes1)
+    index2 = _gene_index(genes2)
+    gg = sorted(set(index1) & set(index2))
+    return np.array([index1[g] for g in gg], dtype=int), np.array([index2[g] for g in gg], dtype=int)
+
+def _gene_index(genes):
+    index = {}
+    for i, g in enumerate(genes):
+        index.setdefault(g, i)
+    return index
+
+def _content_hash(*items):
+    h = hashlib.sha1()
+    for item in items:
+        if item is None:
+            h.update(b'None')
+        elif sparse.issparse(item):
+            h.update(item.format.encode() + repr(item.shape).encode())
+            for a in [item.data, item.indices, item.indptr]:
+                h.update(np.ascontiguousarray(a).tobytes())
+        elif isinstance(item, np.ndarray) and item.dtype != object:
+            h.update(item.dtype.str.encode() + repr(item.shape).encode())
+            h.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, (np.ndarray, list, tuple)):
+            h.update('\n'.join(map(str, item)).encode())
+        else:
+            h.update(repr(item).encode())
+    return h.hexdigest()
+
+
+class ReferenceAtlas:
+    """
+    Reference data preprocessed once for map_to_tsne and map_to_clusters: the
+    log2 expression levels (normalized by exon/intron lengths if normalize=True),
+    a dictionary index of the genes, and the per-cell row sums and sums of squares
+    that corr2_sparse needs for centering. Pass it as referenceCounts to the mapping
+    functions; referenceGenes, referenceIntronCounts and normalizeReference are
+    then ignored, and only the new cells are processed in every call.
+    
+    Arguments:
+    - counts: reference exon (or UMI) counts, cells x genes, sparse or dense
+    - genes: the gene names of the columns of counts
+    - intronCounts: reference intron counts, optional
+    - normalize: True - normalize the counts by exonLengths/intronLengths (per kilobase)
+    - exonLengths, intronLengths: gene lengths aligned with genes, used if normalize=True
+    - dtype: float or np.float32
+    - cachedir: if given, the preprocessed reference is stored there keyed by the content
+                of all inputs and memory-mapped by later instances with the same inputs
+    """
+    def __init__(self, counts, genes, intronCounts=None, normalize=False,
+                 exonLengths=None, intronLengths=None, dtype=float, cachedir=None):
+        self.genes = np.asarray(genes)
+        self.geneIndex = _gene_index(self.genes)
+        self.dtype = np.dtype(dtype)
+        self._stats = {}
+
+        path = None
+        if cachedir is not None:
+            key = _content_hash(counts, self.genes, intronCounts, normalize,
+                                exonLengths, intronLengths, self.dtype.str)
+            path = os.path.join(cachedir, 'reference-' + key[:16])
+
+        if path is not None and os.path.isdir(path):
+            arrays = _load_arrays(path)
+            if 'expression' in arrays:
+                self.expression = arrays['expression']
+            else:
+                self.expression = _sparse_from_arrays(arrays, 'csc')
+            stats = (np.array(arrays['rowsums']), np.array(arrays['rowsquares']))
+        else:
+            self.expression = log_expression(counts, intronCounts, normalize,
+                                             exonLengths, intronLengths, dtype)
+            if sparse.issparse(self.expression):
+                # columns are selected for every new gene set, so keep it column-major
+                self.expression = self.expression.tocsc()
+            stats = rowstats(self.expression)
+            if path is not None:
+                os.makedirs(cachedir, exist_ok=True)
+                if sparse.issparse(self.expression):
+                    arrays = _sparse_arrays(self.expression)
+                else:
+                    arrays = {'expression': self.expression}
+                _save_arrays(path, dict(arrays, rowsums=stats[0], rowsquares=stats[1]))
+        self._stats[None] = stats
+
+    def common_genes(self, genes):
+        """
+        Returns the indices of the common genes in the reference and in genes.
+        """
+        newIndex = _gene_index(genes)
+        gg = sorted(set(self.geneIndex) & set(newIndex))
+        return (np.array([self.geneIndex[g] for g in gg], dtype=int),
+                np.array([newIndex[g] for g in gg], dtype=int))
+
+    def subset(self, refGenes):
+        """
+        Returns the expression levels for the reference genes refGenes and their row stats.
+        The full gene set in its original order is returned without a copy.
+        """
+        if np.array_equal(refGenes, np.arange(self.genes.size)):
+            return self.expression, self._stats[None]
+        T = self.expression[:, refGenes]
+        key = hashlib.sha1(np.ascontiguousarray(refGenes).tobytes()).hexdigest()
+        if key not in self._stats:
+            self._stats[key] = rowstats(T)
+        return T, self._stats[key]
+
+
+# Preprocessing shared by map_to_tsne and map_to_clusters
+def _mapping_inputs(referenceCounts, referenceGenes, newCounts, newGenes,
+                    referenceIntronCounts, newIntronCounts, normalizeNew, normalizeReference,
+                    newExonLengths, newIntronLengths, dtype):
+    if isinstance(referenceCounts, ReferenceAtlas):
+        reference = referenceCounts
+        refGenes, newGenes = reference.common_genes(newGenes)
+    else:
+        refGenes, newGenes = common_genes(referenceGenes, newGenes)
+
+    exonLengths = newExonLengths[newGenes] if newExonLengths is not None else None
+    intronLengths = newIntronLengths[newGenes] if newIntronLengths is not None else None
+    X = log_expression(newCounts[:,newGenes],
+                       newIntronCounts[:,newGenes] if newIntronCounts is not None else None,
+                       normalizeNew, exonLengths, intronLengths, dtype)
+
+    if not isinstance(referenceCounts, ReferenceAtlas):
+        # the reference lengths come from the new data, so only the common genes can be used
+        reference = ReferenceAtlas(referenceCounts[:,refGenes], np.asarray(referenceGenes)[refGenes],
+                                   referenceIntronCounts[:,refGenes] if referenceIntronCounts is not None else None,
+                                   normalizeReference, exonLengths, intronLengths, dtype)
+        refGenes = np.arange(refGenes.size)
+    T, Tstats = reference.subset(refGenes)
+    return X, T, Tstats, refGenes
+
+
 def map_to_tsne(referenceCounts, referenceGenes, newCounts, newGenes, referenceAtlas, 
                 bootstrap = False, knn = 10, nrep = 100, seed = None, batchsize = 1000,
 				verbose = 1,
                 referenceIntronCounts = None, newIntronCounts = None,
                 normalizeNew = False, normalizeReference = False,
-                newExonLengths = None, newIntronLengths = None):
-    gg = sorted(list(set(referenceGenes) & set(newGenes)))
+                newExonLengths = None, newIntronLengths = None,
+                n_jobs = 1, maxmemory = 2**30, aggregate = 'median', dtype = float,
+                index = None):
+    X, T, Tstats, refGenes = _mapping_inputs(referenceCounts, referenceGenes, newCounts, newGenes,
+                                             referenceIntronCounts, newIntronCounts, normalizeNew, normalizeReference,
+                                             newExonLengths, newIntronLengths, dtype)
     if verbose > 0:
-        print('Using a common set of ' + str(len(gg)) + ' genes.')
-    
-    newGenes = [np.where(newGenes==g)[0][0] for g in gg]
-    refGenes = [np.where(referenceGenes==g)[0][0] for g in gg]
-    
-    X = newCounts[:,newGenes]
-    if sparse.issparse(X):
-        X = np.array(X.todense())
-    if normalizeNew:
-        X = X / (newExonLengths[newGenes]/1000)
-    if newIntronCounts is not None:
-        Xi = newIntronCounts[:, newGenes]
-        if sparse.issparse(Xi):
-            Xi = np.array(Xi.todense())
-        if normalizeNew:
-            Xi = Xi / ((newIntronLengths[newGenes]+.001)/1000)
-        X = X + Xi
-    X = np.log2(X + 1)
-    
-    T = referenceCounts[:,refGenes]
-    if sparse.issparse(T):
-        T = np.array(T.todense())
-    if normalizeReference:
-        T = T / (newExonLengths[newGenes]/1000)
-    if referenceIntronCounts is not None:
-        Ti = referenceIntronCounts[:, refGenes]
-        if sparse.issparse(Ti):
-            Ti = np.array(Ti.todense())
-        if normalizeReference:
-            Ti = Ti / ((newIntronLengths[newGenes]+.001)/1000)
-        T = T + Ti
-    T = np.log2(T + 1)
+        print('Using a common set of ' + str(X.shape[1]) + ' genes.')
+
+    # a neighborSearch.NeighborIndex built on the ReferenceAtlas replaces the brute-force search
+    if index is not None:
+        if not isinstance(referenceCounts, ReferenceAtlas) or refGenes.size != index.reference.shape[1]:
+            raise ValueError('index needs a ReferenceAtlas as referenceCounts whose genes are all in newGenes')
+        Xindex = X[:, np.argsort(refGenes)]
     
     n = X.shape[0]
     assignmentPositions = np.zeros((n, referenceAtlas.shape[1]))
@@ -186,28 +690,50 @@ def map_to_tsne(referenceCounts, referenceGenes, newCounts, newGenes, referenceA
         if (batchCount > 1) and (verbose > 0):
             print('.', end='', flush=True) 
         batch = np.arange(b*batchsize, np.minimum((b+1)*batchsize, n))
-        C = corr2(X[batch,:], T)
-        ind = np.argpartition(C, -knn)[:, -knn:]
-        for i in range(batch.size):
-            assignmentPositions[batch[i],:] = np.median(referenceAtlas[ind[i,:],:], axis=0)
+        if index is not None:
+            ind, corrs = index.query(Xindex[batch,:], knn)
+            assignmentPositions[batch,:] = aggregate_positions(ind, corrs, referenceAtlas, aggregate)
+        else:
+            C = corr2_sparse(X[batch,:], T, dtype, Tstats)
+            assignmentPositions[batch,:] = knn_positions(C, knn, referenceAtlas, aggregate)
     if (batchCount > 1) and (verbose > 0):
         print(' done', flush=True) 
     
-    # Note: currently bootstrapping does not support batchsize
     if bootstrap:
-        if seed is not None:
-            np.random.seed(seed)
+        # every replicate gets its own random stream, so the result does not
+        # depend on the tiling or on the number of workers
+        seeds = np.random.SeedSequence(seed).spawn(nrep)
         assignmentPositions_boot = np.zeros((n, referenceAtlas.shape[1], nrep))
+
+        # tile size: the squared reference is shared, every cell in a tile needs its dense
+        # copy, its weighted and squared copies (3 x genes), a row of correlations and the
+        # temporary of the same size in corr2_weighted (2 x reference cells), and the int64
+        # indices of argpartition in knn_positions (reference cells)
+        R, G = T.shape
+        T2 = T.power(2) if sparse.issparse(T) else T**2
+        T2bytes = T2.data.nbytes if sparse.issparse(T2) else T2.nbytes
+        perCell = np.dtype(dtype).itemsize * (3*G + 2*R) + np.dtype(np.int64).itemsize * R
+        available = maxmemory - T2bytes
+        if available < n_jobs * perCell:
+            warnings.warn('maxmemory={} does not fit the squared reference ({} bytes) and one cell per job; '
+                          'the bootstrap tiles are sized as if it were not counted'.format(maxmemory, T2bytes))
+            available = maxmemory
+        bootBatchsize = int(available / (n_jobs * perCell))
+        bootBatchsize = max(1, min(bootBatchsize, batchsize, n))
+        batches = [np.arange(b, np.minimum(b+bootBatchsize, n)) for b in range(0, n, bootBatchsize)]
+        tiles = [(rep, batch) for rep in range(nrep) for batch in batches]
+
+        def run(tile):
+            rep, batch = tile
+            assignmentPositions_boot[batch,:,rep] = _bootstrap_tile(
+                X, T, T2, referenceAtlas, knn, batch, seeds[rep], aggregate)
+            if verbose>0:
+                print('.', end='', flush=True)
+
         if verbose>0:
             print('Bootstrapping', end='', flush=True)
-        for rep in range(nrep):
-            if verbose>0:
-                print('.', end='')
-            bootgenes = np.random.choice(T.shape[1], T.shape[1], replace=True)
-            C_boot = corr2(X[:,bootgenes],T[:,bootgenes])
-            ind = np.argpartition(C_boot, -knn)[:, -knn:]
-            for i in range(X.shape[0]):
-                assignmentPositions_boot[i,:,rep] = np.median(referenceAtlas[ind[i,:],:], axis=0)
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(run, tiles))
         if verbose>0:
             print(' done')      
         return (assignmentPositions, assignmentPositions_boot)
@@ -215,6 +741,70 @@ def map_to_tsne(referenceCounts, referenceGenes, newCounts, newGenes, referenceA
         return assignmentPositions
 
 
+# Cluster means of the rows of T as one product with the (sparse) cluster membership matrix.
+# Clusters outside 0..K-1 are left out, empty clusters have zero means.
+def cluster_means(T, referenceClusters, K, dtype=float):
+    referenceClusters = np.asarray(referenceClusters).astype(int)
+    members = np.where((referenceClusters >= 0) & (referenceClusters < K))[0]
+    membership = sparse.csr_matrix((np.ones(members.size, dtype=dtype), (referenceClusters[members], members)),
+                                   shape=(K, T.shape[0]))
+    sizes = np.bincount(referenceClusters[members], minlength=K)
+    means = membership @ T
+    means = means.toarray() if sparse.issparse(means) else np.asarray(means)
+    means[sizes > 0] /= sizes[sizes > 0, None]
+    return means
+
+# Gene weights of nrep bootstrap replicates over G genes: resampling genes with replacement is
+# the same as weighting every gene by the number of times it was drawn. rng is a
+# np.random.Generator, or the np.random module for the global random state.
+def bootstrap_weights(G, nrep, rng=np.random, dtype=float):
+    return np.array([np.bincount(rng.choice(G, G, replace=True), minlength=G)
+                     for rep in range(nrep)], dtype=dtype)
+
+# Assigns the rows of X to the most correlated row of means (nan if all correlations are nan).
+# statsMeans can be passed to reuse the row stats of means (see rowstats). With bootstrap
+# weights W (see bootstrap_weights) the replicates are computed in batches of weighted
+# correlations instead of correlating a resampled copy per replicate, and the fraction of
+# replicates that assign every row to every cluster is returned as well (otherwise None),
+# leaving out replicates in which all its correlations are nan;
+# weighted can be the output of weighted_rows(means, W), computed once for many X.
+# Returns the assignments, the fractions and the correlations with the means.
+def assign_to_means(X, means, statsMeans=None, W=None, dtype=float, maxmemory=2**30, verbose=True,
+                    weighted=None):
+    Cmeans = corr2_sparse(X, means, dtype, statsMeans)
+    allnans = np.sum(np.isnan(Cmeans), axis=1) == Cmeans.shape[1]
+    clusterAssignment = np.zeros(Cmeans.shape[0]) * np.nan
+    clusterAssignment[~allnans] = np.nanargmax(Cmeans[~allnans,:], axis=1)
+    if W is None:
+        return clusterAssignment, None, Cmeans
+
+    (n, K), (nrep, G) = Cmeans.shape, W.shape
+    repBatch = int(maxmemory / (np.dtype(dtype).itemsize * (K*G + 2*n*K)))
+    repBatch = max(1, min(repBatch, nrep))
+    clusterAssignment_boot = np.zeros((n, nrep), dtype=int)
+    for start in range(0, nrep, repBatch):
+        if verbose:
+            print('.', end='', flush=True) 
+        reps = slice(start, start+repBatch)
+        Cmeans_boot = corr2_weighted_batch(X, means, W[reps], None if weighted is None else
+                                           tuple(w[reps] if w is not None else None for w in weighted))
+        nans = np.isnan(Cmeans_boot)
+        Cmeans_boot[nans] = -np.inf
+        assignment = np.argmax(Cmeans_boot, axis=2)
+        # replicates without any correlation (e.g. no expressed gene drawn) assign nothing
+        assignment[np.all(nans, axis=2)] = -1
+        clusterAssignment_boot[:, start:start+repBatch] = assignment.T
+    if verbose:
+        print(' done')
+    
+    # assignment frequencies of every cell among the replicates that assign it, counted with
+    # one bincount (zeros for cells that are not assigned)
+    cells, reps = np.where((clusterAssignment_boot >= 0) & ~allnans[:,None])
+    counts = np.bincount(cells*K + clusterAssignment_boot[cells, reps], minlength=n*K).reshape(n, K)
+    assigned = np.bincount(cells, minlength=n)
+    return clusterAssignment, counts / np.maximum(assigned, 1)[:,None], Cmeans
+
+
 def map_to_clusters(referenceCounts, referenceGenes,
                     newCounts, newGenes, 
                     referenceClusters, referenceClusterNames=[], cellNames=[],
@@ -222,76 +812,29 @@ def map_to_clusters(referenceCounts, referenceGenes,
                     returnCmeans = False, totalClusters = None,
                     referenceIntronCounts = None, newIntronCounts = None,
                     normalizeNew = False, normalizeReference = False,
-                    newExonLengths = None, newIntronLengths = None):
+                    newExonLengths = None, newIntronLengths = None, dtype = float,
+                    maxmemory = 2**30):
 
-    gg = sorted(list(set(referenceGenes) & set(newGenes)))
-    print('Using a common set of ' + str(len(gg)) + ' genes.')
-    
-    newGenes = [np.where(newGenes==g)[0][0] for g in gg]
-    refGenes = [np.where(referenceGenes==g)[0][0] for g in gg]
-    
-    X = newCounts[:,newGenes]
-    if sparse.issparse(X):
-        X = np.array(X.todense())
-    if normalizeNew:
-        X = X / (newExonLengths[newGenes]/1000)
-    if newIntronCounts is not None:
-        Xi = newIntronCounts[:, newGenes]
-        if sparse.issparse(Xi):
-            Xi = np.array(Xi.todense())
-        if normalizeNew:
-            Xi = Xi / ((newIntronLengths[newGenes]+.001)/1000)
-        X = X + Xi
-    X = np.log2(X + 1)
-    
-    T = referenceCounts[:,refGenes]
-    if sparse.issparse(T):
-        T = np.array(T.todense())
-    if normalizeReference:
-        T = T / (newExonLengths[newGenes]/1000)
-    if referenceIntronCounts is not None:
-        Ti = referenceIntronCounts[:, refGenes]
-        if sparse.issparse(Ti):
-            Ti = np.array(Ti.todense())
-        if normalizeReference:
-            Ti = Ti / ((newIntronLengths[newGenes]+.001)/1000)
-        T = T + Ti
-    T = np.log2(T + 1)
+    X, T, Tstats, refGenes = _mapping_inputs(referenceCounts, referenceGenes, newCounts, newGenes,
+                                             referenceIntronCounts, newIntronCounts, normalizeNew, normalizeReference,
+                                             newExonLengths, newIntronLengths, dtype)
+    print('Using a common set of ' + str(X.shape[1]) + ' genes.')
     
     if totalClusters is not None:
         K = totalClusters
     else:
         K = np.max(referenceClusters) + 1
-    means = np.zeros((K, T.shape[1]))
-    for c in range(K):
-        if np.sum(referenceClusters==c) > 0:
-            means[c,:] = np.mean(T[referenceClusters==c,:], axis=0)
+    means = cluster_means(T, referenceClusters, K, dtype)
 
-    Cmeans = corr2(X, means)
-    allnans = np.sum(np.isnan(Cmeans), axis=1) == Cmeans.shape[1]
-    clusterAssignment = np.zeros(Cmeans.shape[0]) * np.nan
-    clusterAssignment[~allnans] = np.nanargmax(Cmeans[~allnans,:], axis=1)
-    
+    W = None
     if bootstrap:
         if seed is not None:
             np.random.seed(seed)
-            
-        clusterAssignment_boot = np.zeros((X.shape[0], nrep), dtype=int)
-        for rep in range(nrep):
-            print('.', end='', flush=True) 
-            bootgenes = np.random.choice(T.shape[1], T.shape[1], replace=True)
-            Cmeans_boot = corr2(X[:,bootgenes], means[:,bootgenes])
-            m = np.zeros(Cmeans.shape[0]) * np.nan
-            m[~allnans] = np.nanargmax(Cmeans_boot[~allnans,:], axis=1)
-            clusterAssignment_boot[:,rep] = m
-        print(' done')
-        
-        clusterAssignment_matrix = np.zeros((X.shape[0], K))
-        for cell in range(X.shape[0]):
-            mapsto, mapsto_counts = np.unique(clusterAssignment_boot[cell,:], return_counts=True)
-            for i,m in enumerate(mapsto):
-                clusterAssignment_matrix[cell, m] = mapsto_counts[i] / nrep
+        W = bootstrap_weights(T.shape[1], nrep, np.random, dtype)
+    clusterAssignment, clusterAssignment_matrix, Cmeans = assign_to_means(X, means, W=W, dtype=dtype,
+                                                                          maxmemory=maxmemory)
     
+    if bootstrap:
         if verbose:
             for rownum,row in enumerate(clusterAssignment_matrix):
                 ind = np.argsort(row)[::-1]
@@ -313,5 +856,3 @@ def map_to_clusters(referenceCounts, referenceGenes,
             return clusterAssignment, Cmeans
         else:
             return clusterAssignment
-
-
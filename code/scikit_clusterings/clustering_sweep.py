@@ -0,0 +1,286 @@
+import os
+import time
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn import cluster, mixture
+from sklearn.neighbors import NearestNeighbors
+
+from misc_tools import ClusteringScorer
+
+# the algorithms a sweep can run, by name
+ALGORITHMS = {
+    'KMeans': cluster.KMeans,
+    'MiniBatchKMeans': cluster.MiniBatchKMeans,
+    'DBSCAN': cluster.DBSCAN,
+    'OPTICS': cluster.OPTICS,
+    'SpectralClustering': cluster.SpectralClustering,
+    'AgglomerativeClustering': cluster.AgglomerativeClustering,
+    'Birch': cluster.Birch,
+    'MeanShift': cluster.MeanShift,
+    'GaussianMixture': mixture.GaussianMixture,
+}
+
+def expand_grid(grid):
+    """
+    Expands a grid like {'DBSCAN': {'eps': [1, 2], 'min_samples': [5, 10]}, 'KMeans': {'n_clusters': [30]}}
+    into a list of (algorithm, parameters) configurations, one for every combination of parameter values.
+    Single values don't need to be in a list.
+    """
+    configurations = []
+    for algorithm, params in grid.items():
+        if algorithm not in ALGORITHMS:
+            raise ValueError('unknown algorithm ' + algorithm + ', use one of ' + ', '.join(ALGORITHMS))
+        names = sorted(params)
+        values = [v if isinstance(v, (list, tuple, np.ndarray)) else [v] for v in (params[n] for n in names)]
+        for combination in itertools.product(*values):
+            configurations.append((algorithm, dict(zip(names, combination))))
+    return configurations
+
+def configuration_hash(data_key, algorithm, params):
+    """
+    Returns the cache key of one configuration on the data with the hex digest data_key.
+    """
+    h = hashlib.sha1()
+    h.update(data_key.encode())
+    h.update(algorithm.encode())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+def _sorted_graph(dist, ind, n):
+    # CSR distance graph with the neighbors of every row sorted by distance; explicit zeros
+    # (the cell itself, duplicated points) are kept so that they still count as neighbors
+    indptr = np.arange(n + 1) * ind.shape[1]
+    return sparse.csr_matrix((dist.ravel(), ind.ravel(), indptr), shape=(n, n))
+
+def _union_graph(A, B):
+    # entries of both distance graphs (the same distance where both have one), keeping explicit zeros
+    A, B = A.tocoo(), B.tocoo()
+    rows = np.concatenate((A.row, B.row))
+    cols = np.concatenate((A.col, B.col))
+    data = np.concatenate((A.data, B.data))
+    _, first = np.unique(rows.astype(np.int64) * A.shape[1] + cols, return_index=True)
+    order = np.lexsort((data[first], rows[first]))
+    keep = first[order]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[keep], minlength=A.shape[0]))))
+    return sparse.csr_matrix((data[keep], cols[keep], indptr), shape=A.shape)
+
+
+class SharedGraphs:
+    """
+    Neighborhoods of the points computed once and shared by all graph-based configurations:
+    a kNN distance graph (every point with itself and its n_neighbors nearest neighbors, sorted
+    by distance) and a radius distance graph (all neighbors within radius).
+
+    Arguments:
+    - X: points x dimensions, e.g. the t-SNE of Figure 1c
+    - n_neighbors: the largest number of neighbors any configuration needs (0 - no kNN graph)
+    - radius: the largest radius any configuration needs (0 - no radius graph)
+    """
+    def __init__(self, X, n_neighbors=0, radius=0):
+        n = X.shape[0]
+        self.npoints = n
+        self.n_neighbors = min(n_neighbors, n - 1)
+        self.radius = radius
+        self.knn = None
+        self.radiusGraph = None
+        if self.n_neighbors > 0 or radius > 0:
+            nn = NearestNeighbors().fit(X)
+        if self.n_neighbors > 0:
+            dist, ind = nn.kneighbors(X, n_neighbors=self.n_neighbors + 1)
+            self.knn = _sorted_graph(dist, ind, n)
+        if radius > 0:
+            self.radiusGraph = nn.radius_neighbors_graph(X, radius, mode='distance', sort_results=True)
+
+    def connectivity(self, n_neighbors):
+        """
+        The kNN connectivity graph without the points themselves, like
+        sklearn.neighbors.kneighbors_graph(X, n_neighbors, include_self=False).
+        """
+        n = self.knn.shape[0]
+        k = self.n_neighbors + 1
+        ind = self.knn.indices.reshape(n, k)
+        # the point itself is normally the first neighbor, but not always with duplicated points
+        notSelf = ind != np.arange(n)[:,None]
+        notSelf[np.sum(notSelf, axis=1) == k, -1] = False
+        ind = ind[notSelf].reshape(n, k - 1)[:, :n_neighbors]
+        indptr = np.arange(n + 1) * n_neighbors
+        return sparse.csr_matrix((np.ones(ind.size), ind.ravel(), indptr), shape=(n, n))
+
+    def needs(self, algorithm, params):
+        """
+        The kNN size and radius that a configuration needs from the shared graphs (0 - none).
+        """
+        metric = params.get('metric', 'euclidean' if algorithm != 'OPTICS' else 'minkowski')
+        if metric not in ['euclidean', 'minkowski'] or params.get('p', 2) not in [2, None]:
+            return 0, 0
+        if algorithm == 'DBSCAN':
+            return 0, params.get('eps', .5)
+        if algorithm == 'OPTICS' and np.isfinite(params.get('max_eps', np.inf)):
+            minSamples = params.get('min_samples', 5)
+            if minSamples <= 1:
+                # a fraction of the points, converted like sklearn.cluster.OPTICS does
+                minSamples = max(2, int(minSamples * self.npoints))
+            return minSamples, params['max_eps']
+        if algorithm == 'SpectralClustering' and params.get('affinity') == 'nearest_neighbors':
+            return params.get('n_neighbors', 10), 0
+        if algorithm == 'AgglomerativeClustering' and 'connectivity_neighbors' in params:
+            return params['connectivity_neighbors'], 0
+        return 0, 0
+
+    def estimator(self, algorithm, params, seed=None):
+        """
+        The sklearn estimator of a configuration and its input: the shared graphs where
+        the configuration can use them, or None for the points. The results are the same as on
+        the points, up to the order of equidistant neighbors (e.g. duplicated points).
+        """
+        params = dict(params)
+        knn, radius = self.needs(algorithm, params)
+        Xin = None
+        if algorithm == 'DBSCAN' and 0 < radius <= self.radius:
+            params['metric'] = 'precomputed'
+            Xin = self.radiusGraph.copy()
+        elif algorithm == 'OPTICS' and 0 < radius <= self.radius and knn <= self.n_neighbors + 1:
+            # core distances need the min_samples nearest neighbors, reachabilities all neighbors within max_eps
+            params['metric'] = 'precomputed'
+            params.pop('p', None)
+            Xin = _union_graph(self.knn, self.radiusGraph)
+        elif algorithm == 'SpectralClustering' and 0 < knn <= self.n_neighbors + 1:
+            params['affinity'] = 'precomputed_nearest_neighbors'
+            Xin = self.knn
+        elif algorithm == 'AgglomerativeClustering' and 'connectivity_neighbors' in params:
+            k = params.pop('connectivity_neighbors')
+            params['connectivity'] = self.connectivity(k)
+        ALGORITHM = ALGORITHMS[algorithm]
+        if seed is not None and 'random_state' in ALGORITHM().get_params() and 'random_state' not in params:
+            params['random_state'] = seed
+        return ALGORITHM(**params), Xin
+
+
+# the points and the shared graphs of the worker processes
+_worker = {}
+
+def _init_worker(X, graphs):
+    _worker['X'] = X
+    _worker['graphs'] = graphs
+
+def _run_configuration(algorithm, params, seed):
+    # module level, so that it can run in a worker process
+    X, graphs = _worker['X'], _worker['graphs']
+    estimator, Xin = graphs.estimator(algorithm, params, seed)
+    start = time.perf_counter()
+    labels = estimator.fit_predict(X if Xin is None else Xin)
+    return np.asarray(labels), time.perf_counter() - start
+
+
+class ClusteringSweep:
+    """
+    Runs a grid of sklearn clusterings on the same points (e.g. the viplamp t-SNE of Figure 1c)
+    and scores them against the true labels. The neighborhoods of the points are computed
+    once (see SharedGraphs) and shared by all DBSCAN, OPTICS (with a finite max_eps), spectral
+    (affinity='nearest_neighbors') and agglomerative (with 'connectivity_neighbors') configurations,
+    configurations run in n_jobs processes, and the labels of every configuration are cached
+    in cachedir under a hash of the points, the algorithm and its parameters.
+
+    Arguments:
+    - X: points x dimensions
+    - true_labels: the labels to score against, e.g. family names or t-types
+    - cachedir: the directory of the cached labels (optional)
+    - n_jobs: the number of processes
+    - seed: random_state of the algorithms that have one (unless given in the grid)
+
+    Attributes:
+    - scorer: the misc_tools.ClusteringScorer of the true labels
+    - labels: the cluster labels of every configuration that was run, by configuration hash
+    """
+    def __init__(self, X, true_labels, cachedir=None, n_jobs=1, seed=42):
+        self.X = np.ascontiguousarray(X)
+        self.scorer = ClusteringScorer(true_labels)
+        self.cachedir = cachedir
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.labels = {}
+        h = hashlib.sha1()
+        h.update(self.X.dtype.str.encode() + repr(self.X.shape).encode())
+        h.update(self.X.tobytes())
+        h.update(repr(seed).encode())
+        self.dataKey = h.hexdigest()
+
+    def _path(self, algorithm, key):
+        return os.path.join(self.cachedir, '{}-{}.npz'.format(algorithm, key[:16]))
+
+    def _cached(self, algorithm, key):
+        if self.cachedir is None or not os.path.exists(self._path(algorithm, key)):
+            return None
+        with np.load(self._path(algorithm, key)) as f:
+            return f['labels'], float(f['seconds'])
+
+    def _save(self, algorithm, key, labels, seconds):
+        if self.cachedir is None:
+            return
+        os.makedirs(self.cachedir, exist_ok=True)
+        path = self._path(algorithm, key)
+        tmp = path + '.tmp{}.npz'.format(os.getpid())
+        np.savez(tmp, labels=labels, seconds=seconds)
+        os.replace(tmp, path)
+
+    def run(self, grid, rank_by='AMI', metrics=None):
+        """
+        Runs (or loads from the cache) every configuration of the grid (see expand_grid; a list
+        of (algorithm, parameters) pairs also works) and returns the score table sorted by rank_by,
+        best first. Noise labels (-1, e.g. from DBSCAN) are scored as one more cluster.
+
+        Returns a DataFrame with the algorithm, its parameters, the number of clusters, the fraction
+        of noise points, the run time in seconds (of the original run for cached configurations),
+        whether it came from the cache, the configuration hash and the metrics.
+        """
+        configurations = expand_grid(grid) if isinstance(grid, dict) else list(grid)
+        keys = [configuration_hash(self.dataKey, a, p) for a, p in configurations]
+        results = {}
+        todo = []
+        for (algorithm, params), key in zip(configurations, keys):
+            cached = self._cached(algorithm, key)
+            if cached is not None:
+                results[key] = cached + (True,)
+            elif key not in [k for _, _, k in todo]:
+                todo.append((algorithm, params, key))
+
+        if todo:
+            # the largest neighborhoods any configuration needs, computed once
+            graphs = SharedGraphs(self.X, 0, 0)
+            needs = [graphs.needs(a, p) for a, p, _ in todo]
+            graphs = SharedGraphs(self.X, max(k for k, _ in needs), max(r for _, r in needs))
+            print('Running {} configurations'.format(len(todo)), end='', flush=True)
+            if self.n_jobs > 1 and len(todo) > 1:
+                with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+                                         initargs=(self.X, graphs)) as executor:
+                    futures = [executor.submit(_run_configuration, a, p, self.seed) for a, p, _ in todo]
+                    for (algorithm, _, key), future in zip(todo, futures):
+                        labels, seconds = future.result()
+                        self._save(algorithm, key, labels, seconds)
+                        results[key] = (labels, seconds, False)
+                        print('.', end='', flush=True)
+            else:
+                _init_worker(self.X, graphs)
+                for algorithm, params, key in todo:
+                    labels, seconds = _run_configuration(algorithm, params, self.seed)
+                    self._save(algorithm, key, labels, seconds)
+                    results[key] = (labels, seconds, False)
+                    print('.', end='', flush=True)
+                _worker.clear()
+            print(' done')
+
+        rows = []
+        for (algorithm, params), key in zip(configurations, keys):
+            labels, seconds, cached = results[key]
+            self.labels[key] = labels
+            row = {'algorithm': algorithm, 'params': params,
+                   'clusters': np.unique(labels[labels >= 0]).size, 'noise': np.mean(labels < 0),
+                   'seconds': seconds, 'cached': cached, 'key': key}
+            row.update(self.scorer.score(labels, metrics))
+            rows.append(row)
+        table = pd.DataFrame(rows)
+        return table.sort_values(rank_by, ascending=False, kind='stable').reset_index(drop=True)
@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pylab as plt
+import matplotlib
+
+def cluster_medians(Z, clusters, nclusters=None):
+    """
+    The median position of every cluster, for all clusters at once: the points are sorted by
+    cluster and coordinate once per dimension and the medians are read off the middle of every group.
+    The values are the same as np.median(Z[clusters==c], axis=0) for every cluster c.
+
+    Arguments:
+    - Z: points x dimensions, e.g. a t-SNE
+    - clusters: the integer cluster of every point
+    - nclusters: the number of clusters (default: the largest cluster + 1)
+
+    Returns:
+    - medians: nclusters x dimensions, nan for empty clusters and clusters with nan positions
+    - sizes: the number of points in every cluster
+    """
+    Z = np.asarray(Z, dtype=float)
+    clusters = np.asarray(clusters).astype(int)
+    nclusters = clusters.max() + 1 if nclusters is None else nclusters
+    sizes = np.bincount(clusters, minlength=nclusters)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    lo = starts + np.maximum(sizes - 1, 0) // 2
+    hi = starts + sizes // 2
+    medians = np.zeros((nclusters, Z.shape[1])) * np.nan
+    nonempty = sizes > 0
+    for d in range(Z.shape[1]):
+        values = Z[np.lexsort((Z[:,d], clusters)), d]
+        withNan = np.bincount(clusters, weights=np.isnan(Z[:,d]), minlength=nclusters) > 0
+        ok = nonempty & ~withNan
+        medians[ok, d] = (values[lo[ok]] + values[hi[ok]]) / 2
+    return medians, sizes
+
+
+def _pixels(Z, extent, resolution):
+    # the pixel (row-major index) of every point inside extent, and which points are inside
+    xmin, xmax, ymin, ymax = extent
+    width, height = resolution
+    ix = np.floor((Z[:,0] - xmin) / (xmax - xmin) * width).astype(np.int64)
+    iy = np.floor((Z[:,1] - ymin) / (ymax - ymin) * height).astype(np.int64)
+    # points on the upper border belong to the last pixel
+    ix[ix == width] = width - 1
+    iy[iy == height] = height - 1
+    inside = (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height)
+    return iy[inside] * width + ix[inside], inside
+
+
+def density_raster(Z, clusters, colors, extent=None, resolution=(800, 800), mode='majority',
+                   background=(1, 1, 1, 0)):
+    """
+    Bins the points into a resolution[0] x resolution[1] pixel raster and colors every pixel
+    by the clusters of its points, so that plotting costs the same for any number of points.
+
+    Arguments:
+    - Z: points x 2 positions
+    - clusters: the integer cluster of every point
+    - colors: the color of every cluster (anything matplotlib understands, e.g. clusterColors)
+    - extent: (xmin, xmax, ymin, ymax) of the raster (default: the range of the points)
+    - resolution: (width, height) in pixels
+    - mode: 'majority' - the color of the most frequent cluster in the pixel (the first one on ties),
+            'blend' - the mean color of the points in the pixel
+    - background: the RGBA color of empty pixels
+
+    Returns:
+    - image: height x width x 4 RGBA array, row 0 at the bottom (imshow with origin='lower')
+    - counts: height x width number of points per pixel
+    - extent: the extent of the raster
+    """
+    Z = np.asarray(Z, dtype=float)
+    clusters = np.asarray(clusters).astype(np.int64)
+    rgba = matplotlib.colors.to_rgba_array(colors)
+    if extent is None:
+        finite = np.all(np.isfinite(Z), axis=1)
+        xmin, ymin = Z[finite].min(axis=0)
+        xmax, ymax = Z[finite].max(axis=0)
+        extent = (xmin, xmax if xmax > xmin else xmin + 1, ymin, ymax if ymax > ymin else ymin + 1)
+    width, height = resolution
+    pixels, inside = _pixels(Z, extent, resolution)
+    clusters = clusters[inside]
+    counts = np.bincount(pixels, minlength=width*height)
+
+    image = np.tile(np.asarray(background, dtype=float), (width*height, 1))
+    filled = counts > 0
+    if mode == 'majority':
+        # count every (pixel, cluster) pair with one sort, then keep the largest count per pixel
+        pairs, pairCounts = np.unique(pixels * rgba.shape[0] + clusters, return_counts=True)
+        pairPixels, pairClusters = pairs // rgba.shape[0], pairs % rgba.shape[0]
+        order = np.lexsort((pairClusters, -pairCounts, pairPixels))
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = pairPixels[order][1:] != pairPixels[order][:-1]
+        best = order[first]
+        image[pairPixels[best]] = rgba[pairClusters[best]]
+    elif mode == 'blend':
+        for channel in range(4):
+            image[filled, channel] = np.bincount(pixels, weights=rgba[clusters, channel],
+                                                 minlength=width*height)[filled] / counts[filled]
+    else:
+        raise ValueError("mode must be 'majority' or 'blend'")
+    return image.reshape(height, width, 4), counts.reshape(height, width), extent
+
+
+class LabelLayout:
+    """
+    Positions of the cluster labels of an embedding plot: the cluster medians plus manual offsets,
+    with optional renames and rotation angles (like in plot_fig1c). The layout of a given
+    embedding, clusters and label settings is computed once and kept in memory (and in cachedir
+    as JSON if given), so that replotting the same embedding does not touch the points again.
+
+    Arguments:
+    - clusterNames: the names of the clusters
+    - offsets: {name: [dx, dy]} offsets of the labels from the cluster medians
+    - renames: {name: label} labels to use instead of the names
+    - angles: {name: degrees} rotated labels
+    - label: a function from the cluster name to its label, if it is not renamed
+    - cachedir: the directory of the cached layouts (optional)
+    """
+    _cache = {}
+
+    def __init__(self, clusterNames, offsets=None, renames=None, angles=None,
+                 label=lambda name: name, cachedir=None):
+        self.clusterNames = np.asarray(clusterNames)
+        self.offsets = offsets or {}
+        self.renames = renames or {}
+        self.angles = angles or {}
+        self.label = label
+        self.cachedir = cachedir
+
+    def _key(self, Z, clusters):
+        h = hashlib.sha1()
+        for a in [np.asarray(Z, dtype=float), np.asarray(clusters).astype(np.int64)]:
+            h.update(repr(a.shape).encode())
+            h.update(np.ascontiguousarray(a).tobytes())
+        h.update('\n'.join(map(str, self.clusterNames)).encode())
+        h.update(json.dumps([sorted(self.offsets.items()), sorted(self.renames.items()),
+                             sorted(self.angles.items())], default=str).encode())
+        code = getattr(self.label, '__code__', None)
+        h.update(repr((code.co_code, code.co_consts) if code is not None else self.label).encode())
+        return h.hexdigest()
+
+    def compute(self, Z, clusters):
+        """
+        Returns a list of labels (x, y, text, cluster, rotation) for the clusters present in clusters.
+        """
+        key = self._key(Z, clusters)
+        if key in self._cache:
+            return self._cache[key]
+        path = os.path.join(self.cachedir, 'labels-' + key[:16] + '.json') if self.cachedir else None
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                layout = [tuple(item) for item in json.load(f)]
+        else:
+            medians, sizes = cluster_medians(Z, clusters, self.clusterNames.size)
+            layout = []
+            for c in np.where(sizes > 0)[0]:
+                name = self.clusterNames[c]
+                x, y = medians[c] + np.array(self.offsets.get(name, [0, 0]))
+                if np.isnan(x):
+                    continue
+                text = self.renames[name] if name in self.renames else self.label(name)
+                layout.append((float(x), float(y), str(text), int(c), self.angles.get(name, 0)))
+            if path is not None:
+                os.makedirs(self.cachedir, exist_ok=True)
+                tmp = path + '.tmp{}'.format(os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(layout, f)
+                os.replace(tmp, path)
+        self._cache[key] = layout
+        return layout
+
+    def draw(self, Z, clusters, colors, ax=None, fontsize=5):
+        """
+        Draws the labels in the colors of their clusters.
+        """
+        ax = plt.gca() if ax is None else ax
+        for x, y, text, c, rotation in self.compute(Z, clusters):
+            ax.text(x, y, text, color=colors[c], fontsize=fontsize, ha='center', va='center',
+                    zorder=1, rotation=rotation)
+
+
+def render_embedding(Z, clusters, colors, ax=None, resolution=(800, 800), mode='majority',
+                     extent=None, layout=None, fontsize=5):
+    """
+    Plots an embedding (e.g. a million-cell t-SNE) as a density raster of cluster colors
+    (see density_raster) with optional cluster labels (a LabelLayout).
+    Returns the image shown with imshow.
+    """
+    ax = plt.gca() if ax is None else ax
+    image, _, extent = density_raster(Z, clusters, colors, extent, resolution, mode)
+    ax.imshow(image, extent=extent, origin='lower', interpolation='nearest', aspect='auto')
+    if layout is not None:
+        layout.draw(Z, clusters, colors, ax, fontsize)
+    return image
@@ -1,6 +1,9 @@
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import gammaln
 from sklearn import preprocessing
-from sklearn.metrics import adjusted_mutual_info_score,fowlkes_mallows_score
 
 def le_family_names(m1data):
     """
@@ -28,19 +31,179 @@ def ami_and_fmscore(true_labels, predicted_labels, silent=False):
     while returning the two values.
     Setting silent=True will prevent the messages from printing.
     """
+    # both scores come from one contingency table (see ClusteringScorer), 
+    # and agree with sklearn's adjusted_mutual_info_score and fowlkes_mallows_score
+    scores = ClusteringScorer(true_labels).score(predicted_labels, metrics=('AMI', 'FMS'))
+
     # unadjusted mutual information score measures if two cluster assignements agree with each other
     # the unadjusted score gives us false results when cluster sizes are small, so using adjusted version
     # value=1: perfect, value around 0: same as random assignment (can be negative)
-    AMI = adjusted_mutual_info_score(true_labels, predicted_labels)
+    AMI = scores['AMI']
     if silent==False:
         print("Adjusted Mutual Info: {}".format(AMI))
         print("(0: bad, 1: perfect)\n")
 
     # the Fowlkes-Mallows score geometric mean between of the precision and recall
     # value=1: perfect, value=0: terrible
-    FMS = fowlkes_mallows_score(true_labels, predicted_labels)
+    FMS = scores['FMS']
     if silent==False:
         print("Fowlkes-Mallows Score:  {}".format(FMS))
         print("(0: bad, 1: perfect)\n")
     
-    return AMI, FMS
\ No newline at end of file
+    return AMI, FMS
+
+
+def _entropy(counts, n):
+    # entropy (in nats) of a labeling with the given cluster sizes, like sklearn's
+    counts = counts[counts > 0]
+    if counts.size <= 1:
+        return 0.0
+    return float(-np.sum((counts / n) * (np.log(counts) - np.log(n))))
+
+
+def contingency_table(true_codes, predicted_codes, ntrue=None, npredicted=None):
+    """
+    The sparse (CSR) contingency table of two labelings given as integer codes:
+    entry (i, j) is the number of cells with true code i and predicted code j.
+    """
+    true_codes = np.asarray(true_codes)
+    predicted_codes = np.asarray(predicted_codes)
+    ntrue = true_codes.max() + 1 if ntrue is None else ntrue
+    npredicted = predicted_codes.max() + 1 if npredicted is None else npredicted
+    table = sparse.coo_matrix((np.ones(true_codes.size, dtype=np.int64), (true_codes, predicted_codes)),
+                              shape=(ntrue, npredicted))
+    return table.tocsr()
+
+
+class ClusteringScorer:
+    """
+    Scores clusterings against one fixed set of true labels (e.g. the families or t-types
+    of the viplamp cells). Every candidate labeling gets one sparse contingency table, and all
+    metrics are derived from it. Everything that depends on the true labels only (their codes,
+    cluster sizes, entropy, pair counts and the log-gamma terms of the expected mutual
+    information) is computed once in the constructor.
+    
+    The metrics agree with sklearn's adjusted_mutual_info_score, adjusted_rand_score,
+    fowlkes_mallows_score, normalized_mutual_info_score and v_measure_score (arithmetic mean,
+    beta=1). 'accuracy' is the cluster purity: every predicted cluster is assigned its most
+    common true label, and the fraction of cells with the assigned label is returned.
+    
+    Arguments:
+    - true_labels: the ground truth labels, any type that np.unique can sort
+    """
+    METRICS = ('AMI', 'ARI', 'FMS', 'NMI', 'V-measure', 'accuracy')
+
+    def __init__(self, true_labels):
+        self.classes, self.codes = np.unique(np.asarray(true_labels), return_inverse=True)
+        self.codes = self.codes.ravel()
+        self.n = self.codes.size
+        self.sizes = np.bincount(self.codes, minlength=self.classes.size).astype(np.int64)
+        self.entropy = _entropy(self.sizes, self.n)
+        self.sumSquares = int(np.sum(self.sizes**2))
+        # log(k!) for every possible count, and the parts of the hypergeometric
+        # probabilities of the expected mutual information that only need the true sizes
+        self._gammaln = gammaln(np.arange(self.n + 1) + 1)
+        self._glnA = self._gammaln[self.sizes] + self._gammaln[self.n - self.sizes]
+
+    def _expected_mutual_info(self, b, blocksize=2**15):
+        # E[MI] under the hypergeometric model of random labelings with the same cluster sizes,
+        # summed over all possible counts of every table entry. The (true, predicted, count)
+        # triples are evaluated together, in blocks of predicted clusters of about blocksize triples
+        n, a, lg = self.n, self.sizes, self._gammaln
+        start = np.maximum(1, a[:,None] + b[None,:] - n)
+        lengths = np.maximum(np.minimum(a[:,None], b[None,:]) - start + 1, 0)
+        perColumn = np.cumsum(np.sum(lengths, axis=0))
+        emi = 0.0
+        first = 0
+        while first < b.size:
+            last = max(first + 1, np.searchsorted(perColumn, perColumn[first] - np.sum(lengths[:,first]) + blocksize, 'right'))
+            L = lengths[:, first:last].ravel()
+            pair = np.repeat(np.arange(L.size), L)
+            i, j = pair // (last - first), first + pair % (last - first)
+            nij = start[i, j] + np.arange(pair.size) - np.repeat(np.cumsum(L) - L, L)
+            ai, bj = a[i], b[j]
+            gln = (self._glnA[i] + lg[bj] + lg[n - bj] - lg[n] - lg[nij]
+                   - lg[ai - nij] - lg[bj - nij] - lg[n - ai - bj + nij])
+            emi += np.sum(nij / n * (np.log(n * nij) - np.log(ai) - np.log(bj)) * np.exp(gln))
+            first = last
+        return emi
+
+    def score(self, predicted_labels, metrics=None):
+        """
+        Returns a dictionary with the metrics (all of METRICS by default) of one candidate labeling.
+        """
+        metrics = self.METRICS if metrics is None else metrics
+        predicted = np.asarray(predicted_labels)
+        if predicted.shape[0] != self.n:
+            raise ValueError('the candidate labels have {} cells, the true labels {}'.format(predicted.shape[0], self.n))
+        _, predictedCodes = np.unique(predicted, return_inverse=True)
+        table = contingency_table(self.codes, predictedCodes.ravel(), self.classes.size)
+        n, a = self.n, self.sizes
+        b = np.asarray(table.sum(axis=0)).ravel().astype(np.int64)
+        rows, cols, nij = sparse.find(table)
+        
+        # the limit cases are the ones of sklearn: both labelings with one cluster match perfectly
+        oneClass, oneCluster = a.size <= 1, b.size <= 1
+        hTrue, hPred = self.entropy, _entropy(b, n)
+        mi = 0.0
+        if not (oneClass or oneCluster):
+            terms = nij / n * (np.log(nij) - np.log(n) - np.log(a[rows] * b[cols]) + 2 * np.log(n))
+            mi = float(np.clip(np.sum(np.where(np.abs(terms) < np.finfo(float).eps, 0, terms)), 0, None))
+        
+        results = {}
+        for metric in metrics:
+            if metric == 'AMI':
+                if oneClass and oneCluster:
+                    results[metric] = 1.0
+                elif oneClass or oneCluster:
+                    results[metric] = 0.0
+                else:
+                    emi = self._expected_mutual_info(b)
+                    eps = np.finfo(float).eps
+                    numerator, denominator = mi - emi, (hTrue + hPred) / 2 - emi
+                    numerator = min(numerator, -eps) if numerator < 0 else max(numerator, eps)
+                    denominator = min(denominator, -eps) if denominator < 0 else max(denominator, eps)
+                    results[metric] = float(numerator / denominator)
+            elif metric == 'ARI':
+                # pairs of cells together in both labelings (tp), only in the truth (fn) or only in the candidate (fp)
+                sumSquares = int(np.dot(nij, nij))
+                tp = sumSquares - n
+                fn = self.sumSquares - sumSquares
+                fp = int(np.sum(b**2)) - sumSquares
+                tn = n**2 - fp - fn - sumSquares
+                results[metric] = 1.0 if fn == 0 and fp == 0 else \
+                    2.0 * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+            elif metric == 'FMS':
+                tk = int(np.dot(nij, nij)) - n
+                pk = int(np.sum(b**2)) - n
+                qk = self.sumSquares - n
+                results[metric] = float(np.sqrt(tk / pk) * np.sqrt(tk / qk)) if tk != 0 else 0.0
+            elif metric == 'NMI':
+                if oneClass and oneCluster:
+                    results[metric] = 1.0
+                else:
+                    results[metric] = 0.0 if mi == 0 else float(mi / ((hTrue + hPred) / 2))
+            elif metric == 'V-measure':
+                homogeneity = mi / hTrue if hTrue else 1.0
+                completeness = mi / hPred if hPred else 1.0
+                results[metric] = 0.0 if homogeneity + completeness == 0 else \
+                    float(2 * homogeneity * completeness / (homogeneity + completeness))
+            elif metric == 'accuracy':
+                results[metric] = float(np.sum(table.max(axis=0).toarray()) / n)
+            else:
+                raise ValueError('unknown metric ' + str(metric) + ', use one of ' + ', '.join(self.METRICS))
+        return results
+
+    def score_many(self, candidates, metrics=None, n_jobs=1):
+        """
+        Scores a list (or a dictionary) of candidate labelings, in n_jobs processes if n_jobs > 1.
+        Returns a DataFrame with one row per candidate (indexed by the dictionary keys) and one column per metric.
+        """
+        names = list(candidates.keys()) if isinstance(candidates, dict) else None
+        labelings = list(candidates.values()) if names is not None else list(candidates)
+        if n_jobs > 1 and len(labelings) > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(self.score, labelings, [metrics] * len(labelings)))
+        else:
+            results = [self.score(labels, metrics) for labels in labelings]
+        return pd.DataFrame(results, index=names, columns=self.METRICS if metrics is None else list(metrics))
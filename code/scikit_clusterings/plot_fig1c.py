@@ -3,6 +3,8 @@ import seaborn as sns; sns.set()
 import matplotlib
 import numpy as np
 
+from embedding_renderer import LabelLayout, render_embedding
+
 # set seaborn styles from original article
 def sns_styleset():
     sns.set(context='paper', style='ticks', font='Arial')
@@ -25,19 +27,28 @@ def sns_styleset():
 
 sns_styleset()
 
-def plot_fig1c(Z, m1data,title="Fig1c from Scala et al."):
+def _short_name(name):
+    # for brevity, keep the cell family name out and replace space with newline
+    return '\n'.join(name.split()[1:])
+
+def plot_fig1c(Z, m1data,title="Fig1c from Scala et al.", raster=False, resolution=(800, 800)):
     """
     This function is a copy of the code from ttype-coverage-mod.ipynb,
     that plots figure 1c in Scala et al.'s article.
     The only difference is that m1data in this code needs to already be the 
     subgroup with key "viplamp"
+    With raster=True the cells are drawn as a density raster of resolution pixels
+    (see embedding_renderer.render_embedding), e.g. for t-SNEs with millions of cells.
     """
     
     clusterColors = m1data['clusterColors']
     clusterNames = m1data['clusterNames']
 
-    plt.scatter(Z[:,0], Z[:,1], s=1, alpha=1, rasterized=True, edgecolors='none',
-                c = clusterColors[m1data['clusters']])
+    if raster:
+        render_embedding(Z, m1data['clusters'], clusterColors, resolution=resolution)
+    else:
+        plt.scatter(Z[:,0], Z[:,1], s=1, alpha=1, rasterized=True, edgecolors='none',
+                    c = clusterColors[m1data['clusters']])
 
     offsets = {'Lamp5 Slc35d3': [25,-20], 'Lamp5 Lhx6': [10,6], 'Lamp5 Pdlim5_2': [20,10],
                'Lamp5 Pdlim5_1': [20,5], 'Lamp5 Pax6': [10,8], 'Lamp5 Egln3_1': [20,8],
@@ -52,24 +63,10 @@ def plot_fig1c(Z, m1data,title="Fig1c from Scala et al."):
     angles = {'Vip Mybpc1_1': 60, 'Sncg Col14a1': -75}
     renames = {'Vip Mybpc1_3': 'M3', 'Vip Serpinf1_1': 'S1', 'Vip Serpinf1_2': 'S2', 'Vip Serpinf1_3': 'S3'}
 
-    for c in np.unique(m1data['clusters']): # for every cluster assigned to Yao et al.'s CGE interneurons
-        ind = m1data['clusters']==c
-        col = clusterColors[c]
-        x,y = np.median(Z[ind,0]), np.median(Z[ind,1]) #set the labels at the median value of the t-SNE values for that cluster
-        if clusterNames[c] in offsets: # use the offset
-            x += offsets[clusterNames[c]][0]
-            y += offsets[clusterNames[c]][1]
-        if clusterNames[c] not in renames:
-            label = '\n'.join(clusterNames[c].split()[1:]) #for brevity, keep the cell family name out and replace space with newline
-        else:
-            label = renames[clusterNames[c]] #rename if you need to
-        if clusterNames[c] not in angles:
-            alpha = 0
-        else:
-            alpha = angles[clusterNames[c]] #set angles to cell types if specified
-
-        if ~np.isnan(x):
-            plt.text(x, y, label, color=col, fontsize=5, ha='center', va='center', zorder=1, rotation=alpha)
+    # labels at the median t-SNE position of every cluster (computed for all clusters at once),
+    # moved by the offsets, renamed and rotated where specified; cached for the same t-SNE
+    layout = LabelLayout(clusterNames, offsets, renames, angles, label=_short_name)
+    layout.draw(Z, m1data['clusters'], clusterColors)
 
     #the next 6 rows are for plotting the cell family names: Vip, Sncg, Lamp5
     col = clusterColors[clusterNames=='Vip Mybpc1_3'][0]
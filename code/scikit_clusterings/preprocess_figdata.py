@@ -1,4 +1,7 @@
+import os
+import json
 import pickle
+import shutil
 import numpy as np
 from scipy import sparse
 
@@ -7,14 +10,21 @@ def common_gene_idx(gene_list1, gene_list2):
     A function to get indices of common genes for gene_list1and gene_list2
     """
     
+    # the first index of every gene name in each list
+    index1, index2 = {}, {}
+    for i, g in enumerate(gene_list1):
+        index1.setdefault(g, i)
+    for i, g in enumerate(gene_list2):
+        index2.setdefault(g, i)
+    
     # get a list of genes which can be found in both gene lists and sort them in alphabetical order
-    gg = sorted(list(set(gene_list1) & set(gene_list2)))
+    gg = sorted(set(index1) & set(index2))
     print('Using a common set of ' + str(len(gg)) + ' genes.')
     
     # the indices in gene_list1 that correspond to the common genes
-    common_genes1 = [np.where(gene_list1==g)[0][0] for g in gg] 
+    common_genes1 = [index1[g] for g in gg] 
     # the indices in gene_list2 that correspond to the common genes
-    common_genes2 = [np.where(gene_list2==g)[0][0] for g in gg] 
+    common_genes2 = [index2[g] for g in gg] 
     
     return common_genes1, common_genes2
 
@@ -46,21 +56,141 @@ def normalize_counts(counts, length, isIntron=False):
     lengths to avoid division by zero.
     """
     if isIntron == True:
-        return counts / ((length+.001)/1000)
+        length = (length+.001)/1000
     else:
-        return counts / (length/1000)
+        length = length/1000
+    if sparse.issparse(counts):
+        # scale the columns without densifying
+        return sparse.csr_matrix(counts) @ sparse.diags(1/length)
+    return counts / length
+
+def log2_counts(counts):
+    """
+    Returns log2(counts + 1). Sparse matrices stay sparse because log2(0+1) = 0.
+    """
+    if sparse.issparse(counts):
+        counts = counts.log1p()
+        counts.data /= np.log(2)
+        return counts
+    return np.log2(counts + 1)
         
 
+def _row_blocks(counts, genes, chunksize):
+    # blocks of rows of counts restricted to the columns genes, sparse if counts is sparse
+    if sparse.issparse(counts):
+        counts = sparse.csr_matrix(counts)
+    for start in range(0, counts.shape[0], chunksize):
+        block = counts[start:start+chunksize]
+        yield block[:, genes] if sparse.issparse(block) else np.asarray(block)[:, genes]
+
+def write_chunks(path, blocks, nrows, ncols, genes=None, dtype=float):
+    """
+    Writes the dense row blocks (an iterable of arrays) into the directory path as chunk-00000.npy,
+    chunk-00001.npy, ... and a manifest.json with the shape, the dtype and the rows of every chunk
+    (and the gene names of the columns into genes.txt if given). The manifest is written last,
+    so that a directory with a manifest is always complete. See load_chunks.
+    """
+    tmp = path.rstrip('/') + '.tmp{}'.format(os.getpid())
+    if os.path.exists(tmp):
+        # left over from an earlier attempt of this process, e.g. in the same notebook kernel
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    try:
+        chunks = []
+        start = 0
+        for i, block in enumerate(blocks):
+            block = np.asarray(block, dtype=dtype)
+            fname = 'chunk-{:05d}.npy'.format(i)
+            np.save(os.path.join(tmp, fname), block)
+            chunks.append({'file': fname, 'start': start, 'stop': start + block.shape[0]})
+            start += block.shape[0]
+        if start != nrows:
+            raise ValueError('the blocks have {} rows, expected {}'.format(start, nrows))
+        if genes is not None:
+            with open(os.path.join(tmp, 'genes.txt'), 'w') as f:
+                f.write('\n'.join(map(str, genes)) + '\n')
+        manifest = {'shape': [nrows, ncols], 'dtype': np.dtype(dtype).str, 'chunks': chunks,
+                    'genes': 'genes.txt' if genes is not None else None}
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            # e.g. a pickle written to the same path by earlier versions
+            os.remove(path)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+
+def load_chunks(path, rows=None, mmap=True):
+    """
+    Loads the rows of a matrix written by write_chunks (e.g. by preprocess_figure_data).
+    Only the chunks that contain the requested rows are opened, memory-mapped if mmap=True.
+    
+    Arguments:
+    - path: the directory with manifest.json
+    - rows: row indices, a slice or a Boolean mask (None - all rows)
+    - mmap: memory-map the chunks instead of reading them
+    
+    Returns:
+    - a numpy array with the selected rows in the requested order, or a memory-mapped view of
+      one chunk if all rows come from it as a slice
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    nrows, ncols = manifest['shape']
+    chunks = manifest['chunks']
+    starts = np.array([c['start'] for c in chunks], dtype=int)
+    mode = 'r' if mmap else None
+    
+    if rows is None:
+        rows = slice(None)
+    if isinstance(rows, slice):
+        start, stop, step = rows.indices(nrows)
+        first = max(np.searchsorted(starts, start, 'right') - 1, 0)
+        if step == 1 and chunks and chunks[first]['start'] <= start and stop <= chunks[first]['stop']:
+            M = np.load(os.path.join(path, chunks[first]['file']), mmap_mode=mode)
+            return M[start-chunks[first]['start']:stop-chunks[first]['start']]
+        rows = np.arange(start, stop, step)
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+        rows = np.where(rows)[0]
+    rows = np.where(rows < 0, rows + nrows, rows)
+    
+    result = np.zeros((rows.size, ncols), dtype=np.dtype(manifest['dtype']))
+    chunkOfRow = np.searchsorted(starts, rows, 'right') - 1
+    for c in np.unique(chunkOfRow):
+        M = np.load(os.path.join(path, chunks[c]['file']), mmap_mode=mode)
+        selected = chunkOfRow == c
+        result[selected] = M[rows[selected] - chunks[c]['start']]
+    return result
+
+def load_chunk_genes(path):
+    """
+    Returns the gene names of the columns of a matrix written by write_chunks, or None.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['genes'] is None:
+        return None
+    with open(os.path.join(path, manifest['genes'])) as f:
+        return np.array(f.read().splitlines(), dtype=object)
+
+
 # this function was created from the first half of the map_to_tsne function in rnaseqTools.py
 def preprocess_figure_data(reference_umicnt, reference_genes, new_exoncnt, new_introncnt,
-                   new_genes, exonlen, intronlen, UMI_fname, exint_fname):
+                   new_genes, exonlen, intronlen, UMI_fname, exint_fname, chunksize=5000,
+                   output='pickle', dtype=float):
     """
     This function is for preprocessing the reference data and new data in the same way as the article 
     by Scala st al. It assumes that the reference data is UMI counts and the new data is separated 
     into exon counts and intron counts.
     It first normalizes the counts by exon lengths and intron lengths. The UMI counts are normalized
     by exon lengths only. Then the normalized UMI counts and exonic + intronic expression levels for 
-    common genes and all genes are written as pickle files in the given path.
+    common genes are written out in the given paths.
+    The counts stay sparse (if they are sparse), and the normalization and log2 transform are done
+    on blocks of chunksize rows, so that only one dense block is in memory at a time.
     
     Arguments:
     - reference_umicnt: the reference UMI counts
@@ -72,35 +202,48 @@ def preprocess_figure_data(reference_umicnt, reference_genes, new_exoncnt, new_i
     - intronlen: intron lengths
     - UMI_fname: file path + name for the output UMI counts
     - exint_fname: file path + name for the output exonic + intronic expression levels
+    - chunksize: the number of rows per block (and per output chunk)
+    - output: 'pickle' - pickle files of numpy matrices, like earlier versions,
+              'chunks' - directories of .npy chunks with a manifest (see load_chunks)
+    - dtype: the dtype of the output, e.g. np.float32 to halve the size
     
-    Writes out:
-    1. <UMI_fname>: a pickle file of normalized UMI counts for common genes
-    2. <exint_fname>: a pickle file of normalized exonic + intronic expression levels for common genes
+    Writes out (a file, or with output='chunks' a directory in place of the file):
+    1. <UMI_fname>: normalized UMI counts for common genes
+    2. <exint_fname>: normalized exonic + intronic expression levels for common genes
     """
+    if output not in ['chunks', 'pickle']:
+        raise ValueError("output must be 'chunks' or 'pickle'")
+    
     # get indices in reference gene list and new gene list that correspond to the common genes
     ref_common_gidx, new_common_gidx = common_gene_idx(reference_genes, new_genes)
-    
-    # if counts are sparse matrices, convert to numpy matrices
-    reference_umicnt, new_exoncnt, new_introncnt = get_dense(reference_umicnt, new_exoncnt, new_introncnt)
-    
-    # get the umi/exon/intron counts for the common genes
-    com_ref_umi = reference_umicnt[:, ref_common_gidx]
-    com_new_exon = new_exoncnt[:,new_common_gidx]
-    com_new_intron = new_introncnt[:,new_common_gidx]
+    genes = np.asarray(new_genes)[new_common_gidx]
     
     # get the exon/intron lengths for the common genes
     com_exonlen = exonlen[new_common_gidx]
     com_intronlen = intronlen[new_common_gidx]
     
-    # get normalized UMI counts
-    ncom_ref_umi = normalize_counts(com_ref_umi, com_exonlen)
-    ncom_ref_umi = np.log2(ncom_ref_umi + 1)
+    # get normalized UMI counts, one block of cells at a time
+    def umi_blocks():
+        for com_ref_umi in _row_blocks(reference_umicnt, ref_common_gidx, chunksize):
+            ncom_ref_umi = log2_counts(normalize_counts(com_ref_umi, com_exonlen))
+            yield ncom_ref_umi.toarray() if sparse.issparse(ncom_ref_umi) else ncom_ref_umi
     
     # get normalized exon+intron expression levels
-    ncom_exint = normalize_counts(com_new_exon, com_exonlen) + \
-    normalize_counts(com_new_intron, com_intronlen, isIntron=True)
-    ncom_exint = np.log2(ncom_exint + 1)
+    def exint_blocks():
+        for com_new_exon, com_new_intron in zip(_row_blocks(new_exoncnt, new_common_gidx, chunksize),
+                                                _row_blocks(new_introncnt, new_common_gidx, chunksize)):
+            ncom_exint = normalize_counts(com_new_exon, com_exonlen) + \
+            normalize_counts(com_new_intron, com_intronlen, isIntron=True)
+            ncom_exint = log2_counts(ncom_exint)
+            yield ncom_exint.toarray() if sparse.issparse(ncom_exint) else ncom_exint
     
     # write the normalized counts and expression levels
-    pickle.dump(ncom_ref_umi, open(UMI_fname, 'wb'))
-    pickle.dump(ncom_exint, open(exint_fname, 'wb'))
+    for fname, blocks, nrows in [(UMI_fname, umi_blocks(), reference_umicnt.shape[0]),
+                                 (exint_fname, exint_blocks(), new_exoncnt.shape[0])]:
+        if output == 'chunks':
+            write_chunks(fname, blocks, nrows, genes.size, genes, dtype)
+        else:
+            M = np.asmatrix(np.concatenate([np.asarray(b, dtype=dtype) for b in blocks])
+                            if nrows > 0 else np.zeros((0, genes.size), dtype=dtype))
+            with open(fname, 'wb') as f:
+                pickle.dump(M, f)